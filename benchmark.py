@@ -0,0 +1,407 @@
+"""
+性能基准测试
+
+在本机生成合成目录树，启动进程内的 WebDAV 服务器，分别统计各个阶段的耗时，结果写入 JSON 文件。
+不需要网络，用于在同一台机器上比较不同版本之间的性能变化。
+
+用法：
+    python benchmark.py --files 2000 --min-size-kb 4 --max-size-kb 1024 --compressibility 0.5 --output bench.json
+"""
+import argparse
+import email.utils
+import hashlib
+import json
+import logging
+import math
+import os
+import platform
+import random
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime, timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import quote, unquote, urlparse
+from xml.sax.saxutils import escape
+
+from utils.db_handler import DatabaseManager
+from utils.local_file_handler import get_available_files
+from utils.webdav_sync import WebDAVSyncClient
+import main
+
+class WebDAVRequestHandler(BaseHTTPRequestHandler):
+    """
+    最小的 WebDAV 服务器实现，文件保存在 server.root 目录中
+
+    支持 GET、HEAD、PUT（含分块传输编码和 Content-Range）、DELETE、MKCOL 和 PROPFIND（Depth 0/1），
+    足够覆盖 webdavclient3 在本项目中用到的请求
+    """
+    protocol_version = 'HTTP/1.1'
+    # 响应头和响应体分两次写出，keep-alive 连接上不关闭 Nagle 会与客户端的延迟确认叠加，每个请求多等约 40ms；
+    # 常见的 WebDAV 服务器（nginx、Apache）都会设置 TCP_NODELAY
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        pass
+
+    def _local_path(self):
+        path = unquote(urlparse(self.path).path)
+        parts = [part for part in path.split('/') if part not in ('', '.', '..')]
+        return os.path.join(self.server.root, *parts)
+
+    def _send(self, status, body=b'', headers=None):
+        self.send_response(status)
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        if body and self.command != 'HEAD':
+            self.wfile.write(body)
+
+    def _read_body(self):
+        """读取请求体，返回产出 bytes 的生成器"""
+        if self.headers.get('Transfer-Encoding', '').lower() == 'chunked':
+            while True:
+                size = int(self.rfile.readline().split(b';')[0].strip(), 16)
+                if size == 0:
+                    # 跳过 trailer
+                    while self.rfile.readline() not in (b'\r\n', b'\n', b''):
+                        pass
+                    return
+                yield self.rfile.read(size)
+                self.rfile.readline()
+        remaining = int(self.headers.get('Content-Length') or 0)
+        while remaining > 0:
+            data = self.rfile.read(min(remaining, 1024 * 1024))
+            if not data:
+                return
+            remaining -= len(data)
+            yield data
+
+    def do_HEAD(self):
+        path = self._local_path()
+        if not os.path.exists(path):
+            self._send(404)
+        elif os.path.isdir(path):
+            self._send(200)
+        else:
+            self.send_response(200)
+            self.send_header('Content-Length', str(os.path.getsize(path)))
+            self.end_headers()
+
+    def do_GET(self):
+        path = self._local_path()
+        if not os.path.isfile(path):
+            self._send(404)
+            return
+        with open(path, 'rb') as f:
+            self._send(200, f.read())
+
+    def do_PUT(self):
+        path = self._local_path()
+        if not os.path.isdir(os.path.dirname(path)):
+            for _ in self._read_body():
+                pass
+            self._send(409)
+            return
+        content_range = self.headers.get('Content-Range')
+        if content_range:
+            # Content-Range: bytes start-end/total
+            start = int(content_range.split()[1].split('-')[0])
+            mode = 'r+b' if os.path.exists(path) else 'wb'
+            with open(path, mode) as f:
+                f.truncate(start)
+                f.seek(start)
+                for data in self._read_body():
+                    f.write(data)
+        else:
+            with open(path, 'wb') as f:
+                for data in self._read_body():
+                    f.write(data)
+        self._send(201)
+
+    def do_DELETE(self):
+        path = self._local_path()
+        if not os.path.exists(path):
+            self._send(404)
+        elif os.path.isdir(path):
+            shutil.rmtree(path)
+            self._send(204)
+        else:
+            os.remove(path)
+            self._send(204)
+
+    def do_MKCOL(self):
+        path = self._local_path()
+        if os.path.exists(path):
+            self._send(405)
+        elif not os.path.isdir(os.path.dirname(path)):
+            self._send(409)
+        else:
+            os.mkdir(path)
+            self._send(201)
+
+    def _prop_response(self, href, path):
+        stat = os.stat(path)
+        is_dir = os.path.isdir(path)
+        if is_dir and not href.endswith('/'):
+            href += '/'
+        etag = hashlib.md5(f"{path}:{stat.st_size}:{stat.st_mtime_ns}".encode('utf-8')).hexdigest()
+        return (
+            f"<d:response><d:href>{escape(quote(href))}</d:href><d:propstat><d:prop>"
+            f"<d:resourcetype>{'<d:collection/>' if is_dir else ''}</d:resourcetype>"
+            f"<d:getcontentlength>{0 if is_dir else stat.st_size}</d:getcontentlength>"
+            f"<d:getlastmodified>{email.utils.formatdate(stat.st_mtime, usegmt=True)}</d:getlastmodified>"
+            f"<d:creationdate>{datetime.utcfromtimestamp(stat.st_ctime).strftime('%Y-%m-%dT%H:%M:%SZ')}</d:creationdate>"
+            f"<d:getetag>\"{etag}\"</d:getetag>"
+            f"</d:prop><d:status>HTTP/1.1 200 OK</d:status></d:propstat></d:response>"
+        )
+
+    def do_PROPFIND(self):
+        for _ in self._read_body():
+            pass
+        path = self._local_path()
+        if not os.path.exists(path):
+            self._send(404)
+            return
+        href = unquote(urlparse(self.path).path)
+        responses = [self._prop_response(href, path)]
+        if os.path.isdir(path) and self.headers.get('Depth', '1') != '0':
+            base = href if href.endswith('/') else href + '/'
+            for name in sorted(os.listdir(path)):
+                responses.append(self._prop_response(base + name, os.path.join(path, name)))
+        body = ('<?xml version="1.0" encoding="utf-8"?><d:multistatus xmlns:d="DAV:">'
+                + ''.join(responses) + '</d:multistatus>').encode('utf-8')
+        self._send(207, body, {'Content-Type': 'application/xml; charset=utf-8'})
+
+class LocalWebDAVServer:
+    """在后台线程中运行的进程内 WebDAV 服务器，只监听 127.0.0.1"""
+    def __init__(self, root):
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), WebDAVRequestHandler)
+        self.server.daemon_threads = True
+        self.server.root = root
+        self.thread = threading.Thread(target=self.server.serve_forever, name="bench-webdav", daemon=True)
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self.server.server_address[1]}"
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.server.shutdown()
+        self.server.server_close()
+
+def generate_tree(root, files, dirs, min_size, max_size, distribution, compressibility, seed):
+    """
+    生成合成目录树
+
+    :param compressibility: 0-1，每个文件中可压缩内容（重复文本）所占的比例，其余为随机字节
+    :return: (文件数, 总字节数)
+    """
+    rng = random.Random(seed)
+    pattern = b"webdavsync benchmark line 0123456789 abcdefghijklmnopqrstuvwxyz\n" * 16
+    total_bytes = 0
+    for index in range(files):
+        if distribution == 'lognormal':
+            # 中位数为最小值和最大值的几何平均
+            mu = (math.log(min_size) + math.log(max_size)) / 2
+            size = int(min(max_size, max(min_size, rng.lognormvariate(mu, 1.0))))
+        else:
+            size = rng.randint(min_size, max_size)
+        compressible = int(size * compressibility)
+        data = (pattern * (compressible // len(pattern) + 1))[:compressible] + rng.randbytes(size - compressible)
+        directory = os.path.join(root, f"dir_{index % dirs:04d}") if dirs > 1 else root
+        os.makedirs(directory, exist_ok=True)
+        # 文件名全局唯一，不压缩同步时远程目录是平铺的
+        with open(os.path.join(directory, f"file_{index:06d}.bin"), 'wb') as f:
+            f.write(data)
+        total_bytes += size
+    return files, total_bytes
+
+def create_expired_archives(directory, count, age_days, db_manager):
+    """生成已过期且已上传的压缩包并登记到数据库，用于测试本地清理"""
+    os.makedirs(directory, exist_ok=True)
+    start = datetime.now() - timedelta(days=age_days)
+    for index in range(count):
+        create_time = start - timedelta(minutes=index)
+        archive_path = os.path.join(directory, f"bench_{create_time.strftime('%Y-%m-%d-%H-%M-%S')}.wdsync.zip")
+        with open(archive_path, 'wb') as f:
+            f.write(b'PK\x05\x06' + b'\x00' * 18)
+        db_manager.add_archive(None, archive_path, 'zip', file_size=22, uploaded=True, create_time=create_time)
+
+class StageTimer:
+    """记录每个阶段的耗时、文件数和字节数"""
+    def __init__(self):
+        self.stages = {}
+
+    def run(self, name, func, files=0, bytes_processed=0):
+        start = time.perf_counter()
+        result = func()
+        seconds = time.perf_counter() - start
+        self.stages[name] = {'seconds': seconds, 'files': files, 'bytes': bytes_processed}
+        logging.info(f"{name}: {seconds:.3f} 秒")
+        return result
+
+def run_database_benchmark(timer, workdir, records):
+    """DatabaseManager 的批量读写"""
+    db_manager = DatabaseManager(os.path.join(workdir, 'bench_db.db'))
+    paths = [f"/bench/local/file_{index:08d}.bin" for index in range(records)]
+    timer.run('db_add_files', lambda: db_manager.add_files(
+        [(path, f"/bench/remote/{os.path.basename(path)}", 1024, 1.0, None) for path in paths]), records)
+    timer.run('db_get_files_info', lambda: db_manager.get_files_info(paths), records)
+    timer.run('db_update_files_stat', lambda: db_manager.update_files_stat(
+        [(path, 2048, 2.0, 'hash') for path in paths]), records)
+    expired = timer.run('db_get_expired_remote_files', lambda: db_manager.get_expired_remote_files(
+        '/bench/remote', datetime.now() + timedelta(days=1)), records)
+    timer.run('db_mark_remote_deleted_batch', lambda: db_manager.mark_remote_deleted_batch(expired), len(expired))
+
+def run_suite(args, workdir):
+    """在 workdir 中执行一轮完整的测试，返回各阶段的结果"""
+    timer = StageTimer()
+    origin_dir = os.path.join(workdir, 'origin')
+    zip_dir = os.path.join(workdir, 'zips')
+    server_root = os.path.join(workdir, 'server')
+    os.makedirs(zip_dir)
+    os.makedirs(os.path.join(server_root, 'bench'))
+
+    file_count, total_bytes = generate_tree(origin_dir, args.files, args.dirs, args.min_size_kb * 1024,
+                                            args.max_size_kb * 1024, args.size_distribution,
+                                            args.compressibility, args.seed)
+
+    run_database_benchmark(timer, workdir, args.db_records)
+
+    with LocalWebDAVServer(server_root) as server:
+        config_file = os.path.join(workdir, 'config.json')
+        with open(config_file, 'w') as f:
+            json.dump({
+                'WebDAV': {'url': server.url, 'username': '', 'password': '',
+                           'max_concurrent_uploads': args.upload_workers},
+                'Sync': []
+            }, f)
+        client = WebDAVSyncClient(config_file)
+        db_manager = DatabaseManager(os.path.join(workdir, 'synced_files.db'))
+
+        sync_config = {
+            'local_sync_directory': origin_dir,
+            'remote_directory': '/bench',
+            'local_save_day': args.local_save_day,
+            'remote_save_day': 0,
+            'ready_settle_seconds': args.settle_seconds,
+            'upload_workers': args.upload_workers
+        }
+        zip_config = dict(sync_config,
+                          local_zip=True,
+                          local_origin_directory=origin_dir,
+                          local_sync_directory=zip_dir,
+                          zip_workers=args.zip_workers)
+
+        file_list = timer.run('get_available_files',
+                              lambda: get_available_files(origin_dir, settle_seconds=args.settle_seconds),
+                              file_count, total_bytes)
+        zip_files = timer.run('handle_local_zip', lambda: main.handle_local_zip(client, zip_config, db_manager),
+                              file_count, total_bytes)
+        timer.stages['handle_local_zip']['output_bytes'] = sum(os.path.getsize(path) for path in zip_files)
+        timer.run('sync_files', lambda: main.sync_files(client, db_manager, file_list, sync_config),
+                  len(file_list), total_bytes)
+        # 第二次同步没有需要上传的文件，只统计变化检测的开销
+        timer.run('sync_files_unchanged', lambda: main.sync_files(client, db_manager, file_list, sync_config),
+                  len(file_list), 0)
+
+        create_expired_archives(zip_dir, args.expired_archives, args.local_save_day + 1, db_manager)
+        timer.run('clean_local_expired_files', lambda: main.clean_local_expired_files(db_manager, zip_config),
+                  args.expired_archives)
+        timer.run('clean_remote_expired_files',
+                  lambda: main.clean_remote_expired_files(client, db_manager, sync_config), len(file_list))
+    return timer.stages
+
+def summarize(runs):
+    """合并多轮结果，保留每轮耗时以及最小值和中位数"""
+    summary = {}
+    for name in runs[0]:
+        seconds = [run[name]['seconds'] for run in runs]
+        stage = {key: value for key, value in runs[0][name].items() if key != 'seconds'}
+        stage.update({
+            'runs': seconds,
+            'min_seconds': min(seconds),
+            'median_seconds': statistics.median(seconds)
+        })
+        best = stage['min_seconds'] or 1e-9
+        if stage['files']:
+            stage['files_per_second'] = stage['files'] / best
+        if stage['bytes']:
+            stage['mb_per_second'] = stage['bytes'] / best / 1024 / 1024
+        summary[name] = stage
+    return summary
+
+def get_git_revision():
+    try:
+        return subprocess.check_output(['git', 'describe', '--always', '--dirty'],
+                                       cwd=os.path.dirname(os.path.abspath(__file__)),
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="webdavsync 性能基准测试")
+    parser.add_argument('--files', type=int, default=1000, help="生成的文件数")
+    parser.add_argument('--dirs', type=int, default=10, help="文件分布的子目录数")
+    parser.add_argument('--min-size-kb', type=int, default=4, help="最小文件大小（KB）")
+    parser.add_argument('--max-size-kb', type=int, default=256, help="最大文件大小（KB）")
+    parser.add_argument('--size-distribution', choices=['uniform', 'lognormal'], default='lognormal',
+                        help="文件大小分布")
+    parser.add_argument('--compressibility', type=float, default=0.5,
+                        help="文件内容中可压缩部分的比例，0为完全随机，1为完全重复")
+    parser.add_argument('--seed', type=int, default=42, help="随机数种子，相同参数生成相同的文件")
+    parser.add_argument('--db-records', type=int, default=10000, help="数据库测试的记录数")
+    parser.add_argument('--expired-archives', type=int, default=100, help="本地清理测试的过期压缩包数")
+    parser.add_argument('--local-save-day', type=int, default=7)
+    parser.add_argument('--settle-seconds', type=float, default=0, help="get_available_files 的等待秒数")
+    parser.add_argument('--upload-workers', type=int, default=4)
+    parser.add_argument('--zip-workers', type=int, default=1)
+    parser.add_argument('--repeat', type=int, default=1, help="重复执行的轮数，结果中记录每轮耗时")
+    parser.add_argument('--output', default='bench_results.json', help="结果文件路径")
+    parser.add_argument('--workdir', help="在这个目录下创建每轮的临时测试目录（不存在时自动创建），默认使用系统临时目录；每轮结束后删除临时测试目录")
+    parser.add_argument('--verbose', action='store_true', help="输出程序日志")
+    return parser.parse_args(argv)
+
+def main_benchmark(argv=None):
+    args = parse_args(argv)
+    logging.basicConfig(level=logging.INFO if args.verbose else logging.WARNING,
+                        format='%(asctime)s - %(levelname)s - %(message)s')
+
+    if args.workdir:
+        os.makedirs(args.workdir, exist_ok=True)
+    runs = []
+    for _ in range(args.repeat):
+        workdir = tempfile.mkdtemp(prefix='wdsync_bench_', dir=args.workdir)
+        try:
+            runs.append(run_suite(args, workdir))
+        finally:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    result = {
+        'created': datetime.now().isoformat(timespec='seconds'),
+        'revision': get_git_revision(),
+        'python': sys.version.split()[0],
+        'platform': platform.platform(),
+        'cpu_count': os.cpu_count(),
+        'params': vars(args),
+        'stages': summarize(runs)
+    }
+    with open(args.output, 'w', encoding='utf-8') as f:
+        json.dump(result, f, ensure_ascii=False, indent=2)
+
+    for name, stage in result['stages'].items():
+        print(f"{name:<30} {stage['min_seconds']:>9.3f} 秒  {stage.get('files_per_second', 0):>10.1f} 文件/秒  "
+              f"{stage.get('mb_per_second', 0):>8.1f} MB/秒")
+    print(f"结果已保存到 {args.output}")
+
+if __name__ == '__main__':
+    main_benchmark()
@@ -1,14 +1,26 @@
 import logging, os, time
-from datetime import datetime
+from datetime import datetime, timedelta
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from apscheduler.schedulers.background import BackgroundScheduler
 from apscheduler.triggers.cron import CronTrigger
-from utils.webdav_sync import WebDAVSyncClient
+from watchdog.observers import Observer
+from utils.webdav_sync import WebDAVSyncClient, SyncEventHandler
 from utils.db_handler import DatabaseManager
-from utils.local_file_handler import get_available_files
-from utils.zip_handler import ZipHandler
+from utils.local_file_handler import iter_available_files, compute_file_hash
+from utils.file_walker import FileRecord, PathFilter, walk_files
+from utils.zip_handler import (ZipHandler, CompressionPolicy, scan_directory, write_file, write_files_parallel,
+                               TIMESTAMP_FORMAT)
+from utils.upload_engine import upload_files, stream_upload
+from utils.mysql_handler import MySQLBackup
+from utils.metrics import SyncMetrics
+from utils.coordinator import JobCoordinator, BandwidthLimiter
+from utils.dedup_store import DedupStore
 from logging.handlers import RotatingFileHandler
 import hashlib
 import zipfile
+import gzip
+import io
+import json
 
 def setup_logging():
     # 确保日志目录存在
@@ -41,11 +53,23 @@ def setup_logging():
 
     logging.info("日志系统初始化完成")
 
-def handle_local_zip(client, sync_config):
-    """处理本地文件压缩任务"""
+def handle_local_zip(client, sync_config, db_manager=None):
+    """
+    处理本地文件压缩任务
+
+    不压缩时返回边遍历边产出可上传文件（FileRecord）的生成器，由 sync_files 边消费边上传
+    """
     if not sync_config.get('local_zip', False):
-        return get_available_files(sync_config['local_sync_directory'])
+        return iter_available_files(
+            sync_config['local_sync_directory'],
+            settle_seconds=sync_config.get('ready_settle_seconds', 1),
+            max_workers=sync_config.get('ready_probe_workers', 8),
+            path_filter=PathFilter.from_config(sync_config)
+        )
         
+    if sync_config.get('incremental_zip', False) and db_manager is not None:
+        return handle_incremental_zip(db_manager, sync_config)
+
     origin_dir = sync_config['local_origin_directory']
     sync_dir = sync_config['local_sync_directory']
     
@@ -55,19 +79,13 @@ def handle_local_zip(client, sync_config):
         zip_filename = f"{folder_name}_{timestamp}.wdsync.zip"
         zip_filepath = os.path.join(sync_dir, zip_filename)
         
-        with zipfile.ZipFile(zip_filepath, 'w', zipfile.ZIP_DEFLATED) as zipf:
-            for root, _, files in os.walk(origin_dir):
-                for file in files:
-                    file_path = os.path.join(root, file)
-                    try:
-                        # 获取相对路径
-                        arc_path = os.path.relpath(file_path, origin_dir)
-                        # 尝试添加文件到压缩包
-                        zipf.write(file_path, arc_path)
-                    except (OSError, IOError) as e:
-                        # 记录错误但继续处理其他文件
-                        logging.warning(f"无法压缩文件 {file_path}: {str(e)}")
-                        continue
+        if sync_config.get('stream_upload', False):
+            return stream_local_zip(client, db_manager, sync_config, zip_filename)
+
+        with open(zip_filepath, 'wb') as f:
+            write_origin_zip(f, sync_config)
+        if db_manager is not None:
+            db_manager.add_archive(origin_dir, zip_filepath, 'zip', file_size=os.path.getsize(zip_filepath))
         
         logging.info(f"成功创建压缩文件: {zip_filepath}")
         return [zip_filepath]
@@ -76,126 +94,796 @@ def handle_local_zip(client, sync_config):
         logging.error(f"创建压缩文件失败: {str(e)}")
         raise
 
-def sync_files(client, db_manager, file_list, sync_config):
-    """同步本地文件到远程"""
-    unsynced_files = []
-    for file_path in file_list:
-        file_info = db_manager.get_file_info(file_path)
-        if file_info is None or not file_info["sync_success"]:
-            unsynced_files.append(file_path)
-    
-    success_count = 0
-    for file_path in unsynced_files:
+def write_origin_zip(fileobj, sync_config):
+    """将源目录压缩写入类文件对象"""
+    origin_dir = sync_config['local_origin_directory']
+    zip_workers = sync_config.get('zip_workers', 1)
+    compress_level = sync_config.get('zip_compress_level', -1)
+    policy = CompressionPolicy.from_config(sync_config)
+    cpu_start = time.process_time()
+    records = walk_files(origin_dir, PathFilter.from_config(sync_config))
+    with zipfile.ZipFile(fileobj, 'w', zipfile.ZIP_DEFLATED, compresslevel=compress_level) as zipf:
+        if zip_workers > 1:
+            # 多线程分块压缩，仍然生成标准zip
+            files = ((record.path, record.rel_path) for record in records)
+            write_files_parallel(zipf, files, zip_workers, compress_level, policy=policy)
+        else:
+            for record in records:
+                try:
+                    # 尝试添加文件到压缩包
+                    write_file(zipf, record.path, record.rel_path, policy)
+                except (OSError, IOError) as e:
+                    # 记录错误但继续处理其他文件
+                    logging.warning(f"无法压缩文件 {record.path}: {str(e)}")
+                    continue
+    if policy:
+        policy.log_summary(time.process_time() - cpu_start)
+
+def stream_local_zip(client, db_manager, sync_config, zip_filename):
+    """
+    一边压缩一边上传，不在本地暂存完整压缩包
+
+    keep_local_copy 为 true 时从同一个数据流写一份本地副本，用于本地保留
+    """
+    sync_dir = sync_config['local_sync_directory']
+    remote_path = os.path.join(sync_config['remote_directory'], zip_filename).replace('\\', '/')
+    local_copy_path = os.path.join(sync_dir, zip_filename) if sync_config.get('keep_local_copy', False) else None
+    buffer_mb = sync_config.get('stream_buffer_mb', 8)
+
+    try:
+        pipe = stream_upload(
+            client,
+            remote_path,
+            lambda fileobj: write_origin_zip(fileobj, sync_config),
+            chunk_size=1024 * 1024,
+            max_chunks=buffer_mb,
+            local_copy_path=local_copy_path
+        )
+    except Exception:
+        # 不保留不完整的本地副本
+        if local_copy_path and os.path.exists(local_copy_path):
+            os.remove(local_copy_path)
+        raise
+
+    # 已经上传完成，直接记录同步状态，不再交给 sync_files
+    record_path = local_copy_path or remote_path
+    file_mtime = os.path.getmtime(local_copy_path) if local_copy_path else None
+    db_manager.add_file(record_path, remote_path, pipe.size, file_mtime, pipe.hexdigest)
+    db_manager.update_file_sync_status(record_path, True)
+    if local_copy_path:
+        db_manager.add_archive(sync_config['local_origin_directory'], local_copy_path, 'zip',
+                               file_size=pipe.size, uploaded=True)
+    logging.info(f"成功流式上传压缩文件: {remote_path}, 大小 {pipe.size} 字节")
+    return [local_copy_path] if local_copy_path else []
+
+def handle_incremental_zip(db_manager, sync_config):
+    """
+    增量压缩：定期创建完整归档，其余时间只压缩上次归档后新增、修改的文件，并记录删除的文件
+    """
+    origin_dir = sync_config['local_origin_directory']
+    sync_dir = sync_config['local_sync_directory']
+    full_archive_days = sync_config.get('full_archive_days', 7)
+
+    now = datetime.now()
+    timestamp = now.strftime(TIMESTAMP_FORMAT)
+    folder_name = os.path.basename(origin_dir.rstrip('/\\'))
+
+    current_index = scan_directory(origin_dir, PathFilter.from_config(sync_config))
+    previous_index = db_manager.get_archive_index(origin_dir)
+    last_full = db_manager.get_last_archive(origin_dir, 'full')
+    need_full = (
+        last_full is None
+        or (now - datetime.fromisoformat(str(last_full['create_time']))).days >= full_archive_days
+    )
+
+    if need_full:
+        archive_type = 'full'
+        changed = sorted(current_index)
+        deleted = []
+        base_archive = None
+        zip_filename = f"{folder_name}_{timestamp}.wdsync.zip"
+    else:
+        archive_type = 'delta'
+        changed = sorted(p for p, sig in current_index.items() if previous_index.get(p) != sig)
+        deleted = sorted(p for p in previous_index if p not in current_index)
+        if not changed and not deleted:
+            logging.info(f"源目录自上次归档后没有变化，跳过压缩: {origin_dir}")
+            return []
+        base_archive = os.path.basename(last_full['archive_path'])
+        zip_filename = f"{folder_name}_delta_{timestamp}.wdsync.zip"
+
+    last_archive = db_manager.get_last_archive(origin_dir)
+    manifest = {
+        'type': archive_type,
+        'created': timestamp,
+        'base': base_archive,
+        'previous': os.path.basename(last_archive['archive_path']) if last_archive else None,
+        'files': changed,
+        'deleted': deleted
+    }
+    policy = CompressionPolicy.from_config(sync_config)
+    zip_handler = ZipHandler(origin_dir, sync_dir, zip_filename,
+                             workers=sync_config.get('zip_workers', 1),
+                             compress_level=sync_config.get('zip_compress_level', -1),
+                             policy=policy)
+    cpu_start = time.process_time()
+    zip_filepath = zip_handler.create_zip(files=changed, manifest=manifest)
+    if policy:
+        policy.log_summary(time.process_time() - cpu_start)
+
+    # 压缩失败的文件保留旧索引，下次增量时会重新压缩
+    archived_index = dict(current_index)
+    for rel_path in zip_handler.skipped_files:
+        if rel_path in previous_index and not need_full:
+            archived_index[rel_path] = previous_index[rel_path]
+        else:
+            archived_index.pop(rel_path, None)
+    db_manager.replace_archive_index(origin_dir, archived_index)
+    db_manager.add_archive(origin_dir, zip_filepath, archive_type, base_archive,
+                           file_size=os.path.getsize(zip_filepath))
+
+    logging.info(f"已创建{'完整' if need_full else '增量'}归档: {zip_filepath}, "
+                 f"变更 {len(changed)} 个文件, 删除 {len(deleted)} 个文件")
+    return [zip_filepath]
+
+def create_mysql_backup(sync_config):
+    """根据同步配置中的 mysql 部分创建 MySQLBackup"""
+    mysql_config = sync_config['mysql']
+    return MySQLBackup(
+        host=mysql_config.get('host', 'localhost'),
+        user=mysql_config.get('user', 'root'),
+        password=mysql_config.get('password', ''),
+        port=mysql_config.get('port', 3306),
+        batch_rows=mysql_config.get('batch_rows', 1000),
+        max_statement_rows=mysql_config.get('max_statement_rows', 1000),
+        max_statement_bytes=int(mysql_config.get('max_statement_kb', 1024) * 1024),
+        workers=mysql_config.get('workers', 1),
+        split_rows=mysql_config.get('split_rows', 1000000)
+    )
+
+def handle_mysql_backup(client, db_manager, sync_config):
+    """
+    备份MySQL数据库：每个表的导出经 gzip 压缩后直接流式上传，不在本地落盘
+
+    每个数据库每次备份上传到 remote_directory 下的一个目录，该目录作为一条记录写入数据库，
+    与普通文件一样按 remote_save_day 清理。开启 mysql.incremental 时，表签名没有变化的表不导出，
+    备份目录中的 manifest.json 指向包含该表数据的上一次备份目录；每隔 full_archive_days 天做一次完整备份
+    """
+    mysql_config = sync_config['mysql']
+    backup = create_mysql_backup(sync_config)
+    databases = mysql_config.get('databases') or backup.get_user_databases()
+    tag = mysql_config.get('tag')
+    compress_level = sync_config.get('zip_compress_level', -1)
+    buffer_mb = sync_config.get('stream_buffer_mb', 8)
+    incremental = mysql_config.get('incremental', False)
+    change_detection = mysql_config.get('change_detection', 'checksum')
+    full_backup_days = sync_config.get('full_archive_days', 7)
+
+    backup_dirs = []
+    for database_name in databases:
+        timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
+        dir_name = f"{tag}_{database_name}_{timestamp}" if tag else f"{database_name}_{timestamp}"
+        backup_dir = os.path.join(sync_config['remote_directory'], dir_name).replace('\\', '/')
+        sizes = []
+
+        # 上次备份的表签名以及包含各表数据的备份目录，和其他同步状态一起保存在数据库中
+        state_key = f"mysql_tables:{backup.host}:{backup.port}/{database_name}"
+        state = json.loads(db_manager.get_state(state_key) or '{}')
+        previous_tables = state.get('tables', {})
+        need_full = (
+            not incremental
+            or 'full_time' not in state
+            or datetime.now() - datetime.fromisoformat(state['full_time']) >= timedelta(days=full_backup_days)
+        )
+        # 完整备份时传入空签名，仍然计算本次签名供下次比较
+        previous_signatures = None
+        if incremental:
+            previous_signatures = {} if need_full else {
+                table_name: info['signature'] for table_name, info in previous_tables.items()
+            }
+
+        def write_output(file_name, write_func):
+            results = []
+
+            def write_gzip(fileobj):
+                gzip_file = gzip.GzipFile(filename=file_name, mode='wb', compresslevel=compress_level, fileobj=fileobj)
+                with io.TextIOWrapper(gzip_file, encoding='utf8') as f:
+                    results.append(write_func(f))
+
+            pipe = stream_upload(client, f"{backup_dir}/{file_name}.gz", write_gzip,
+                                 chunk_size=1024 * 1024, max_chunks=buffer_mb)
+            sizes.append(pipe.size)
+            return results[0]
+
         try:
-            remote_path = client.sync_file(file_path, sync_config['remote_directory'])
-            db_manager.add_file(file_path, remote_path)
-            db_manager.update_file_sync_status(file_path, True)
-            logging.info(f"成功同步文件: {file_path}")
-            success_count += 1
+            client.make_remote_directory(backup_dir)
+            result = backup.dump_database(database_name, write_output, previous_signatures, change_detection)
+
+            tables = {}
+            for table_name, file_names in result['files'].items():
+                tables[table_name] = {'signature': result['signatures'].get(table_name),
+                                      'backup': dir_name, 'files': file_names}
+            for table_name in result['skipped']:
+                tables[table_name] = previous_tables[table_name]
+            # 还原时按 manifest 从各表所在的备份目录取数据文件
+            manifest = {
+                'database': database_name,
+                'type': 'full' if need_full else 'incremental',
+                'created': timestamp,
+                'tables': {table_name: {'backup': info['backup'], 'files': [f"{name}.gz" for name in info['files']]}
+                           for table_name, info in tables.items()}
+            }
+            manifest_data = json.dumps(manifest, ensure_ascii=False, indent=2).encode('utf-8')
+            client.upload_bytes(manifest_data, f"{backup_dir}/manifest.json")
+            sizes.append(len(manifest_data))
         except Exception as e:
-            logging.error(f"同步文件失败: {file_path}, 错误: {str(e)}")
+            logging.error(f"备份数据库失败: {database_name}, 错误: {str(e)}")
+            # 不保留不完整的备份
+            client.delete_remote_file(backup_dir, True)
+            continue
+
+        db_manager.add_file(backup_dir, backup_dir, sum(sizes), None, None)
+        db_manager.update_file_sync_status(backup_dir, True)
+        # 沿用的表数据所在的备份目录，在本次备份过期前不能清理
+        referenced_dirs = {info['backup'] for info in tables.values() if info['backup'] != dir_name}
+        if referenced_dirs:
+            db_manager.add_backup_references(backup_dir, [
+                os.path.join(sync_config['remote_directory'], name).replace('\\', '/') for name in referenced_dirs
+            ])
+        if incremental:
+            db_manager.set_state(state_key, json.dumps({
+                'full_time': datetime.now().isoformat() if need_full else state['full_time'],
+                'tables': tables
+            }))
+        backup_dirs.append(backup_dir)
+        logging.info(f"成功备份数据库: {database_name} -> {backup_dir}, {result['rows']} 行, "
+                     f"跳过 {len(result['skipped'])} 个未变化的表, 压缩后 {sum(sizes)} 字节")
+    return backup_dirs
+
+def create_dedup_store(client, db_manager, sync_config):
+    """根据同步配置创建去重备份存储，数据块和快照都放在 remote_directory 下"""
+    return DedupStore(
+        client, db_manager, sync_config['remote_directory'],
+        avg_chunk_size=int(sync_config.get('dedup_chunk_kb', 1024) * 1024),
+        workers=sync_config.get('upload_workers', 4),
+        compress_level=sync_config.get('zip_compress_level', -1)
+    )
+
+def sync_files(client, db_manager, file_list, sync_config, stage=None):
+    """
+    同步本地文件到远程，只上传新增或内容发生变化的文件
+
+    file_list 可以是生成器：每取到一批文件就查询一次同步状态，需要上传的文件立即交给上传线程池，
+    扫描和上传同时进行，不需要先得到完整的文件列表。
+    需要上传的文件记录在数据库的上传队列中，进程重启后由 resume_pending_uploads 继续上传；
+    多次失败的文件按 upload_retry_backoff 指数退避，没到重试时间的文件本次跳过
+
+    :param file_list: 本地文件路径或 FileRecord 的可迭代对象
+    :param stage: 可选的 StageStats，记录上传的文件数、字节数、重试和错误
+    """
+    # 只保存需要上传的文件的信息
+    file_stats = {}
+    file_hashes = {}
+    skip_existing_remote = sync_config.get('skip_existing_remote', False)
+    query_batch_size = sync_config.get('db_batch_size', 100)
+    backoff = sync_config.get('upload_retry_backoff', 2)
+    max_backoff = sync_config.get('upload_queue_max_backoff', 3600)
+    sync_name = get_sync_name(sync_config)
+    run_id = datetime.now().strftime(TIMESTAMP_FORMAT)
+    db_manager.clear_done_uploads(sync_name)
+
+    def iter_batches():
+        batch = []
+        for item in file_list:
+            batch.append(item)
+            if len(batch) >= query_batch_size:
+                yield batch
+                batch = []
+        if batch:
+            yield batch
+
+    def iter_unsynced_files():
+        existing_count = 0
+        for batch in iter_batches():
+            unchanged_stats = []
+            existing_records = []
+            uploads = []
+            batch_paths = [item.path if isinstance(item, FileRecord) else item for item in batch]
+            # 一次查询一批文件的同步状态和上传队列状态
+            files_info = db_manager.get_files_info(batch_paths)
+            queue_items = db_manager.get_upload_queue_items(sync_name, batch_paths)
+            for item in batch:
+                if isinstance(item, FileRecord):
+                    # 遍历时已经获取了大小和修改时间
+                    file_path, file_stat = item.path, (item.size, item.mtime)
+                else:
+                    file_path = item
+                    try:
+                        stat = os.stat(file_path)
+                    except OSError as e:
+                        logging.warning(f"无法获取文件信息，跳过: {file_path}, 错误: {str(e)}")
+                        continue
+                    file_stat = (stat.st_size, stat.st_mtime)
+
+                file_info = files_info.get(file_path)
+                if file_info is None and skip_existing_remote:
+                    # 数据库中没有记录，但远程已有同名同大小的文件（例如数据库丢失后重建），直接记录为已同步
+                    remote_path = os.path.join(sync_config['remote_directory'], os.path.basename(file_path)).replace('\\', '/')
+                    remote_info = client.get_remote_file_info(remote_path)
+                    if remote_info and not remote_info['is_dir'] and remote_info['size'] == file_stat[0]:
+                        # 同时记录内容哈希作为之后判断内容变化的基准；没有哈希的记录会被当作旧版本记录，修改后不会重新上传
+                        try:
+                            content_hash = compute_file_hash(file_path)
+                        except OSError as e:
+                            logging.warning(f"无法计算文件哈希，按新文件上传: {file_path}, 错误: {str(e)}")
+                        else:
+                            existing_records.append((file_path, remote_path, file_stat[0], file_stat[1], content_hash))
+                            continue
+                if file_info is None or not file_info["sync_success"]:
+                    file_stats[file_path] = file_stat
+                    uploads.append(file_path)
+                    continue
+
+                # 大小和修改时间都没变，视为未修改
+                if (file_info['file_size'], file_info['file_mtime']) == file_stat:
+                    continue
+
+                # 只有大小或修改时间变化时才计算内容哈希
+                content_hash = compute_file_hash(file_path)
+                if file_info['content_hash'] is None or file_info['content_hash'] == content_hash:
+                    # 旧版本记录没有哈希，以当前内容作为基准，不重复上传
+                    unchanged_stats.append((file_path, file_stat[0], file_stat[1], content_hash))
+                    continue
+
+                logging.info(f"文件内容已变化，重新同步: {file_path}")
+                file_hashes[file_path] = content_hash
+                file_stats[file_path] = file_stat
+                uploads.append(file_path)
+
+            if unchanged_stats:
+                db_manager.update_files_stat(unchanged_stats)
+            if existing_records:
+                db_manager.add_files(existing_records)
+                existing_count += len(existing_records)
+
+            now = datetime.now()
+            deferred = set()
+            for file_path in uploads:
+                queue_item = queue_items.get(file_path)
+                if queue_item and queue_item['status'] == 'failed' and \
+                        datetime.fromisoformat(str(queue_item['next_attempt'])) > now:
+                    deferred.add(file_path)
+                    file_stats.pop(file_path, None)
+                    file_hashes.pop(file_path, None)
+            if deferred:
+                logging.info(f"{len(deferred)} 个文件上传失败后尚未到重试时间，本次跳过")
+            uploads = [file_path for file_path in uploads if file_path not in deferred]
+            # 队列中已经不需要上传的文件（已同步、已删除等）移出队列
+            settled = [file_path for file_path in queue_items if file_path not in deferred and file_path not in uploads]
+            if settled:
+                db_manager.remove_upload_items(sync_name, settled)
+            if uploads:
+                db_manager.plan_uploads(sync_name, run_id, uploads)
+            yield from uploads
+        if existing_count:
+            logging.info(f"远程已存在 {existing_count} 个同名同大小的文件，跳过上传")
+
+    # 已提交给上传线程池、尚未记录为 in_flight 的文件，攒够一批后在一个事务中更新
+    submitted = []
+
+    def flush_submitted():
+        if submitted:
+            db_manager.start_uploads(sync_name, submitted)
+            submitted.clear()
+
+    def on_submit(file_path):
+        submitted.append(file_path)
+        if len(submitted) >= query_batch_size:
+            flush_submitted()
+
+    def save_records(records):
+        flush_submitted()
+        db_manager.add_files(records)
+        db_manager.complete_uploads(sync_name, [record[0] for record in records])
+        if sync_config.get('local_zip', False):
+            # 上传的是压缩文件时同时更新压缩文件目录中的上传状态
+            db_manager.mark_archives_uploaded([record[0] for record in records])
+
+    def on_retry(file_path):
+        db_manager.record_upload_retry(sync_name, file_path)
+        if stage:
+            stage.add(retries=1)
+
+    success_count = 0
+    batch_size = sync_config.get('db_batch_size', 100)
+    pending_records = []
+    results = upload_files(
+        client,
+        iter_unsynced_files(),
+        sync_config['remote_directory'],
+        max_workers=sync_config.get('upload_workers', 4),
+        retries=sync_config.get('upload_retries', 3),
+        backoff=sync_config.get('upload_retry_backoff', 2),
+        db_manager=db_manager,
+        on_retry=on_retry,
+        on_submit=on_submit
+    )
+    for file_path, remote_path, error in results:
+        if error is not None:
+            logging.error(f"同步文件失败: {file_path}, 错误: {str(error)}")
+            file_stats.pop(file_path, None)
+            file_hashes.pop(file_path, None)
+            queue_item = db_manager.get_upload_queue_items(sync_name, [file_path]).get(file_path)
+            delay = min(backoff * 2 ** (queue_item['attempts'] if queue_item else 0), max_backoff)
+            db_manager.fail_upload(sync_name, file_path, str(error), datetime.now() + timedelta(seconds=delay))
+            if stage:
+                stage.add(errors=1)
+            continue
+        file_size, file_mtime = file_stats.pop(file_path)
+        if stage:
+            stage.add(files=1, bytes=file_size)
+        # 优先使用上传时计算的校验和，不需要再读取一遍文件
+        content_hash = client.pop_upload_checksum(file_path) or file_hashes.pop(file_path, None) \
+            or compute_file_hash(file_path)
+        file_hashes.pop(file_path, None)
+        pending_records.append((file_path, remote_path, file_size, file_mtime, content_hash))
+        logging.info(f"成功同步文件: {file_path}")
+        success_count += 1
+        # 成功记录攒够一批后在一个事务中写入
+        if len(pending_records) >= batch_size:
+            save_records(pending_records)
+            pending_records = []
+
+    if pending_records:
+        save_records(pending_records)
+    flush_submitted()
     
     logging.info(f"本次任务共成功同步 {success_count} 个文件")
     return success_count
 
+def get_retained_archive_chains(db_manager, sync_dir, cutoff, time_key):
+    """
+    获取因归档链仍在使用而不能删除的压缩文件名
+
+    增量归档只记录相对上一个归档的变化，还原时需要它的完整归档和之前的所有增量归档，
+    因此链中还有未过期的增量归档时，整条链（完整归档和全部增量归档）都保留
+
+    :param time_key: 判断增量归档是否过期使用的时间，本地清理为 create_time，远程清理为 upload_time
+    :return: 压缩文件名集合
+    """
+    archives = db_manager.get_archive_chains(sync_dir)
+    live_chains = set()
+    for archive in archives:
+        archive_time = archive[time_key]
+        # 时间为空（例如尚未上传）的增量归档之后仍会用到，视为未过期
+        if archive['archive_type'] == 'delta' and \
+                (archive_time is None or datetime.fromisoformat(str(archive_time)) > cutoff):
+            live_chains.add(archive['base_archive'])
+    retained = set()
+    for archive in archives:
+        name = os.path.basename(archive['archive_path'])
+        chain = archive['base_archive'] if archive['archive_type'] == 'delta' else name
+        if chain in live_chains:
+            retained.add(name)
+    return retained
+
 def clean_remote_expired_files(client, db_manager, sync_config):
-    """清理远程过期文件"""
-    remote_files = client.list_remote_directory(sync_config['remote_directory'])
+    """
+    清理远程过期文件，根据数据库中的同步时间确定过期文件并发删除
+
+    增量压缩的归档链中还有未过期的增量归档时，链中过期的完整归档和增量归档暂不删除；
+    增量数据库备份沿用的表数据所在的备份目录，在引用它的备份过期前也不删除
+    """
+    remote_directory = sync_config['remote_directory']
     remote_save_days = sync_config['remote_save_day']
-    current_time = time.time()
+    cutoff = datetime.now() - timedelta(days=remote_save_days)
+
+    expired_files = db_manager.get_expired_remote_files(remote_directory, cutoff)
+    if expired_files and sync_config.get('incremental_zip', False):
+        retained = get_retained_archive_chains(db_manager, sync_config['local_sync_directory'], cutoff, 'upload_time')
+        kept = {remote_path for remote_path in expired_files if os.path.basename(remote_path) in retained}
+        if kept:
+            logging.info(f"{len(kept)} 个过期归档仍被未过期的增量归档依赖，暂不删除")
+            expired_files = [remote_path for remote_path in expired_files if remote_path not in kept]
+    if expired_files and sync_config.get('type') == 'mysql':
+        kept = db_manager.get_referenced_backups(expired_files, cutoff)
+        if kept:
+            logging.info(f"{len(kept)} 个过期备份目录仍被未过期的增量备份引用，暂不删除")
+            expired_files = [remote_path for remote_path in expired_files if remote_path not in kept]
+    deleted_count = 0
+    if expired_files:
+        batch_size = sync_config.get('db_batch_size', 100)
+        deleted_paths = []
+        with ThreadPoolExecutor(max_workers=max(1, sync_config.get('delete_workers', 4))) as executor:
+            futures = {
+                executor.submit(client.delete_remote_file, remote_path, True): remote_path
+                for remote_path in expired_files
+            }
+            for future in as_completed(futures):
+                remote_path = futures[future]
+                if not future.result():
+                    logging.error(f"删除过期远程文件失败: {remote_path}")
+                    continue
+                logging.info(f"已删除过期远程文件: {remote_path}")
+                deleted_paths.append(remote_path)
+                deleted_count += 1
+                if len(deleted_paths) >= batch_size:
+                    db_manager.mark_remote_deleted_batch(deleted_paths)
+                    deleted_paths = []
+        if deleted_paths:
+            db_manager.mark_remote_deleted_batch(deleted_paths)
+        logging.info(f"共删除 {deleted_count} 个过期远程文件")
+
+    reconcile_remote_directory(client, db_manager, sync_config)
+    return deleted_count
+
+def reconcile_remote_directory(client, db_manager, sync_config):
+    """
+    定期对账：列出远程目录，找出数据库中没有记录或已标记删除但仍存在的文件
+
+    已标记删除但仍存在的会再次删除，数据库中没有记录的只记录日志
+    """
+    remote_directory = sync_config['remote_directory']
+    reconcile_days = sync_config.get('remote_reconcile_days', 7)
+    state_key = f"last_reconcile:{remote_directory}"
+    last_reconcile = db_manager.get_state(state_key)
+    if last_reconcile and datetime.now() - datetime.fromisoformat(last_reconcile) < timedelta(days=reconcile_days):
+        return
 
-    for remote_file in remote_files:
-        remote_path = os.path.join(sync_config['remote_directory'], remote_file).replace('\\', '/')
+    logging.info(f"开始远程目录对账: {remote_directory}")
+    remote_files = client.list_remote_directory(remote_directory, refresh=True)
+    remote_paths = [
+        # 分块目录在列表中带有结尾的斜杠
+        os.path.join(remote_directory, remote_file.rstrip('/')).replace('\\', '/')
+        for remote_file in remote_files
+    ]
+    orphan_count = 0
+    for remote_path in remote_paths:
         file_info = db_manager.get_file_info(remote_path)
-        if file_info:
-            sync_time = datetime.fromisoformat(file_info['sync_time']).timestamp()
-            if current_time - sync_time > remote_save_days * 24 * 3600:
-                try:
-                    client.delete_remote_file(remote_path)
-                    db_manager.mark_remote_deleted(remote_path)
-                    logging.info(f"已删除过期远程文件: {remote_path}")
-                except Exception as e:
-                    logging.error(f"删除过期远程文件失败: {remote_path}, 错误: {str(e)}")
-
-def create_task_function(client, db_config, sync_config):
-    """为每个配置创建独立的任务函数"""
+        if file_info is None:
+            orphan_count += 1
+            logging.warning(f"远程文件在数据库中没有记录: {remote_path}")
+        elif file_info['remote_deleted']:
+            if client.delete_remote_file(remote_path, True):
+                logging.info(f"已删除对账发现的残留远程文件: {remote_path}")
+    db_manager.set_state(state_key, datetime.now().isoformat())
+    logging.info(f"远程目录对账完成: {remote_directory}, 共 {len(remote_paths)} 项, 无记录 {orphan_count} 项")
+
+def count_records(records, stage):
+    """
+    逐个转发 FileRecord，同时把文件数、字节数和取得每个文件的耗时累加到 stage
+
+    只计入遍历、检测文件本身的时间，不包括调用方处理文件（上传）的时间
+    """
+    iterator = iter(records)
+    while True:
+        start = time.monotonic()
+        try:
+            record = next(iterator)
+        except StopIteration:
+            stage.add(seconds=time.monotonic() - start)
+            return
+        except Exception:
+            stage.add(seconds=time.monotonic() - start, errors=1)
+            raise
+        stage.add(files=1, bytes=record.size, seconds=time.monotonic() - start)
+        yield record
+
+def create_task_function(client, db_config, sync_config, metrics=None, coordinator=None):
+    """
+    为每个配置创建独立的任务函数，每个阶段的耗时和处理量记录到 metrics
+
+    coordinator 保证同一个任务不会重叠执行，并限制所有任务同时进行的压缩数
+    """
+    sync_name = get_sync_name(sync_config)
+    metrics = metrics or SyncMetrics()
+    coordinator = coordinator or JobCoordinator()
+
     def task():
+        if not coordinator.try_start(sync_name):
+            logging.warning(f"上一次任务仍在运行，跳过本次执行: {sync_name}")
+            return
         try:
-            logging.info(f"开始执行任务: {sync_config['local_origin_directory']}")
-            
-            # 在任务线程中创建新的数据库连接
-            db_manager = DatabaseManager(db_config)
-            
-            # 执行任务：压缩本地文件
-            file_list = handle_local_zip(client, sync_config)
-            
-            # 执行任务：同步文件
-            sync_files(client, db_manager, file_list, sync_config)
-            
-            # 执行任务：删除本地过期文件
-            clean_local_expired_files(sync_config)
-            
-            # 执行任务：删除远端过期文件
-            clean_remote_expired_files(client, db_manager, sync_config)
-            
-            logging.info(f"完成同步配置: {sync_config['local_origin_directory']}")
+            with metrics.run(sync_name) as run:
+                logging.info(f"开始执行任务: {sync_name}")
+                
+                # 在任务线程中创建新的数据库连接
+                db_manager = DatabaseManager(db_config)
+
+                if sync_config.get('type') == 'mysql':
+                    # 执行任务：备份数据库并流式上传，然后删除远端过期备份
+                    with coordinator.zip_slot(sync_name), run.stage('mysql_backup') as stage:
+                        backup_dirs = handle_mysql_backup(client, db_manager, sync_config)
+                        stage.add(files=len(backup_dirs))
+                    with run.stage('remote_cleanup') as stage:
+                        stage.add(files=clean_remote_expired_files(client, db_manager, sync_config))
+                    logging.info(f"完成同步配置: {sync_name}")
+                    return
+
+                if sync_config.get('dedup', False):
+                    # 执行任务：创建去重快照，然后删除过期快照和不再被引用的数据块
+                    store = create_dedup_store(client, db_manager, sync_config)
+                    with coordinator.zip_slot(sync_name), run.stage('dedup_backup') as stage:
+                        result = store.backup(sync_config['local_origin_directory'], PathFilter.from_config(sync_config))
+                        stage.add(files=result['files'], bytes=result['uploaded_size'])
+                    with run.stage('remote_cleanup') as stage:
+                        cutoff = datetime.now() - timedelta(days=sync_config['remote_save_day'])
+                        snapshot_count, chunk_count = store.prune(cutoff, sync_config.get('delete_workers', 4))
+                        stage.add(files=snapshot_count + chunk_count)
+                    logging.info(f"完成同步配置: {sync_name}")
+                    return
+                
+                # 执行任务：压缩本地文件
+                if sync_config.get('local_zip', False):
+                    with coordinator.zip_slot(sync_name), run.stage('zip') as stage:
+                        file_list = handle_local_zip(client, sync_config, db_manager)
+                        stage.add(files=len(file_list))
+                else:
+                    # 边扫描边上传，扫描在 upload 阶段内进行，scan 阶段只累加遍历和检测文件本身的耗时
+                    file_list = count_records(handle_local_zip(client, sync_config, db_manager),
+                                              run.stage_stats('scan'))
+                
+                # 执行任务：同步文件
+                with run.stage('upload') as stage:
+                    sync_files(client, db_manager, file_list, sync_config, stage)
+                
+                # 执行任务：删除本地过期文件
+                with run.stage('local_cleanup') as stage:
+                    stage.add(files=clean_local_expired_files(db_manager, sync_config))
+                
+                # 执行任务：删除远端过期文件
+                with run.stage('remote_cleanup') as stage:
+                    stage.add(files=clean_remote_expired_files(client, db_manager, sync_config))
+                
+                logging.info(f"完成同步配置: {sync_name}")
         except Exception as e:
-            logging.error(f"处理同步配置时出错: {sync_config['local_origin_directory']}, 错误: {str(e)}")
+            logging.error(f"处理同步配置时出错: {sync_name}, 错误: {str(e)}")
+        finally:
+            coordinator.finish(sync_name)
     
     return task
 
-def clean_local_expired_files(sync_config):
-    """清理本地过期文件"""
+def resume_pending_uploads(client, db_config, sync_config, metrics=None, coordinator=None):
+    """
+    继续上一次进程退出前没有完成的上传
+
+    只处理上传队列中的文件，不重新扫描目录；与定时任务共用 coordinator，定时任务正在运行时跳过
+    """
+    sync_name = get_sync_name(sync_config)
+    metrics = metrics or SyncMetrics()
+    coordinator = coordinator or JobCoordinator()
+    if not coordinator.try_start(sync_name):
+        logging.info(f"任务正在运行，由本次任务处理未完成的上传: {sync_name}")
+        return
+    try:
+        with metrics.run(sync_name) as run:
+            db_manager = DatabaseManager(db_config)
+            file_list = db_manager.get_pending_uploads(sync_name)
+            logging.info(f"继续上次未完成的上传: {sync_name}, 共 {len(file_list)} 个文件")
+            with run.stage('upload') as stage:
+                sync_files(client, db_manager, file_list, sync_config, stage)
+    except Exception as e:
+        logging.error(f"继续未完成的上传时出错: {sync_name}, 错误: {str(e)}")
+    finally:
+        coordinator.finish(sync_name)
+
+def start_watch(client, db_config, sync_config):
+    """
+    启动实时监控模式：监听 local_sync_directory 的文件变化，静默一段时间后上传
+
+    与定时任务使用同一个数据库，已同步且未变化的文件不会重复上传
+    """
+    if sync_config.get('local_zip', False):
+        logging.warning(f"压缩模式不支持实时监控，已忽略 watch 配置: {sync_config['local_origin_directory']}")
+        return None
+
+    watch_dir = sync_config['local_sync_directory']
+    # 只在监控处理线程中使用
+    db_manager = DatabaseManager(db_config)
+    handler = SyncEventHandler(
+        client,
+        sync_config,
+        on_ready=lambda file_paths: sync_files(client, db_manager, file_paths, sync_config),
+        path_filter=PathFilter.from_config(sync_config)
+    )
+    observer = Observer()
+    observer.schedule(handler, watch_dir, recursive=True)
+    observer.start()
+    handler.start()
+    logging.info(f"已启动实时监控: {watch_dir}, 静默时间: {handler.quiet_seconds} 秒")
+    return observer, handler
+
+def import_local_archives(db_manager, sync_config):
+    """
+    把压缩文件目录建立之前创建的压缩文件登记到数据库，每个本地目录只执行一次
+
+    创建时间取自文件名中的时间戳，上传状态取自同步记录
+    """
+    local_dir = sync_config['local_sync_directory']
+    state_key = f"archive_catalog_imported:{local_dir}"
+    if db_manager.get_state(state_key):
+        return
+    records = list(walk_files(local_dir, PathFilter(include=['*.wdsync.zip'])))
+    files_info = db_manager.get_files_info(record.path for record in records)
+    known_archives = db_manager.get_archive_paths(local_dir)
+    imported = 0
+    for record in records:
+        # 文件名格式：folder_name_YYYY-MM-DD-HH-mm-SS.wdsync.zip
+        timestamp_str = os.path.basename(record.path).split('_')[-1].replace('.wdsync.zip', '')
+        try:
+            create_time = datetime.strptime(timestamp_str, TIMESTAMP_FORMAT)
+        except ValueError:
+            logging.debug(f"跳过文件名格式不符的文件: {record.path}")
+            continue
+        file_info = files_info.get(record.path)
+        if record.path in known_archives:
+            # 增量压缩等已经登记过的压缩文件只补充上传状态
+            if file_info and file_info['sync_success']:
+                db_manager.mark_archives_uploaded([record.path])
+            continue
+        db_manager.add_archive(sync_config.get('local_origin_directory'), record.path, 'zip',
+                               file_size=record.size, uploaded=bool(file_info and file_info['sync_success']),
+                               create_time=create_time, sync_directory=local_dir)
+        imported += 1
+    db_manager.set_state(state_key, datetime.now().isoformat())
+    logging.info(f"已登记本地目录中原有的 {imported} 个压缩文件: {local_dir}")
+
+def clean_local_expired_files(db_manager, sync_config):
+    """
+    清理本地过期的压缩文件，返回删除的文件数
+
+    过期文件从数据库的压缩文件目录中查询，不需要遍历本地目录；尚未上传的压缩文件，
+    以及仍被未过期的增量归档依赖的完整归档和增量归档不会被删除
+    """
     # 只在local_zip为true时执行清理
     if not sync_config.get('local_zip', False):
-        return
+        return 0
+
+    deleted_count = 0
 
     try:
         local_dir = sync_config['local_sync_directory']
         local_save_days = sync_config['local_save_day']
-        current_time = datetime.now()
 
         # 确保目录存在
         if not os.path.exists(local_dir):
             logging.warning(f"本地同步目录不存在: {local_dir}")
-            return
+            return 0
 
-        # 获取本地目录中的所有wdsync压缩文件
-        for root, _, files in os.walk(local_dir):
-            for file in files:
-                if not file.endswith('.wdsync.zip'):
+        import_local_archives(db_manager, sync_config)
+        # 与按天数取整的判断一致：超过 local_save_day 整天才删除
+        cutoff = datetime.now() - timedelta(days=local_save_days + 1)
+        retained = get_retained_archive_chains(db_manager, local_dir, cutoff, 'create_time')
+        for archive in db_manager.get_expired_archives(local_dir, cutoff):
+            file_path = archive['archive_path']
+            try:
+                if archive['upload_time'] is None:
+                    logging.warning(f"压缩文件尚未上传，跳过删除: {file_path}")
+                    continue
+                if os.path.basename(file_path) in retained:
+                    logging.info(f"压缩文件仍被未过期的增量归档依赖，暂不删除: {file_path}")
+                    continue
+                if not os.path.exists(file_path):
+                    db_manager.mark_archive_deleted(file_path)
                     continue
 
-                file_path = os.path.join(root, file)
-                
-                try:
-                    # 解析文件名���的时间戳
-                    # 文件名格式：folder_name_YYYY-MM-DD-HH-mm-SS.wdsync.zip
-                    timestamp_str = file.split('_')[-1].replace('.wdsync.zip', '')
-                    try:
-                        file_time = datetime.strptime(timestamp_str, '%Y-%m-%d-%H-%M-%S')
-                    except ValueError:
-                        # 如果无法解析时间戳，说明文件名格式不对，跳过
-                        logging.debug(f"跳过文件名格式不符的文件: {file_path}")
-                        continue
-
-                    # 计算文件是否过期
-                    days_old = (current_time - file_time).days
-                    if days_old > local_save_days:
-                        # 检查文件是否被锁定
-                        if not is_file_accessible(file_path):
-                            logging.warning(f"文件被占用，跳过删除: {file_path}")
-                            continue
+                # 检查文件是否被锁定
+                if not is_file_accessible(file_path):
+                    logging.warning(f"文件被占用，跳过删除: {file_path}")
+                    continue
 
-                        os.remove(file_path)
-                        logging.info(f"已删除过期本地压缩文件: {file_path}")
+                os.remove(file_path)
+                db_manager.mark_archive_deleted(file_path)
+                deleted_count += 1
+                logging.info(f"已删除过期本地压缩文件: {file_path}")
 
-                except Exception as e:
-                    logging.error(f"处理文件时出错: {file_path}, 错误: {str(e)}")
-                    continue
+            except Exception as e:
+                logging.error(f"处理文件时出错: {file_path}, 错误: {str(e)}")
+                continue
 
     except Exception as e:
         logging.error(f"清理本地过期文件时出错: {str(e)}")
+    return deleted_count
 
 def is_file_accessible(file_path):
     """检查文件是否可访问（未被锁定）"""
@@ -206,6 +894,13 @@ def is_file_accessible(file_path):
     except IOError:
         return False
 
+def get_sync_name(sync_config):
+    """同步配置的名称，用于日志和任务ID"""
+    if sync_config.get('type') == 'mysql':
+        mysql_config = sync_config['mysql']
+        return f"mysql://{mysql_config.get('host', 'localhost')}:{mysql_config.get('port', 3306)} -> {sync_config['remote_directory']}"
+    return sync_config.get('local_origin_directory') or sync_config['local_sync_directory']
+
 def create_safe_task_id(path):
     """创建基于路径哈希的安全任务ID"""
     # 使用 MD5（生成32位哈希）
@@ -226,25 +921,59 @@ def main():
     # 创建调度器
     scheduler = BackgroundScheduler()
     scheduler.start()
+
+    # 任务指标：滚动统计文件，配置了端口时同时提供 Prometheus 接口
+    metrics = SyncMetrics.from_config(client.config)
+    # 防止任务重叠执行，并限制同时进行的压缩数
+    coordinator = JobCoordinator.from_config(client.config)
     
+    # 为开启实时监控的同步配置启动监控
+    watchers = []
+    for sync_config in client.config['Sync']:
+        if sync_config.get('watch', False):
+            watcher = start_watch(client, 'data/synced_files.db', sync_config)
+            if watcher:
+                watchers.append(watcher)
+
     # 为每个同步配置创建独立的定时任务
+    db_manager = DatabaseManager('data/synced_files.db')
     for sync_config in client.config['Sync']:
-        task_func = create_task_function(client, 'data/synced_files.db', sync_config)
+        task_func = create_task_function(client, 'data/synced_files.db', sync_config, metrics, coordinator)
+        # 同步配置单独的带宽限制，只作用于上传到该远程目录的文件
+        limiter = BandwidthLimiter.from_config(sync_config.get('bandwidth_limits'))
+        if limiter:
+            client.set_directory_bandwidth(sync_config['remote_directory'], limiter)
         
         # 从配置中获取cron表达式
         cron_expression = sync_config['schedule']
         
         # 添加任务到调度器
-        task_id = create_safe_task_id(sync_config['local_origin_directory'])
-        logging.info(f"任务ID映射: {task_id} -> {sync_config['local_origin_directory']}")
+        sync_name = get_sync_name(sync_config)
+        task_id = create_safe_task_id(sync_name)
+        logging.info(f"任务ID映射: {task_id} -> {sync_name}")
         scheduler.add_job(
             task_func,
             CronTrigger.from_crontab(cron_expression),
             id=task_id,
-            replace_existing=True
+            replace_existing=True,
+            # 错过的多次触发只补执行一次
+            max_instances=1,
+            coalesce=True
         )
+        metrics.set_next_run_provider(sync_name, lambda task_id=task_id: scheduler.get_job(task_id).next_run_time)
+
+        # 上次进程退出时还有未完成的上传，立即继续，不等待下一次调度
+        if sync_config.get('type') != 'mysql' and not sync_config.get('dedup', False) \
+                and db_manager.get_pending_uploads(sync_name):
+            scheduler.add_job(
+                resume_pending_uploads,
+                args=[client, 'data/synced_files.db', sync_config, metrics, coordinator],
+                id=f"{task_id}_resume",
+                replace_existing=True
+            )
+            logging.info(f"已安排继续未完成的上传: {sync_name}")
         
-        logging.info(f"已设置定时任务: {sync_config['local_origin_directory']}, 调度: {cron_expression}")
+        logging.info(f"已设置定时任务: {sync_name}, 调度: {cron_expression}")
     
     try:
         # 保持主线程运行
@@ -252,7 +981,12 @@ def main():
             time.sleep(1)
     except KeyboardInterrupt:
         logging.info("程序被用户中断")
+        for observer, handler in watchers:
+            observer.stop()
+            observer.join()
+            handler.stop()
         scheduler.shutdown()
+        metrics.stop()
     finally:
         logging.info("程序结束")
 
@@ -0,0 +1,48 @@
+import io
+import os
+import shutil
+import tempfile
+import unittest
+import zipfile
+
+from utils.zip_handler import _NonSeekableWriter, predeflated_supported, write_files_parallel
+
+
+class WriteFilesParallelTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.files = {}
+        for name, size in (('empty.txt', 0), ('small.txt', 1000), ('large.bin', 3 * 1024 * 1024 + 17)):
+            data = (os.urandom(256) + b'compressible ' * 64) * (size // 1088 + 1)
+            data = data[:size]
+            with open(os.path.join(self.directory, name), 'wb') as f:
+                f.write(data)
+            self.files[name] = data
+
+    def tearDown(self):
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    def round_trip(self, seekable):
+        buffer = io.BytesIO()
+        output = buffer if seekable else _NonSeekableWriter(buffer)
+        files = [(os.path.join(self.directory, name), name) for name in sorted(self.files)]
+        with zipfile.ZipFile(output, 'w', zipfile.ZIP_DEFLATED) as zipf:
+            skipped = write_files_parallel(zipf, files, workers=4, block_size=256 * 1024)
+        self.assertEqual(skipped, [])
+        with zipfile.ZipFile(io.BytesIO(buffer.getvalue())) as zipf:
+            self.assertIsNone(zipf.testzip())
+            for name, data in self.files.items():
+                self.assertEqual(zipf.read(name), data)
+
+    def test_predeflated_supported(self):
+        self.assertTrue(predeflated_supported())
+
+    def test_seekable_output(self):
+        self.round_trip(seekable=True)
+
+    def test_non_seekable_output(self):
+        self.round_trip(seekable=False)
+
+
+if __name__ == '__main__':
+    unittest.main()
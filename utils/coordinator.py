@@ -0,0 +1,154 @@
+import time
+import logging
+import threading
+from contextlib import contextmanager
+from datetime import datetime
+
+class TokenBucket:
+    """
+    令牌桶限速器，多个线程共享
+
+    每次消耗先扣除令牌（允许欠账），再按欠账的多少等待，大块数据也能平滑限速
+    """
+    def __init__(self, rate, burst_seconds=1):
+        """
+        :param rate: 每秒允许的字节数
+        :param burst_seconds: 桶的容量，以秒为单位，允许的突发量为 rate * burst_seconds
+        """
+        self.rate = rate
+        self.burst_seconds = burst_seconds
+        self.tokens = rate * burst_seconds
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def set_rate(self, rate):
+        with self.lock:
+            if rate != self.rate:
+                self.rate = rate
+                self.tokens = min(self.tokens, rate * self.burst_seconds)
+
+    def consume(self, amount):
+        """消耗 amount 个令牌，令牌不足时阻塞等待"""
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.rate * self.burst_seconds, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= amount
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0
+        if wait > 0:
+            time.sleep(wait)
+
+def _parse_clock(value):
+    hour, minute = value.split(':')
+    return int(hour) * 60 + int(minute)
+
+class BandwidthLimiter:
+    """
+    按时间段设置的带宽限制
+
+    时间段配置示例：[{"start": "08:00", "end": "20:00", "rate_kb": 2048}]，
+    start 大于 end 时表示跨过午夜；不在任何时间段内或 rate_kb 为0时不限速
+    """
+    def __init__(self, windows):
+        self.windows = [
+            (_parse_clock(window['start']), _parse_clock(window['end']), int(window.get('rate_kb', 0) * 1024))
+            for window in windows
+        ]
+        self.bucket = None
+        self.lock = threading.Lock()
+
+    @classmethod
+    def from_config(cls, windows):
+        """没有配置时返回None"""
+        return cls(windows) if windows else None
+
+    def current_rate(self, now=None):
+        """当前时间段的限速（字节/秒），0 表示不限速"""
+        now = now or datetime.now()
+        minute = now.hour * 60 + now.minute
+        for start, end, rate in self.windows:
+            in_window = start <= minute < end if start <= end else (minute >= start or minute < end)
+            if in_window:
+                return rate
+        return 0
+
+    def consume(self, amount):
+        rate = self.current_rate()
+        if not rate:
+            return
+        with self.lock:
+            if self.bucket is None:
+                self.bucket = TokenBucket(rate)
+            bucket = self.bucket
+        bucket.set_rate(rate)
+        bucket.consume(amount)
+
+class ThrottledReader:
+    """
+    按带宽限制读取文件的包装对象
+
+    提供 __len__，requests 会据此设置 Content-Length，并分块调用 read() 发送
+    """
+    def __init__(self, fileobj, size, limiters, block_size=64 * 1024):
+        self.fileobj = fileobj
+        self.size = size
+        self.limiters = limiters
+        self.block_size = block_size
+
+    def __len__(self):
+        return self.size
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            size = self.block_size
+        data = self.fileobj.read(min(size, self.block_size))
+        for limiter in self.limiters:
+            limiter.consume(len(data))
+        return data
+
+    def __iter__(self):
+        while True:
+            data = self.read(self.block_size)
+            if not data:
+                return
+            yield data
+
+class JobCoordinator:
+    """
+    协调所有同步任务
+
+    同一个任务上一次还没有结束时跳过本次执行；限制同时进行的压缩（包括数据库导出）的数量。
+    同时上传的文件数由 WebDAVSyncClient 的 max_concurrent_uploads 统一限制
+    """
+    def __init__(self, max_concurrent_zips=1):
+        self.zip_semaphore = threading.BoundedSemaphore(max(1, max_concurrent_zips))
+        self.running = set()
+        self.lock = threading.Lock()
+
+    @classmethod
+    def from_config(cls, config):
+        scheduler_config = config.get('Scheduler', {})
+        return cls(scheduler_config.get('max_concurrent_zips', 1))
+
+    def try_start(self, job_name):
+        """开始一个任务，任务已经在运行时返回 False"""
+        with self.lock:
+            if job_name in self.running:
+                return False
+            self.running.add(job_name)
+            return True
+
+    def finish(self, job_name):
+        with self.lock:
+            self.running.discard(job_name)
+
+    @contextmanager
+    def zip_slot(self, job_name):
+        """占用一个压缩名额，名额用完时等待"""
+        if not self.zip_semaphore.acquire(blocking=False):
+            logging.info(f"等待其他任务完成压缩: {job_name}")
+            self.zip_semaphore.acquire()
+        try:
+            yield
+        finally:
+            self.zip_semaphore.release()
@@ -1,7 +1,29 @@
 import sqlite3
 import os
+import threading
 from datetime import datetime
 
+# 批量查询时每条 SQL 中 IN 参数的最大个数，低于 SQLite 的默认变量上限
+QUERY_BATCH_SIZE = 500
+
+SYNCED_FILE_COLUMNS = '''
+    id, file_path, remote_path, sync_time, sync_success, remote_deleted,
+    file_size, file_mtime, content_hash
+'''
+
+def _row_to_file_info(row):
+    return {
+        'id': row[0],
+        'file_path': row[1],
+        'remote_path': row[2],
+        'sync_time': row[3],
+        'sync_success': row[4],
+        'remote_deleted': row[5],
+        'file_size': row[6],
+        'file_mtime': row[7],
+        'content_hash': row[8]
+    }
+
 class DatabaseManager:
     def __init__(self, db_file='synced_files.db'):
         # 确保数据库文件所在的目录存在
@@ -12,12 +34,18 @@ class DatabaseManager:
         self.db_file = db_file
         self.conn = None
         self.cursor = None
+        # 上传线程池中的线程也会写入上传进度，所有数据库操作共用一把锁
+        self.lock = threading.RLock()
         self.initialize_db()
 
     def initialize_db(self):
         # 连接到数据库文件，如果不存在会自动创建
-        self.conn = sqlite3.connect(self.db_file)
+        self.conn = sqlite3.connect(self.db_file, check_same_thread=False, timeout=30)
         self.cursor = self.conn.cursor()
+
+        # WAL 模式下读写互不阻塞，多个定时任务线程可以同时使用各自的连接
+        self.cursor.execute('PRAGMA journal_mode=WAL')
+        self.cursor.execute('PRAGMA synchronous=NORMAL')
         
         # 创建表（如果不存在）
         self.cursor.execute('''
@@ -27,65 +55,708 @@ class DatabaseManager:
                 remote_path TEXT,
                 sync_time TIMESTAMP,
                 sync_success BOOLEAN DEFAULT 0,
-                remote_deleted BOOLEAN DEFAULT 0
+                remote_deleted BOOLEAN DEFAULT 0,
+                file_size INTEGER,
+                file_mtime REAL,
+                content_hash TEXT
             )
         ''')
-        self.conn.commit()
 
-    def add_file(self, local_path, remote_path):
-        """添加或更新文件记录"""
+        # 旧版本数据库没有文件大小、修改时间和内容哈希列，补充上
+        self.cursor.execute('PRAGMA table_info(synced_files)')
+        columns = {row[1] for row in self.cursor.fetchall()}
+        for column, column_type in (('file_size', 'INTEGER'), ('file_mtime', 'REAL'), ('content_hash', 'TEXT')):
+            if column not in columns:
+                self.cursor.execute(f'ALTER TABLE synced_files ADD COLUMN {column} {column_type}')
+
+        # get_file_info、mark_remote_deleted 等都会按 remote_path 查询
+        self.cursor.execute('CREATE INDEX IF NOT EXISTS idx_synced_files_remote_path ON synced_files (remote_path)')
+        # 远程过期清理按 remote_deleted + sync_time 查询
+        self.cursor.execute('''
+            CREATE INDEX IF NOT EXISTS idx_synced_files_expiry ON synced_files (remote_deleted, sync_time)
+        ''')
+
+        # 任务级别的键值状态，例如上次远程对账的时间
+        self.cursor.execute('''
+            CREATE TABLE IF NOT EXISTS task_state (
+                key TEXT PRIMARY KEY,
+                value TEXT
+            )
+        ''')
+
+        # 分块上传进度表，用于断点续传
+        self.cursor.execute('''
+            CREATE TABLE IF NOT EXISTS upload_progress (
+                file_path TEXT PRIMARY KEY,
+                remote_path TEXT,
+                file_size INTEGER,
+                file_mtime REAL,
+                chunk_size INTEGER,
+                confirmed_offset INTEGER DEFAULT 0,
+                update_time TIMESTAMP
+            )
+        ''')
+
+        # 增量压缩：上一次归档时源目录中每个文件的大小和修改时间
+        self.cursor.execute('''
+            CREATE TABLE IF NOT EXISTS archive_index (
+                origin_directory TEXT,
+                rel_path TEXT,
+                file_size INTEGER,
+                file_mtime REAL,
+                PRIMARY KEY (origin_directory, rel_path)
+            )
+        ''')
+
+        # 已创建的压缩文件，同时作为本地压缩文件的目录，本地过期清理只查询该表
+        self.cursor.execute('''
+            CREATE TABLE IF NOT EXISTS archives (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                origin_directory TEXT,
+                archive_path TEXT UNIQUE,
+                archive_type TEXT,
+                base_archive TEXT,
+                create_time TIMESTAMP,
+                sync_directory TEXT,
+                file_size INTEGER,
+                upload_time TIMESTAMP,
+                local_deleted BOOLEAN DEFAULT 0
+            )
+        ''')
+
+        # 旧版本数据库没有本地目录、大小和上传状态列，补充上
+        self.cursor.execute('PRAGMA table_info(archives)')
+        columns = {row[1] for row in self.cursor.fetchall()}
+        for column, column_type in (('sync_directory', 'TEXT'), ('file_size', 'INTEGER'),
+                                    ('upload_time', 'TIMESTAMP'), ('local_deleted', 'BOOLEAN DEFAULT 0')):
+            if column not in columns:
+                self.cursor.execute(f'ALTER TABLE archives ADD COLUMN {column} {column_type}')
+
+        self.cursor.execute('SELECT id, archive_path FROM archives WHERE sync_directory IS NULL')
+        self.cursor.executemany('UPDATE archives SET sync_directory = ? WHERE id = ?', [
+            (os.path.normpath(os.path.dirname(archive_path)), archive_id)
+            for archive_id, archive_path in self.cursor.fetchall()
+        ])
+
+        # 本地过期清理按 sync_directory + local_deleted + create_time 查询
+        self.cursor.execute('''
+            CREATE INDEX IF NOT EXISTS idx_archives_expiry ON archives (sync_directory, local_deleted, create_time)
+        ''')
+
+        # 上传队列：每次同步计划上传的文件及其状态（planned、in_flight、done、failed），
+        # 进程重启后未完成的文件可以直接继续上传，不需要重新扫描目录
+        self.cursor.execute('''
+            CREATE TABLE IF NOT EXISTS upload_queue (
+                sync_name TEXT,
+                file_path TEXT,
+                run_id TEXT,
+                status TEXT,
+                attempts INTEGER DEFAULT 0,
+                next_attempt TIMESTAMP,
+                last_error TEXT,
+                update_time TIMESTAMP,
+                PRIMARY KEY (sync_name, file_path)
+            )
+        ''')
+        self.cursor.execute('CREATE INDEX IF NOT EXISTS idx_upload_queue_status ON upload_queue (sync_name, status)')
+
+        # 增量数据库备份引用的更早的备份目录，被仍保留的备份引用的目录不能按天数清理
+        self.cursor.execute('''
+            CREATE TABLE IF NOT EXISTS backup_references (
+                backup_path TEXT,
+                referenced_path TEXT,
+                PRIMARY KEY (backup_path, referenced_path)
+            )
+        ''')
+        self.cursor.execute(
+            'CREATE INDEX IF NOT EXISTS idx_backup_references_target ON backup_references (referenced_path)'
+        )
+
+        # 去重备份：远程已有的数据块，ref_count 为引用该数据块的快照数
+        self.cursor.execute('''
+            CREATE TABLE IF NOT EXISTS dedup_chunks (
+                store TEXT,
+                hash TEXT,
+                size INTEGER,
+                stored_size INTEGER,
+                ref_count INTEGER DEFAULT 0,
+                PRIMARY KEY (store, hash)
+            )
+        ''')
+        # 去重备份：已上传的快照
         self.cursor.execute('''
-            INSERT OR REPLACE INTO synced_files 
-            (file_path, remote_path, sync_time, sync_success, remote_deleted)
-            VALUES (?, ?, ?, ?, ?)
-        ''', (local_path, remote_path, datetime.now(), True, False))
+            CREATE TABLE IF NOT EXISTS dedup_snapshots (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                store TEXT,
+                name TEXT,
+                remote_path TEXT,
+                file_count INTEGER,
+                total_size INTEGER,
+                uploaded_size INTEGER,
+                create_time TIMESTAMP
+            )
+        ''')
+        # 去重备份：上一次快照中每个文件的大小、修改时间和数据块，未变化的文件不再重新分块
+        self.cursor.execute('''
+            CREATE TABLE IF NOT EXISTS dedup_files (
+                store TEXT,
+                rel_path TEXT,
+                file_size INTEGER,
+                file_mtime REAL,
+                chunks TEXT,
+                PRIMARY KEY (store, rel_path)
+            )
+        ''')
         self.conn.commit()
 
+    def add_file(self, local_path, remote_path, file_size=None, file_mtime=None, content_hash=None):
+        """添加或更新文件记录"""
+        with self.lock:
+            self.cursor.execute('''
+                INSERT OR REPLACE INTO synced_files 
+                (file_path, remote_path, sync_time, sync_success, remote_deleted, file_size, file_mtime, content_hash)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+            ''', (local_path, remote_path, datetime.now(), True, False, file_size, file_mtime, content_hash))
+            self.conn.commit()
+
+    def update_file_stat(self, file_path, file_size, file_mtime, content_hash=None):
+        """内容未变化时更新记录的文件大小和修改时间"""
+        with self.lock:
+            self.cursor.execute('''
+                UPDATE synced_files
+                SET file_size = ?, file_mtime = ?, content_hash = COALESCE(?, content_hash)
+                WHERE file_path = ?
+            ''', (file_size, file_mtime, content_hash, file_path))
+            self.conn.commit()
+
     def update_file_sync_status(self, file_path, success):
         """更新文件同步状态"""
-        self.cursor.execute('''
-            UPDATE synced_files
-            SET sync_time = ?, sync_success = ?
-            WHERE file_path = ?
-        ''', (datetime.now(), success, file_path))
-        self.conn.commit()
+        with self.lock:
+            self.cursor.execute('''
+                UPDATE synced_files
+                SET sync_time = ?, sync_success = ?
+                WHERE file_path = ?
+            ''', (datetime.now(), success, file_path))
+            self.conn.commit()
 
     def mark_remote_deleted(self, remote_path):
         """标记远程文件已删除"""
-        self.cursor.execute('''
-            UPDATE synced_files
-            SET remote_deleted = 1
-            WHERE file_path = ? OR remote_path = ?
-        ''', (remote_path, remote_path))
-        self.conn.commit()
+        with self.lock:
+            self.cursor.execute('''
+                UPDATE synced_files
+                SET remote_deleted = 1
+                WHERE file_path = ? OR remote_path = ?
+            ''', (remote_path, remote_path))
+            self.conn.commit()
 
     def delete_file(self, file_path):
         """删除文件记录"""
-        self.cursor.execute('DELETE FROM synced_files WHERE file_path = ? OR remote_path = ?', (file_path, file_path))
-        self.conn.commit()
+        with self.lock:
+            self.cursor.execute('DELETE FROM synced_files WHERE file_path = ? OR remote_path = ?', (file_path, file_path))
+            self.conn.commit()
 
     def get_file_info(self, file_path):
         """获取单个文件信息"""
-        self.cursor.execute('''
-            SELECT id, file_path, remote_path, sync_time, sync_success, remote_deleted 
-            FROM synced_files 
-            WHERE file_path = ? OR remote_path = ?
-        ''', (file_path, file_path))
-        result = self.cursor.fetchone()
-        if result:
-            return {
-                'id': result[0],
-                'file_path': result[1],
-                'remote_path': result[2],
-                'sync_time': result[3],
-                'sync_success': result[4],
-                'remote_deleted': result[5]
-            }
-        return None
+        with self.lock:
+            self.cursor.execute(f'''
+                SELECT {SYNCED_FILE_COLUMNS}
+                FROM synced_files 
+                WHERE file_path = ? OR remote_path = ?
+            ''', (file_path, file_path))
+            result = self.cursor.fetchone()
+            if result:
+                return _row_to_file_info(result)
+            return None
+
+    def get_files_info(self, file_paths):
+        """
+        批量获取文件信息
+
+        :param file_paths: 本地文件路径列表
+        :return: {本地文件路径: 文件信息}，没有记录的文件不在结果中
+        """
+        file_paths = list(file_paths)
+        result = {}
+        with self.lock:
+            for start in range(0, len(file_paths), QUERY_BATCH_SIZE):
+                batch = file_paths[start:start + QUERY_BATCH_SIZE]
+                placeholders = ', '.join('?' * len(batch))
+                self.cursor.execute(
+                    f'SELECT {SYNCED_FILE_COLUMNS} FROM synced_files WHERE file_path IN ({placeholders})',
+                    batch
+                )
+                for row in self.cursor.fetchall():
+                    result[row[1]] = _row_to_file_info(row)
+        return result
+
+    def add_files(self, records):
+        """
+        在一个事务中批量添加或更新同步成功的文件记录
+
+        :param records: 可迭代的 (本地路径, 远程路径, 大小, 修改时间, 内容哈希)
+        """
+        now = datetime.now()
+        with self.lock:
+            with self.conn:
+                self.conn.executemany('''
+                    INSERT OR REPLACE INTO synced_files
+                    (file_path, remote_path, sync_time, sync_success, remote_deleted, file_size, file_mtime, content_hash)
+                    VALUES (?, ?, ?, 1, 0, ?, ?, ?)
+                ''', [(local_path, remote_path, now, file_size, file_mtime, content_hash)
+                      for local_path, remote_path, file_size, file_mtime, content_hash in records])
+
+    def update_files_stat(self, records):
+        """
+        在一个事务中批量更新内容未变化文件的大小和修改时间
+
+        :param records: 可迭代的 (本地路径, 大小, 修改时间, 内容哈希)
+        """
+        with self.lock:
+            with self.conn:
+                self.conn.executemany('''
+                    UPDATE synced_files
+                    SET file_size = ?, file_mtime = ?, content_hash = COALESCE(?, content_hash)
+                    WHERE file_path = ?
+                ''', [(file_size, file_mtime, content_hash, file_path)
+                      for file_path, file_size, file_mtime, content_hash in records])
+
+    def mark_remote_deleted_batch(self, remote_paths):
+        """在一个事务中批量标记远程文件已删除，同时删除已删除备份的引用记录"""
+        with self.lock:
+            with self.conn:
+                self.conn.executemany(
+                    'UPDATE synced_files SET remote_deleted = 1 WHERE remote_path = ?',
+                    [(remote_path,) for remote_path in remote_paths]
+                )
+                self.conn.executemany(
+                    'DELETE FROM backup_references WHERE backup_path = ?',
+                    [(remote_path,) for remote_path in remote_paths]
+                )
+
+    def add_backup_references(self, backup_path, referenced_paths):
+        """记录备份目录引用的更早的备份目录"""
+        with self.lock:
+            self.cursor.executemany(
+                'INSERT OR IGNORE INTO backup_references (backup_path, referenced_path) VALUES (?, ?)',
+                [(backup_path, referenced_path) for referenced_path in referenced_paths]
+            )
+            self.conn.commit()
+
+    def get_referenced_backups(self, referenced_paths, cutoff):
+        """
+        获取仍被未过期的备份引用的备份目录
+
+        :param referenced_paths: 待检查的备份目录
+        :param cutoff: 同步时间不早于 cutoff 且未删除的备份视为未过期
+        :return: referenced_paths 中仍被引用的路径集合
+        """
+        referenced = set()
+        referenced_paths = list(referenced_paths)
+        with self.lock:
+            for start in range(0, len(referenced_paths), 500):
+                batch = referenced_paths[start:start + 500]
+                self.cursor.execute(f'''
+                    SELECT DISTINCT r.referenced_path
+                    FROM backup_references r
+                    JOIN synced_files f ON f.remote_path = r.backup_path
+                    WHERE r.referenced_path IN ({', '.join('?' * len(batch))})
+                      AND f.remote_deleted = 0 AND f.sync_time >= ?
+                ''', batch + [cutoff])
+                referenced.update(row[0] for row in self.cursor.fetchall())
+        return referenced
+
+    def get_expired_remote_files(self, remote_directory, cutoff):
+        """
+        获取远程目录下同步时间早于 cutoff 且尚未从远程删除的文件
+
+        :param remote_directory: 远程目录路径
+        :param cutoff: 截止时间（datetime）
+        :return: 远程路径列表
+        """
+        prefix = remote_directory.rstrip('/').replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+        with self.lock:
+            self.cursor.execute('''
+                SELECT remote_path
+                FROM synced_files
+                WHERE remote_deleted = 0 AND sync_time < ? AND sync_success = 1
+                  AND remote_path LIKE ? ESCAPE '\\'
+            ''', (cutoff, prefix + '/%'))
+            return [row[0] for row in self.cursor.fetchall()]
+
+    def get_state(self, key, default=None):
+        """读取任务状态"""
+        with self.lock:
+            self.cursor.execute('SELECT value FROM task_state WHERE key = ?', (key,))
+            result = self.cursor.fetchone()
+            return result[0] if result else default
+
+    def set_state(self, key, value):
+        """写入任务状态"""
+        with self.lock:
+            self.cursor.execute('INSERT OR REPLACE INTO task_state (key, value) VALUES (?, ?)', (key, value))
+            self.conn.commit()
 
     def get_all_files(self):
         """获取所有文件信息"""
-        self.cursor.execute('SELECT * FROM synced_files')
-        return self.cursor.fetchall()
+        with self.lock:
+            self.cursor.execute('SELECT * FROM synced_files')
+            return self.cursor.fetchall()
+
+    def get_upload_progress(self, file_path):
+        """获取文件的分块上传进度"""
+        with self.lock:
+            self.cursor.execute('''
+                SELECT file_path, remote_path, file_size, file_mtime, chunk_size, confirmed_offset
+                FROM upload_progress
+                WHERE file_path = ?
+            ''', (file_path,))
+            result = self.cursor.fetchone()
+            if result:
+                return {
+                    'file_path': result[0],
+                    'remote_path': result[1],
+                    'file_size': result[2],
+                    'file_mtime': result[3],
+                    'chunk_size': result[4],
+                    'confirmed_offset': result[5]
+                }
+            return None
+
+    def save_upload_progress(self, file_path, remote_path, file_size, file_mtime, chunk_size, confirmed_offset):
+        """记录文件已确认上传到的位置"""
+        with self.lock:
+            self.cursor.execute('''
+                INSERT OR REPLACE INTO upload_progress
+                (file_path, remote_path, file_size, file_mtime, chunk_size, confirmed_offset, update_time)
+                VALUES (?, ?, ?, ?, ?, ?, ?)
+            ''', (file_path, remote_path, file_size, file_mtime, chunk_size, confirmed_offset, datetime.now()))
+            self.conn.commit()
+
+    def clear_upload_progress(self, file_path):
+        """上传完成后删除进度记录"""
+        with self.lock:
+            self.cursor.execute('DELETE FROM upload_progress WHERE file_path = ?', (file_path,))
+            self.conn.commit()
+
+    def get_archive_index(self, origin_directory):
+        """获取上一次归档时的文件索引"""
+        with self.lock:
+            self.cursor.execute('''
+                SELECT rel_path, file_size, file_mtime
+                FROM archive_index
+                WHERE origin_directory = ?
+            ''', (origin_directory,))
+            return {row[0]: (row[1], row[2]) for row in self.cursor.fetchall()}
+
+    def replace_archive_index(self, origin_directory, index):
+        """用本次归档后的文件索引替换旧索引"""
+        with self.lock:
+            self.cursor.execute('DELETE FROM archive_index WHERE origin_directory = ?', (origin_directory,))
+            self.cursor.executemany('''
+                INSERT INTO archive_index (origin_directory, rel_path, file_size, file_mtime)
+                VALUES (?, ?, ?, ?)
+            ''', [(origin_directory, rel_path, size, mtime) for rel_path, (size, mtime) in index.items()])
+            self.conn.commit()
+
+    def add_archive(self, origin_directory, archive_path, archive_type, base_archive=None, file_size=None,
+                    uploaded=False, create_time=None, sync_directory=None):
+        """
+        记录新创建的压缩文件
+
+        :param archive_type: full、delta（增量压缩）或 zip（普通压缩）
+        :param uploaded: 是否已经上传（流式上传时创建即上传）
+        :param create_time: 创建时间，默认为当前时间
+        :param sync_directory: 压缩文件所属的本地目录，默认为压缩文件所在的目录
+        """
+        now = datetime.now()
+        sync_directory = os.path.normpath(sync_directory or os.path.dirname(archive_path))
+        with self.lock:
+            self.cursor.execute('''
+                INSERT OR REPLACE INTO archives
+                (origin_directory, archive_path, archive_type, base_archive, create_time,
+                 sync_directory, file_size, upload_time, local_deleted)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, 0)
+            ''', (origin_directory, archive_path, archive_type, base_archive, create_time or now,
+                  sync_directory, file_size, now if uploaded else None))
+            self.conn.commit()
+
+    def get_archive_paths(self, sync_directory):
+        """获取本地目录中已登记的所有压缩文件路径"""
+        with self.lock:
+            self.cursor.execute('SELECT archive_path FROM archives WHERE sync_directory = ?',
+                                (os.path.normpath(sync_directory),))
+            return {row[0] for row in self.cursor.fetchall()}
+
+    def mark_archives_uploaded(self, archive_paths):
+        """记录压缩文件已上传，不是压缩文件的路径不受影响"""
+        now = datetime.now()
+        with self.lock:
+            self.cursor.executemany(
+                'UPDATE archives SET upload_time = ? WHERE archive_path = ?',
+                [(now, archive_path) for archive_path in archive_paths]
+            )
+            self.conn.commit()
+
+    def get_expired_archives(self, sync_directory, cutoff):
+        """
+        获取本地目录中创建时间不晚于 cutoff 且尚未删除的压缩文件
+
+        :return: 字典列表，包含 archive_path、file_size、create_time、upload_time
+        """
+        with self.lock:
+            self.cursor.execute('''
+                SELECT archive_path, file_size, create_time, upload_time
+                FROM archives
+                WHERE sync_directory = ? AND local_deleted = 0 AND create_time <= ?
+                ORDER BY create_time
+            ''', (os.path.normpath(sync_directory), cutoff))
+            return [
+                {'archive_path': row[0], 'file_size': row[1], 'create_time': row[2], 'upload_time': row[3]}
+                for row in self.cursor.fetchall()
+            ]
+
+    def get_archive_chains(self, sync_directory):
+        """
+        获取本地目录中增量压缩产生的所有完整归档和增量归档（包括已删除的），用于判断归档链是否仍在使用
+
+        :return: 字典列表，包含 archive_path、archive_type、base_archive、create_time、upload_time
+        """
+        with self.lock:
+            self.cursor.execute('''
+                SELECT archive_path, archive_type, base_archive, create_time, upload_time
+                FROM archives
+                WHERE sync_directory = ? AND archive_type IN ('full', 'delta')
+            ''', (os.path.normpath(sync_directory),))
+            return [
+                {'archive_path': row[0], 'archive_type': row[1], 'base_archive': row[2],
+                 'create_time': row[3], 'upload_time': row[4]}
+                for row in self.cursor.fetchall()
+            ]
+
+    def mark_archive_deleted(self, archive_path):
+        """记录本地压缩文件已删除，保留记录供增量压缩查询归档链"""
+        with self.lock:
+            self.cursor.execute('UPDATE archives SET local_deleted = 1 WHERE archive_path = ?', (archive_path,))
+            self.conn.commit()
+
+    def get_last_archive(self, origin_directory, archive_type=None):
+        """获取源目录最近一次创建的压缩文件，可按类型筛选"""
+        with self.lock:
+            sql = '''
+                SELECT archive_path, archive_type, base_archive, create_time
+                FROM archives
+                WHERE origin_directory = ?
+            '''
+            params = [origin_directory]
+            if archive_type:
+                sql += ' AND archive_type = ?'
+                params.append(archive_type)
+            sql += ' ORDER BY create_time DESC, id DESC LIMIT 1'
+            self.cursor.execute(sql, params)
+            result = self.cursor.fetchone()
+            if result:
+                return {
+                    'archive_path': result[0],
+                    'archive_type': result[1],
+                    'base_archive': result[2],
+                    'create_time': result[3]
+                }
+            return None
+
+    def get_upload_queue_items(self, sync_name, file_paths):
+        """
+        批量获取上传队列中的文件
+
+        :return: {本地文件路径: {'status', 'attempts', 'next_attempt'}}，不在队列中的文件不在结果中
+        """
+        file_paths = list(file_paths)
+        result = {}
+        with self.lock:
+            for start in range(0, len(file_paths), QUERY_BATCH_SIZE):
+                batch = file_paths[start:start + QUERY_BATCH_SIZE]
+                placeholders = ', '.join('?' * len(batch))
+                self.cursor.execute(f'''
+                    SELECT file_path, status, attempts, next_attempt
+                    FROM upload_queue
+                    WHERE sync_name = ? AND file_path IN ({placeholders})
+                ''', [sync_name] + batch)
+                for row in self.cursor.fetchall():
+                    result[row[0]] = {'status': row[1], 'attempts': row[2], 'next_attempt': row[3]}
+        return result
+
+    def plan_uploads(self, sync_name, run_id, file_paths):
+        """把一批文件加入上传队列，状态为 planned，保留之前的失败次数，整批在一个事务中写入"""
+        now = datetime.now()
+        with self.lock:
+            self.cursor.executemany('''
+                INSERT INTO upload_queue (sync_name, file_path, run_id, status, attempts, update_time)
+                VALUES (?, ?, ?, 'planned', 0, ?)
+                ON CONFLICT (sync_name, file_path)
+                DO UPDATE SET run_id = excluded.run_id, status = 'planned', update_time = excluded.update_time
+            ''', [(sync_name, file_path, run_id, now) for file_path in file_paths])
+            self.conn.commit()
+
+    def start_uploads(self, sync_name, file_paths):
+        """
+        在一个事务中记录一批文件已提交给上传线程池
+
+        只更新仍为 planned 的记录，已经完成或失败的记录不受影响
+        """
+        now = datetime.now()
+        with self.lock:
+            self.cursor.executemany('''
+                UPDATE upload_queue SET status = 'in_flight', update_time = ?
+                WHERE sync_name = ? AND file_path = ? AND status = 'planned'
+            ''', [(now, sync_name, file_path) for file_path in file_paths])
+            self.conn.commit()
+
+    def record_upload_retry(self, sync_name, file_path, error=None):
+        """记录一次上传重试"""
+        with self.lock:
+            self.cursor.execute('''
+                UPDATE upload_queue SET attempts = attempts + 1, last_error = ?, update_time = ?
+                WHERE sync_name = ? AND file_path = ?
+            ''', (error, datetime.now(), sync_name, file_path))
+            self.conn.commit()
+
+    def fail_upload(self, sync_name, file_path, error, next_attempt):
+        """记录上传失败，next_attempt 之前不再尝试"""
+        with self.lock:
+            self.cursor.execute('''
+                UPDATE upload_queue
+                SET status = 'failed', attempts = attempts + 1, last_error = ?, next_attempt = ?, update_time = ?
+                WHERE sync_name = ? AND file_path = ?
+            ''', (error, next_attempt, datetime.now(), sync_name, file_path))
+            self.conn.commit()
+
+    def complete_uploads(self, sync_name, file_paths):
+        """记录上传完成"""
+        now = datetime.now()
+        with self.lock:
+            self.cursor.executemany('''
+                UPDATE upload_queue SET status = 'done', last_error = NULL, update_time = ?
+                WHERE sync_name = ? AND file_path = ?
+            ''', [(now, sync_name, file_path) for file_path in file_paths])
+            self.conn.commit()
+
+    def remove_upload_items(self, sync_name, file_paths):
+        """从上传队列中移除不再需要上传的文件"""
+        with self.lock:
+            self.cursor.executemany('DELETE FROM upload_queue WHERE sync_name = ? AND file_path = ?',
+                                    [(sync_name, file_path) for file_path in file_paths])
+            self.conn.commit()
+
+    def clear_done_uploads(self, sync_name):
+        """删除已完成的记录，每次同步开始时调用，队列中只保留最近一次的完成记录"""
+        with self.lock:
+            self.cursor.execute("DELETE FROM upload_queue WHERE sync_name = ? AND status = 'done'", (sync_name,))
+            self.conn.commit()
+
+    def get_pending_uploads(self, sync_name, now=None):
+        """获取未完成的上传：计划中、上传中（进程退出时中断），以及已到重试时间的失败文件"""
+        with self.lock:
+            self.cursor.execute('''
+                SELECT file_path FROM upload_queue
+                WHERE sync_name = ?
+                  AND (status IN ('planned', 'in_flight') OR (status = 'failed' AND next_attempt <= ?))
+                ORDER BY update_time
+            ''', (sync_name, now or datetime.now()))
+            return [row[0] for row in self.cursor.fetchall()]
+
+    def get_dedup_chunk_hashes(self, store):
+        """获取存储中所有已上传数据块的哈希"""
+        with self.lock:
+            self.cursor.execute('SELECT hash FROM dedup_chunks WHERE store = ?', (store,))
+            return {row[0] for row in self.cursor.fetchall()}
+
+    def add_dedup_chunks(self, store, records):
+        """
+        记录新上传的数据块
+
+        :param records: (哈希, 原始大小, 存储大小) 的列表
+        """
+        with self.lock:
+            self.cursor.executemany('''
+                INSERT OR IGNORE INTO dedup_chunks (store, hash, size, stored_size, ref_count)
+                VALUES (?, ?, ?, ?, 0)
+            ''', [(store, chunk_hash, size, stored_size) for chunk_hash, size, stored_size in records])
+            self.conn.commit()
+
+    def add_dedup_snapshot(self, store, name, remote_path, file_count, total_size, uploaded_size, hashes,
+                           create_time=None):
+        """记录快照，并在同一个事务中增加其引用的数据块的引用计数"""
+        with self.lock:
+            self.cursor.executemany(
+                'UPDATE dedup_chunks SET ref_count = ref_count + 1 WHERE store = ? AND hash = ?',
+                [(store, chunk_hash) for chunk_hash in set(hashes)]
+            )
+            self.cursor.execute('''
+                INSERT INTO dedup_snapshots
+                (store, name, remote_path, file_count, total_size, uploaded_size, create_time)
+                VALUES (?, ?, ?, ?, ?, ?, ?)
+            ''', (store, name, remote_path, file_count, total_size, uploaded_size, create_time or datetime.now()))
+            self.conn.commit()
+
+    def get_dedup_snapshots(self, store):
+        """按创建时间从旧到新获取存储中的所有快照"""
+        with self.lock:
+            self.cursor.execute('''
+                SELECT id, name, remote_path, create_time
+                FROM dedup_snapshots
+                WHERE store = ?
+                ORDER BY create_time, id
+            ''', (store,))
+            return [
+                {'id': row[0], 'name': row[1], 'remote_path': row[2], 'create_time': row[3]}
+                for row in self.cursor.fetchall()
+            ]
+
+    def remove_dedup_snapshot(self, store, snapshot_id, hashes):
+        """删除快照记录，并在同一个事务中减少其引用的数据块的引用计数"""
+        with self.lock:
+            self.cursor.executemany(
+                'UPDATE dedup_chunks SET ref_count = ref_count - 1 WHERE store = ? AND hash = ?',
+                [(store, chunk_hash) for chunk_hash in set(hashes)]
+            )
+            self.cursor.execute('DELETE FROM dedup_snapshots WHERE id = ?', (snapshot_id,))
+            self.conn.commit()
+
+    def get_unreferenced_dedup_chunks(self, store):
+        """获取没有任何快照引用的数据块"""
+        with self.lock:
+            self.cursor.execute('SELECT hash FROM dedup_chunks WHERE store = ? AND ref_count <= 0', (store,))
+            return [row[0] for row in self.cursor.fetchall()]
+
+    def delete_dedup_chunks(self, store, hashes):
+        """删除数据块记录"""
+        with self.lock:
+            self.cursor.executemany('DELETE FROM dedup_chunks WHERE store = ? AND hash = ?',
+                                    [(store, chunk_hash) for chunk_hash in hashes])
+            self.conn.commit()
+
+    def get_dedup_file_index(self, store):
+        """获取上一次快照的文件索引，{相对路径: (大小, 修改时间, 数据块哈希列表)}"""
+        with self.lock:
+            self.cursor.execute('''
+                SELECT rel_path, file_size, file_mtime, chunks FROM dedup_files WHERE store = ?
+            ''', (store,))
+            return {row[0]: (row[1], row[2], row[3].split(',') if row[3] else []) for row in self.cursor.fetchall()}
+
+    def replace_dedup_file_index(self, store, index):
+        """用本次快照的文件索引替换旧索引"""
+        with self.lock:
+            self.cursor.execute('DELETE FROM dedup_files WHERE store = ?', (store,))
+            self.cursor.executemany('''
+                INSERT INTO dedup_files (store, rel_path, file_size, file_mtime, chunks)
+                VALUES (?, ?, ?, ?, ?)
+            ''', [(store, rel_path, size, mtime, ','.join(chunks)) for rel_path, (size, mtime, chunks) in index.items()])
+            self.conn.commit()
+
+    def reset_dedup_store(self, store):
+        """清空存储的全部本地记录，用于从远程重建索引"""
+        with self.lock:
+            for table in ('dedup_chunks', 'dedup_snapshots', 'dedup_files'):
+                self.cursor.execute(f'DELETE FROM {table} WHERE store = ?', (store,))
+            self.conn.commit()
 
     # ... 其他方法保持不变 ...
@@ -0,0 +1,306 @@
+import os
+import gzip
+import json
+import zlib
+import hashlib
+import logging
+import threading
+from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from utils.zip_handler import scan_directory, TIMESTAMP_FORMAT
+
+# 每个字节映射为 '0' 或 '1'，连续 run_length 个 '1' 结束的位置作为分块边界。
+# 边界只取决于附近的内容，插入或删除数据只影响附近的分块；映射表固定，不能修改，否则已有数据块无法复用
+_BOUNDARY_TABLE = bytes(
+    ord('1') if hashlib.sha256(b'wdsync-cdc' + bytes([value])).digest()[0] & 1 else ord('0')
+    for value in range(256)
+)
+
+# 数据块存储格式：第一个字节表示是否压缩
+_CHUNK_ZLIB = b'z'
+_CHUNK_RAW = b'r'
+
+class ContentDefinedChunker:
+    """
+    按内容分块
+
+    用 bytes.translate 和 bytes.find 查找边界，速度接近内存带宽，不需要逐字节计算滚动哈希
+    """
+    def __init__(self, avg_size=1024 * 1024, min_size=None, max_size=None):
+        self.min_size = min_size or avg_size // 4
+        self.max_size = max_size or avg_size * 4
+        # 随机数据中长度为 n 的连续 '1' 平均每 2^(n+1) 字节出现一次
+        self.pattern = b'1' * max(1, (avg_size - self.min_size).bit_length() - 2)
+
+    def iter_chunks(self, f):
+        """从文件对象中读取并产出数据块"""
+        data = bytearray()
+        bits = bytearray()
+        eof = False
+        while True:
+            while not eof and len(data) < self.max_size:
+                block = f.read(self.max_size)
+                if not block:
+                    eof = True
+                    break
+                data += block
+                bits += block.translate(_BOUNDARY_TABLE)
+            if not data:
+                return
+            cut = self._find_boundary(bits)
+            yield bytes(data[:cut])
+            del data[:cut]
+            del bits[:cut]
+
+    def _find_boundary(self, bits):
+        end = min(len(bits), self.max_size)
+        if end <= self.min_size:
+            return end
+        position = bits.find(self.pattern, self.min_size - len(self.pattern), end)
+        return end if position == -1 else position + len(self.pattern)
+
+class DedupStore:
+    """
+    去重备份存储
+
+    远程目录结构：
+        chunks/<哈希前两位>/<sha256>   数据块，第一个字节为 z（zlib 压缩）或 r（原样）
+        snapshots/<名称>.json.gz       快照清单，列出每个文件及其数据块
+    本地数据库记录已上传的数据块及其引用计数，查询不需要访问远程；
+    清理过期快照后，没有任何快照引用的数据块会被删除
+    """
+    def __init__(self, client, db_manager, remote_directory, avg_chunk_size=1024 * 1024,
+                 workers=4, compress_level=-1):
+        self.client = client
+        self.db_manager = db_manager
+        self.remote_directory = remote_directory.replace('\\', '/').rstrip('/')
+        self.store = self.remote_directory
+        self.chunker = ContentDefinedChunker(avg_chunk_size)
+        self.workers = max(1, workers)
+        self.compress_level = compress_level
+        self.created_directories = set()
+        self.lock = threading.Lock()
+
+    def chunk_path(self, chunk_hash):
+        return f"{self.remote_directory}/chunks/{chunk_hash[:2]}/{chunk_hash}"
+
+    def snapshot_path(self, name):
+        return f"{self.remote_directory}/snapshots/{name}.json.gz"
+
+    def _ensure_directory(self, remote_directory):
+        with self.lock:
+            if remote_directory in self.created_directories:
+                return
+        if self.client.get_remote_file_info(remote_directory) is None:
+            self.client.make_remote_directory(remote_directory)
+        with self.lock:
+            self.created_directories.add(remote_directory)
+
+    def _upload_chunk(self, chunk_hash, data):
+        compressed = zlib.compress(data, self.compress_level)
+        payload = _CHUNK_ZLIB + compressed if len(compressed) < len(data) else _CHUNK_RAW + data
+        self._ensure_directory(f"{self.remote_directory}/chunks/{chunk_hash[:2]}")
+        self.client.upload_bytes(payload, self.chunk_path(chunk_hash))
+        return chunk_hash, len(data), len(payload)
+
+    def _load_index(self):
+        """本地没有记录但远程已有快照时（例如数据库丢失），先从远程清单重建索引"""
+        known_chunks = self.db_manager.get_dedup_chunk_hashes(self.store)
+        if known_chunks or self.db_manager.get_dedup_snapshots(self.store):
+            return known_chunks
+        snapshots_directory = f"{self.remote_directory}/snapshots"
+        if self.client.get_remote_file_info(snapshots_directory) is None:
+            return known_chunks
+        return self.rebuild_index()
+
+    def rebuild_index(self):
+        """根据远程的快照清单和数据块重建本地索引"""
+        logging.info(f"正在从远程重建去重索引: {self.remote_directory}")
+        self.db_manager.reset_dedup_store(self.store)
+        records = []
+        for directory in self.client.list_remote_directory(f"{self.remote_directory}/chunks", refresh=True):
+            if not directory.endswith('/'):
+                continue
+            for name in self.client.list_remote_directory(f"{self.remote_directory}/chunks/{directory}", refresh=True):
+                if not name.endswith('/'):
+                    records.append((name, None, None))
+        self.db_manager.add_dedup_chunks(self.store, records)
+
+        for file_name in sorted(self.client.list_remote_directory(f"{self.remote_directory}/snapshots", refresh=True)):
+            if not file_name.endswith('.json.gz'):
+                continue
+            name = file_name[:-len('.json.gz')]
+            manifest = self.read_manifest(name)
+            hashes = [chunk_hash for entry in manifest['files'] for chunk_hash in entry['chunks']]
+            self.db_manager.add_dedup_snapshot(
+                self.store, name, self.snapshot_path(name), len(manifest['files']),
+                sum(entry['size'] for entry in manifest['files']), 0, hashes,
+                create_time=datetime.strptime(manifest['created'], TIMESTAMP_FORMAT)
+            )
+        known_chunks = self.db_manager.get_dedup_chunk_hashes(self.store)
+        logging.info(f"去重索引重建完成: {len(known_chunks)} 个数据块")
+        return known_chunks
+
+    def read_manifest(self, name):
+        return json.loads(gzip.decompress(self.client.read_remote_file(self.snapshot_path(name))).decode('utf-8'))
+
+    def backup(self, origin_dir, path_filter=None):
+        """
+        创建一个快照：只对新增或修改的文件分块，只上传远程没有的数据块
+
+        :param origin_dir: 源目录
+        :param path_filter: 可选的 PathFilter
+        :return: {'name', 'files', 'total_size', 'uploaded_size', 'new_chunks'}
+        """
+        known_chunks = self._load_index()
+        previous_index = self.db_manager.get_dedup_file_index(self.store)
+        current_index = scan_directory(origin_dir, path_filter)
+
+        timestamp = datetime.now().strftime(TIMESTAMP_FORMAT)
+        folder_name = os.path.basename(os.path.normpath(origin_dir))
+        name = f"{folder_name}_{timestamp}"
+        # 同一秒内多次备份时加序号，避免覆盖已有的快照清单
+        existing_names = {snapshot['name'] for snapshot in self.db_manager.get_dedup_snapshots(self.store)}
+        sequence = 1
+        while name in existing_names:
+            name = f"{folder_name}_{timestamp}_{sequence}"
+            sequence += 1
+        for directory in (self.remote_directory, f"{self.remote_directory}/chunks", f"{self.remote_directory}/snapshots"):
+            self._ensure_directory(directory)
+
+        files = []
+        file_index = {}
+        scheduled = set()
+        uploaded = []
+        pending = set()
+        total_size = 0
+
+        failures = []
+
+        def collect(done):
+            for future in done:
+                try:
+                    uploaded.append(future.result())
+                except Exception as e:
+                    failures.append(e)
+
+        try:
+            with ThreadPoolExecutor(max_workers=self.workers) as executor:
+                try:
+                    for rel_path in sorted(current_index):
+                        size, mtime = current_index[rel_path]
+                        previous = previous_index.get(rel_path)
+                        if previous and (previous[0], previous[1]) == (size, mtime):
+                            # 大小和修改时间都没变，直接沿用上次的数据块
+                            chunks = previous[2]
+                        else:
+                            chunks = []
+                            try:
+                                with open(os.path.join(origin_dir, rel_path), 'rb') as f:
+                                    for data in self.chunker.iter_chunks(f):
+                                        chunk_hash = hashlib.sha256(data).hexdigest()
+                                        chunks.append(chunk_hash)
+                                        if chunk_hash in known_chunks or chunk_hash in scheduled:
+                                            continue
+                                        scheduled.add(chunk_hash)
+                                        pending.add(executor.submit(self._upload_chunk, chunk_hash, data))
+                                        # 限制待上传的数据块数量，内存占用与文件大小无关
+                                        if len(pending) >= self.workers * 2:
+                                            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                                            collect(done)
+                            except OSError as e:
+                                logging.warning(f"无法读取文件，跳过: {rel_path}, 错误: {str(e)}")
+                                continue
+                            # 有数据块上传失败时不再继续（上传异常也是 OSError，不能在上面的 try 中抛出）
+                            if failures:
+                                raise failures[0]
+                        files.append({'path': rel_path, 'size': size, 'mtime': mtime, 'chunks': chunks})
+                        file_index[rel_path] = (size, mtime, chunks)
+                        total_size += size
+                finally:
+                    done, pending = wait(pending)
+                    collect(done)
+            if failures:
+                raise failures[0]
+        finally:
+            # 出错时也记录已经上传成功的数据块，未被快照引用的数据块由 prune 删除
+            self.db_manager.add_dedup_chunks(self.store, uploaded)
+
+        # 数据块全部上传成功后再上传清单
+        manifest = {
+            'version': 1,
+            'created': timestamp,
+            'origin': origin_dir,
+            'files': files
+        }
+        manifest_data = gzip.compress(json.dumps(manifest).encode('utf-8'))
+        self.client.upload_bytes(manifest_data, self.snapshot_path(name))
+        uploaded_size = sum(stored_size for _, _, stored_size in uploaded)
+        self.db_manager.add_dedup_snapshot(
+            self.store, name, self.snapshot_path(name), len(files), total_size, uploaded_size,
+            [chunk_hash for entry in files for chunk_hash in entry['chunks']]
+        )
+        self.db_manager.replace_dedup_file_index(self.store, file_index)
+        logging.info(f"已创建去重快照: {name}, {len(files)} 个文件, 共 {total_size} 字节, "
+                     f"新上传 {len(uploaded)} 个数据块 {uploaded_size} 字节")
+        return {'name': name, 'files': len(files), 'total_size': total_size,
+                'uploaded_size': uploaded_size, 'new_chunks': len(uploaded)}
+
+    def prune(self, cutoff, delete_workers=4):
+        """
+        删除早于 cutoff 的快照（至少保留最新的一个），然后删除没有被引用的数据块
+
+        :return: (删除的快照数, 删除的数据块数)
+        """
+        snapshots = self.db_manager.get_dedup_snapshots(self.store)
+        expired = [
+            snapshot for snapshot in snapshots[:-1]
+            if datetime.fromisoformat(str(snapshot['create_time'])) < cutoff
+        ]
+        for snapshot in expired:
+            try:
+                manifest = self.read_manifest(snapshot['name'])
+            except Exception as e:
+                logging.error(f"读取快照清单失败，跳过: {snapshot['name']}, 错误: {str(e)}")
+                continue
+            hashes = [chunk_hash for entry in manifest['files'] for chunk_hash in entry['chunks']]
+            self.db_manager.remove_dedup_snapshot(self.store, snapshot['id'], hashes)
+            self.client.delete_remote_file(snapshot['remote_path'], True)
+            logging.info(f"已删除过期快照: {snapshot['name']}")
+
+        unreferenced = self.db_manager.get_unreferenced_dedup_chunks(self.store)
+        deleted = []
+        if unreferenced:
+            with ThreadPoolExecutor(max_workers=max(1, delete_workers)) as executor:
+                results = executor.map(
+                    lambda chunk_hash: (chunk_hash, self.client.delete_remote_file(self.chunk_path(chunk_hash), True)),
+                    unreferenced
+                )
+                deleted = [chunk_hash for chunk_hash, success in results if success]
+            self.db_manager.delete_dedup_chunks(self.store, deleted)
+            logging.info(f"已删除 {len(deleted)} 个没有被引用的数据块")
+        return len(expired), len(deleted)
+
+def restore_snapshot(client, remote_directory, snapshot_name, target_dir):
+    """
+    从去重存储还原快照
+
+    :param client: WebDAVSyncClient 实例
+    :param remote_directory: 去重存储所在的远程目录
+    :param snapshot_name: 快照名称（snapshots 目录中的文件名去掉 .json.gz）
+    :param target_dir: 还原目录
+    """
+    store = DedupStore(client, None, remote_directory)
+    manifest = store.read_manifest(snapshot_name)
+    for entry in manifest['files']:
+        target_path = os.path.join(target_dir, *entry['path'].split('/'))
+        os.makedirs(os.path.dirname(target_path), exist_ok=True)
+        with open(target_path, 'wb') as f:
+            for chunk_hash in entry['chunks']:
+                payload = client.read_remote_file(store.chunk_path(chunk_hash))
+                data = zlib.decompress(payload[1:]) if payload[:1] == _CHUNK_ZLIB else payload[1:]
+                if hashlib.sha256(data).hexdigest() != chunk_hash:
+                    raise ValueError(f"数据块校验失败: {chunk_hash}")
+                f.write(data)
+        os.utime(target_path, (entry['mtime'], entry['mtime']))
+    logging.info(f"已还原快照 {snapshot_name} 到 {target_dir}, 共 {len(manifest['files'])} 个文件")
@@ -0,0 +1,82 @@
+import os
+import logging
+from fnmatch import fnmatch
+from collections import namedtuple
+
+# 遍历得到的文件：完整路径、以 / 分隔的相对路径、大小、修改时间
+FileRecord = namedtuple('FileRecord', ['path', 'rel_path', 'size', 'mtime'])
+
+class PathFilter:
+    """
+    按 glob 规则筛选文件
+
+    规则中不含 / 时匹配文件名或目录名（任意层级），含 / 时匹配相对路径。
+    exclude 同时作用于目录（匹配的目录不再进入）和文件；配置了 include 时只保留匹配的文件
+    """
+    def __init__(self, include=None, exclude=None):
+        self.include = list(include or [])
+        self.exclude = list(exclude or [])
+
+    @classmethod
+    def from_config(cls, sync_config):
+        """从同步配置的 include_patterns 和 exclude_patterns 创建，都未配置时返回None"""
+        include = sync_config.get('include_patterns')
+        exclude = sync_config.get('exclude_patterns')
+        if not include and not exclude:
+            return None
+        return cls(include, exclude)
+
+    @staticmethod
+    def _match(rel_path, patterns):
+        name = rel_path.rsplit('/', 1)[-1]
+        return any(fnmatch(rel_path if '/' in pattern else name, pattern) for pattern in patterns)
+
+    def allow_directory(self, rel_path):
+        return not self._match(rel_path, self.exclude)
+
+    def allow_file(self, rel_path):
+        if self._match(rel_path, self.exclude):
+            return False
+        return not self.include or self._match(rel_path, self.include)
+
+    def allow_path(self, rel_path):
+        """判断单个文件是否保留，同时检查它所在的各级目录，结果与 walk_files 遍历时一致"""
+        parts = rel_path.split('/')
+        for depth in range(1, len(parts)):
+            if not self.allow_directory('/'.join(parts[:depth])):
+                return False
+        return self.allow_file(rel_path)
+
+def walk_files(root, path_filter=None):
+    """
+    遍历目录下的所有文件
+
+    基于 os.scandir，文件类型和大小、修改时间取自 DirEntry，每个文件最多一次 stat；
+    以生成器逐个产出，不在内存中保存完整的文件列表。不进入指向目录的符号链接，与 os.walk 的默认行为一致
+
+    :param root: 根目录
+    :param path_filter: 可选的 PathFilter
+    :return: 生成器，产出 FileRecord
+    """
+    pending_dirs = ['']
+    while pending_dirs:
+        rel_dir = pending_dirs.pop()
+        directory = os.path.join(root, rel_dir) if rel_dir else root
+        try:
+            with os.scandir(directory) as entries:
+                for entry in entries:
+                    rel_path = f"{rel_dir}/{entry.name}" if rel_dir else entry.name
+                    try:
+                        if entry.is_dir():
+                            if not entry.is_symlink() and (path_filter is None or path_filter.allow_directory(rel_path)):
+                                pending_dirs.append(rel_path)
+                            continue
+                        if path_filter is not None and not path_filter.allow_file(rel_path):
+                            continue
+                        stat = entry.stat()
+                    except OSError as e:
+                        logging.warning(f"无法获取文件信息 {entry.path}: {str(e)}")
+                        continue
+                    yield FileRecord(entry.path, rel_path, stat.st_size, stat.st_mtime)
+        except OSError as e:
+            logging.warning(f"无法读取目录 {directory}: {str(e)}")
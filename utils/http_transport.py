@@ -0,0 +1,140 @@
+import os
+import ssl
+import logging
+import threading
+from requests import Response
+from requests.adapters import BaseAdapter, HTTPAdapter
+from requests.structures import CaseInsensitiveDict
+from requests.utils import DEFAULT_CA_BUNDLE_PATH
+
+try:
+    import httpx
+except ImportError:
+    httpx = None
+
+def _drain_response(response, *args, **kwargs):
+    """
+    webdav3 的请求都使用 stream=True，响应体没有读完时连接不会放回连接池，下一个请求只能重新握手。
+    除下载（GET）外的响应体都很小，这里直接读完
+    """
+    if response.request.method != 'GET':
+        response.content
+    return response
+
+class Http2Adapter(BaseAdapter):
+    """
+    使用 httpx 的 HTTP/2 连接发送 requests 的请求，同一主机的并发请求复用一条连接
+
+    响应体一次读入内存，程序中的下载只用于清单、数据块等小文件
+    """
+    def __init__(self, pool_size=10, connect_timeout=10, read_timeout=30):
+        super().__init__()
+        self.limits = httpx.Limits(max_connections=pool_size, max_keepalive_connections=pool_size)
+        self.timeout = httpx.Timeout(read_timeout, connect=connect_timeout)
+        # {(verify, cert): httpx.Client}，每种 TLS 设置各用一个连接池
+        self.clients = {}
+        self.lock = threading.Lock()
+        # 预先创建默认设置的连接池，未安装 h2 时在这里抛出 ImportError
+        self._get_client(True, None)
+
+    @staticmethod
+    def _ssl_context(verify, cert):
+        """
+        按 requests 的 verify、cert 参数创建 SSLContext
+
+        :param verify: True 使用与 requests 相同的 CA 证书，False 不校验证书，字符串为 CA 证书文件或目录
+        :param cert: 客户端证书文件，或者 (证书文件, 私钥文件)
+        """
+        if verify is False:
+            context = ssl.create_default_context()
+            context.check_hostname = False
+            context.verify_mode = ssl.CERT_NONE
+        elif isinstance(verify, str) and os.path.isdir(verify):
+            context = ssl.create_default_context(capath=verify)
+        else:
+            context = ssl.create_default_context(cafile=verify if isinstance(verify, str) else DEFAULT_CA_BUNDLE_PATH)
+        if cert:
+            if isinstance(cert, (tuple, list)):
+                context.load_cert_chain(cert[0], cert[1])
+            else:
+                context.load_cert_chain(cert)
+        return context
+
+    def _get_client(self, verify, cert):
+        key = (verify, tuple(cert) if isinstance(cert, list) else cert)
+        with self.lock:
+            client = self.clients.get(key)
+            if client is None:
+                client = httpx.Client(http2=True, verify=self._ssl_context(verify, cert),
+                                      limits=self.limits, timeout=self.timeout)
+                self.clients[key] = client
+            return client
+
+    def send(self, request, stream=False, timeout=None, verify=True, cert=None, proxies=None):
+        body = request.body
+        if hasattr(body, 'read'):
+            # 文件对象（包括限速、计算校验和的包装对象）按块读取
+            body = iter(lambda fileobj=body: fileobj.read(64 * 1024), b'')
+        if isinstance(timeout, tuple):
+            timeout = httpx.Timeout(timeout[1], connect=timeout[0])
+        elif timeout is not None:
+            timeout = httpx.Timeout(timeout)
+        else:
+            timeout = httpx.USE_CLIENT_DEFAULT
+        http2_response = self._get_client(verify, cert).request(
+            request.method, request.url, headers=dict(request.headers), content=body, timeout=timeout
+        )
+
+        response = Response()
+        response.status_code = http2_response.status_code
+        response.headers = CaseInsensitiveDict(http2_response.headers)
+        response.reason = http2_response.reason_phrase
+        response.url = request.url
+        response.request = request
+        response.encoding = http2_response.encoding
+        response._content = http2_response.content
+        response.connection = self
+        return response
+
+    def close(self):
+        with self.lock:
+            for client in self.clients.values():
+                client.close()
+            self.clients.clear()
+
+def configure_client(webdav_client, webdav_config):
+    """
+    为 webdav3 客户端配置连接池和超时
+
+    同一个 WebDAVSyncClient 的所有任务线程共享这个连接池（urllib3 的连接池是线程安全的），
+    连接保持 keep-alive，TLS 握手只在新建连接时发生
+
+    :param webdav_client: webdav3 Client
+    :param webdav_config: config.json 的 WebDAV 部分
+    :return: 挂载的 adapter
+    """
+    pool_size = webdav_config.get('pool_size', max(10, webdav_config.get('max_concurrent_uploads', 8) + 4))
+    connect_timeout = webdav_config.get('connect_timeout', 10)
+    read_timeout = webdav_config.get('read_timeout', 30)
+
+    adapter = None
+    if webdav_config.get('http2', False):
+        if httpx is None:
+            logging.warning("未安装 httpx[http2]，无法使用 HTTP/2，继续使用 HTTP/1.1")
+        else:
+            try:
+                adapter = Http2Adapter(pool_size, connect_timeout, read_timeout)
+                logging.info("已启用 HTTP/2")
+            except ImportError as e:
+                logging.warning(f"无法使用 HTTP/2，继续使用 HTTP/1.1: {str(e)}")
+    if adapter is None:
+        adapter = HTTPAdapter(pool_connections=4, pool_maxsize=pool_size)
+
+    session = webdav_client.session
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    session.hooks['response'].append(_drain_response)
+    # requests 的 (连接超时, 读取超时)，读取超时是两次收到数据之间的最长间隔
+    webdav_client.timeout = (connect_timeout, read_timeout)
+    logging.info(f"WebDAV连接池大小: {pool_size}, 连接超时: {connect_timeout} 秒, 读取超时: {read_timeout} 秒")
+    return adapter
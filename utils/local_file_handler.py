@@ -1,32 +1,24 @@
 import os
 import re
+import hashlib
 from datetime import datetime
 import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from utils.file_walker import walk_files
 
 class FileLockedError(Exception):
     """当文件被占用时抛出的自定义异常"""
     pass
 
-def check_file_access(file_path):
+def try_lock_file(file_path):
     """
-    检查文件是否可访问且写入完成
-    
+    尝试以独占模式锁定文件，检查是否被其他进程占用
+
     :param file_path: 文件路径
     :raises FileLockedError: 如果文件被占用则抛出此异常
     """
     try:
-        # 获取初始文件大小
-        initial_size = os.path.getsize(file_path)
-        # 等待一小段时间
-        time.sleep(1)
-        # 再次获取文件大小
-        final_size = os.path.getsize(file_path)
-        
-        # 如果文件大小发生变化，说明文件正在被写入
-        if initial_size != final_size:
-            raise FileLockedError(f"文件 {file_path} 正在被写入")
-            
-        # 尝试以独占模式打开文件
         with open(file_path, 'rb') as f:
             # 尝试获取文件锁
             try:
@@ -42,25 +34,151 @@ def check_file_access(file_path):
                     fcntl.flock(f.fileno(), fcntl.LOCK_UN)
             except (IOError, OSError):
                 raise FileLockedError(f"文件 {file_path} 被占用")
-                
+
+    except (IOError, OSError) as e:
+        raise FileLockedError(f"文件 {file_path} 被占用或无法访问: {str(e)}")
+
+def check_file_access(file_path, settle_seconds=1):
+    """
+    检查文件是否可访问且写入完成
+
+    :param file_path: 文件路径
+    :param settle_seconds: 两次获取文件大小之间的等待秒数
+    :raises FileLockedError: 如果文件被占用则抛出此异常
+    """
+    try:
+        # 获取初始文件大小
+        initial_size = os.path.getsize(file_path)
+        # 等待一小段时间
+        time.sleep(settle_seconds)
+        # 再次获取文件大小
+        final_size = os.path.getsize(file_path)
     except (IOError, OSError) as e:
         raise FileLockedError(f"文件 {file_path} 被占用或无法访问: {str(e)}")
 
-def get_available_files(folder_path):
+    # 如果文件大小发生变化，说明文件正在被写入
+    if initial_size != final_size:
+        raise FileLockedError(f"文件 {file_path} 正在被写入")
+
+    try_lock_file(file_path)
+
+def compute_file_hash(file_path, chunk_size=1024 * 1024):
+    """
+    计算文件内容的 SHA-256 哈希
+
+    :param file_path: 文件路径
+    :param chunk_size: 每次读取的字节数
+    :return: 十六进制哈希字符串
+    """
+    sha256 = hashlib.sha256()
+    with open(file_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            sha256.update(chunk)
+    return sha256.hexdigest()
+
+def _stat_signature(file_path):
+    """获取文件的大小和修改时间，文件无法访问时返回None"""
+    try:
+        st = os.stat(file_path)
+        return (st.st_size, st.st_mtime_ns)
+    except OSError:
+        return None
+
+def probe_ready_files(file_paths, settle_seconds=1, max_workers=8):
+    """
+    批量检查文件是否写入完成且未被占用
+
+    先对所有文件获取一次大小和修改时间，统一等待一个稳定窗口后再获取一次，
+    只对两次结果一致的文件做文件锁检测。
+
+    :param file_paths: 文件路径列表
+    :param settle_seconds: 稳定窗口秒数
+    :param max_workers: 同时进行文件锁检测的线程数
+    :return: 可用的文件路径列表，顺序与输入一致
+    """
+    file_paths = list(file_paths)
+    if not file_paths:
+        return []
+
+    initial = {path: _stat_signature(path) for path in file_paths}
+    if settle_seconds > 0:
+        time.sleep(settle_seconds)
+
+    # 大小和修改时间都没有变化的文件才需要进一步检测
+    stable_files = []
+    for path in file_paths:
+        signature = initial[path]
+        if signature is not None and _stat_signature(path) == signature:
+            stable_files.append(path)
+
+    return [path for path, ready in zip(stable_files, _probe_locks(stable_files, max_workers)) if ready]
+
+def _probe_locks(file_paths, max_workers):
+    """在线程池中检测文件是否被占用，返回与输入顺序一致的布尔值列表"""
+    def probe(path):
+        try:
+            try_lock_file(path)
+            return True
+        except FileLockedError:
+            return False
+
+    with ThreadPoolExecutor(max_workers=max(1, max_workers)) as executor:
+        return list(executor.map(probe, file_paths))
+
+def iter_available_files(folder_path, settle_seconds=1, max_workers=8, path_filter=None, batch_size=1000):
+    """
+    边遍历边产出指定文件夹下未被占用的文件
+
+    遍历时已经获取的大小和修改时间作为第一次结果，每个文件在遍历到 settle_seconds 秒后才再获取一次。
+    遍历和等待同时进行：已经等够时间的文件每攒够 batch_size 个检测一批，不需要额外等待；
+    遍历结束后剩下的文件只统一等待一次，整个目录最多多等待 settle_seconds 秒。
+
+    :param folder_path: 文件夹路径
+    :param settle_seconds: 判断文件是否写入完成的稳定窗口秒数
+    :param max_workers: 同时进行文件锁检测的线程数
+    :param path_filter: 可选的 PathFilter
+    :param batch_size: 每批检测的文件数
+    :return: 生成器，产出 FileRecord
+    """
+    # (可以再次检查的时间, FileRecord)，按遍历顺序排列，时间单调递增
+    pending = deque()
+    for record in walk_files(folder_path, path_filter):
+        pending.append((time.monotonic() + settle_seconds, record))
+        if len(pending) >= batch_size and pending[batch_size - 1][0] <= time.monotonic():
+            batch = [pending.popleft()[1] for _ in range(batch_size)]
+            yield from _probe_records(batch, 0, max_workers)
+    while pending:
+        deadline = pending[min(batch_size, len(pending)) - 1][0]
+        batch = [pending.popleft()[1] for _ in range(min(batch_size, len(pending)))]
+        yield from _probe_records(batch, deadline, max_workers)
+
+def _probe_records(records, deadline, max_workers):
+    """等到 deadline（time.monotonic 时间）后再次获取大小和修改时间，对没有变化的文件做文件锁检测"""
+    remaining = deadline - time.monotonic()
+    if remaining > 0:
+        time.sleep(remaining)
+
+    # 大小和修改时间都没有变化的文件才需要进一步检测
+    stable_records = []
+    for record in records:
+        try:
+            st = os.stat(record.path)
+        except OSError:
+            continue
+        if (st.st_size, st.st_mtime) == (record.size, record.mtime):
+            stable_records.append(record)
+
+    results = _probe_locks([record.path for record in stable_records], max_workers)
+    return [record for record, ready in zip(stable_records, results) if ready]
+
+def get_available_files(folder_path, settle_seconds=1, max_workers=8, path_filter=None):
     """
     获取指定文件夹下所有未被占用的文件
 
     :param folder_path: 文件夹路径
+    :param settle_seconds: 判断文件是否写入完成的稳定窗口秒数
+    :param max_workers: 同时进行文件锁检测的线程数
+    :param path_filter: 可选的 PathFilter
     :return: 未被占用的文件路径列表
     """
-    available_files = []
-    for root, _, files in os.walk(folder_path):
-        for file in files:
-            file_path = os.path.join(root, file)
-            try:
-                check_file_access(file_path)
-                available_files.append(file_path)
-            except FileLockedError:
-                # 如果文件被占用，跳过该文件
-                continue
-    return available_files
+    return [record.path for record in iter_available_files(folder_path, settle_seconds, max_workers, path_filter)]
@@ -0,0 +1,262 @@
+import os
+import json
+import time
+import logging
+import threading
+from datetime import datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+class StageStats:
+    """单个阶段的统计，可在多个线程中累加"""
+    def __init__(self, name):
+        self.name = name
+        self.files = 0
+        self.bytes = 0
+        self.retries = 0
+        self.errors = 0
+        self.seconds = 0.0
+        self.lock = threading.Lock()
+
+    def add(self, files=0, bytes=0, retries=0, errors=0, seconds=0.0):
+        with self.lock:
+            self.seconds += seconds
+            self.files += files
+            self.bytes += bytes
+            self.retries += retries
+            self.errors += errors
+
+    def to_dict(self):
+        return {
+            'seconds': round(self.seconds, 3),
+            'files': self.files,
+            'bytes': self.bytes,
+            'files_per_second': round(self.files / self.seconds, 3) if self.seconds else 0,
+            'bytes_per_second': round(self.bytes / self.seconds, 1) if self.seconds else 0,
+            'retries': self.retries,
+            'errors': self.errors
+        }
+
+class RunStats:
+    """一次任务运行的统计，按阶段记录"""
+    def __init__(self, metrics, sync_name):
+        self.metrics = metrics
+        self.sync_name = sync_name
+        self.stages = {}
+        self.start_time = None
+        self.start = None
+        self.error = None
+
+    def __enter__(self):
+        self.start_time = datetime.now()
+        self.start = time.monotonic()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_value is not None:
+            self.error = str(exc_value)
+        self.metrics.finish_run(self, time.monotonic() - self.start)
+        return False
+
+    def stage(self, name):
+        """记录一个阶段的耗时，with 块内可调用返回对象的 add() 累加文件数、字节数、重试和错误"""
+        return _StageContext(self.stage_stats(name))
+
+    def stage_stats(self, name):
+        """获取阶段的 StageStats，用于与其他阶段交错进行、需要自行累加耗时的阶段"""
+        return self.stages.setdefault(name, StageStats(name))
+
+class _StageContext:
+    def __init__(self, stats):
+        self.stats = stats
+
+    def __enter__(self):
+        self.start = time.monotonic()
+        return self.stats
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stats.add(seconds=time.monotonic() - self.start, errors=1 if exc_value is not None else 0)
+        return False
+
+class SyncMetrics:
+    """
+    同步任务指标
+
+    保存每个同步配置最近一次运行的各阶段统计，可写入滚动的 JSON 统计文件，
+    也可以通过 HTTP 以 Prometheus 文本格式导出
+    """
+    def __init__(self, stats_file=None, history=100):
+        self.stats_file = stats_file
+        self.history = history
+        self.lock = threading.Lock()
+        # {同步配置名称: 最近一次运行的记录}
+        self.last_runs = {}
+        # {(同步配置名称, 状态): 次数}
+        self.run_counts = {}
+        # {同步配置名称: 返回下次运行时间的函数}
+        self.next_run_providers = {}
+        self.runs = self._load_history()
+        self.server = None
+
+    @classmethod
+    def from_config(cls, config):
+        """
+        根据 config.json 的 Metrics 部分创建，配置了 port 时启动 HTTP 导出
+
+        :param config: 完整的配置字典
+        """
+        metrics_config = config.get('Metrics', {})
+        metrics = cls(metrics_config.get('stats_file', 'data/sync_stats.json'), metrics_config.get('history', 100))
+        if metrics_config.get('port'):
+            metrics.start_http_server(metrics_config['port'], metrics_config.get('host', '127.0.0.1'))
+        return metrics
+
+    def _load_history(self):
+        if not self.stats_file or not os.path.exists(self.stats_file):
+            return []
+        try:
+            with open(self.stats_file, 'r', encoding='utf-8') as f:
+                return json.load(f).get('runs', [])[-self.history:]
+        except (OSError, ValueError) as e:
+            logging.warning(f"无法读取统计文件 {self.stats_file}: {str(e)}")
+            return []
+
+    def run(self, sync_name):
+        """开始记录一次任务运行，作为上下文管理器使用"""
+        return RunStats(self, sync_name)
+
+    def set_next_run_provider(self, sync_name, provider):
+        """设置获取下次运行时间的函数，用于判断运行时间是否接近下一个调度时间"""
+        with self.lock:
+            self.next_run_providers[sync_name] = provider
+
+    def _next_run(self, sync_name):
+        provider = self.next_run_providers.get(sync_name)
+        if provider is None:
+            return None
+        try:
+            return provider()
+        except Exception:
+            return None
+
+    def finish_run(self, run, duration):
+        next_run = self._next_run(run.sync_name)
+        record = {
+            'sync': run.sync_name,
+            'start': run.start_time.isoformat(timespec='seconds'),
+            'duration_seconds': round(duration, 3),
+            'status': 'failed' if run.error else 'success',
+            'error': run.error,
+            'next_run': next_run.isoformat(timespec='seconds') if next_run else None,
+            'stages': {name: stats.to_dict() for name, stats in run.stages.items()}
+        }
+        with self.lock:
+            self.last_runs[run.sync_name] = (time.time(), record)
+            key = (run.sync_name, record['status'])
+            self.run_counts[key] = self.run_counts.get(key, 0) + 1
+            self.runs.append(record)
+            del self.runs[:-self.history]
+            runs = list(self.runs)
+
+        stage_summary = ', '.join(
+            f"{name} {stats['seconds']}秒/{stats['files']}个文件/{stats['bytes']}字节"
+            for name, stats in record['stages'].items()
+        )
+        logging.info(f"任务统计: {run.sync_name}, 耗时 {record['duration_seconds']} 秒, {stage_summary}")
+        if self.stats_file:
+            self._write_stats_file(runs)
+
+    def _write_stats_file(self, runs):
+        """先写临时文件再替换，读取方不会看到写了一半的文件"""
+        try:
+            directory = os.path.dirname(self.stats_file)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            temp_file = f"{self.stats_file}.tmp"
+            with open(temp_file, 'w', encoding='utf-8') as f:
+                json.dump({'updated': datetime.now().isoformat(timespec='seconds'), 'runs': runs},
+                          f, ensure_ascii=False, indent=2)
+            os.replace(temp_file, self.stats_file)
+        except OSError as e:
+            logging.error(f"写入统计文件失败: {self.stats_file}, 错误: {str(e)}")
+
+    def render_prometheus(self):
+        """以 Prometheus 文本格式导出每个同步配置最近一次运行的指标"""
+        with self.lock:
+            last_runs = dict(self.last_runs)
+            run_counts = dict(self.run_counts)
+            sync_names = set(last_runs) | set(self.next_run_providers)
+
+        lines = []
+
+        def metric(name, metric_type, help_text, samples):
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {metric_type}")
+            for labels, value in samples:
+                label_text = ','.join(f'{key}="{_escape_label(str(val))}"' for key, val in labels.items())
+                lines.append(f"{name}{{{label_text}}} {value}")
+
+        metric('webdavsync_runs_total', 'counter', 'Number of finished task runs',
+               [({'sync': sync_name, 'status': status}, count) for (sync_name, status), count in run_counts.items()])
+        metric('webdavsync_last_run_timestamp_seconds', 'gauge', 'Unix time the last run finished',
+               [({'sync': sync_name}, finished) for sync_name, (finished, _) in last_runs.items()])
+        metric('webdavsync_last_run_duration_seconds', 'gauge', 'Wall time of the last run',
+               [({'sync': sync_name}, record['duration_seconds']) for sync_name, (_, record) in last_runs.items()])
+        metric('webdavsync_last_run_success', 'gauge', '1 if the last run succeeded',
+               [({'sync': sync_name}, int(record['status'] == 'success'))
+                for sync_name, (_, record) in last_runs.items()])
+
+        next_runs = []
+        for sync_name in sync_names:
+            next_run = self._next_run(sync_name)
+            if next_run:
+                next_runs.append(({'sync': sync_name}, next_run.timestamp()))
+        metric('webdavsync_next_run_timestamp_seconds', 'gauge', 'Unix time of the next scheduled run', next_runs)
+
+        for field, help_text in (
+            ('seconds', 'Wall time of the stage in the last run'),
+            ('files', 'Files processed by the stage in the last run'),
+            ('bytes', 'Bytes processed by the stage in the last run'),
+            ('files_per_second', 'Files per second of the stage in the last run'),
+            ('bytes_per_second', 'Bytes per second of the stage in the last run'),
+            ('retries', 'Retries in the stage in the last run'),
+            ('errors', 'Errors in the stage in the last run'),
+        ):
+            name = 'webdavsync_stage_duration_seconds' if field == 'seconds' else f'webdavsync_stage_{field}'
+            metric(name, 'gauge', help_text, [
+                ({'sync': sync_name, 'stage': stage}, stats[field])
+                for sync_name, (_, record) in last_runs.items()
+                for stage, stats in record['stages'].items()
+            ])
+        return '\n'.join(lines) + '\n'
+
+    def start_http_server(self, port, host='127.0.0.1'):
+        """在后台线程中启动 /metrics 接口"""
+        metrics = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split('?')[0] not in ('/', '/metrics'):
+                    self.send_error(404)
+                    return
+                body = metrics.render_prometheus().encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.server = ThreadingHTTPServer((host, port), Handler)
+        self.server.daemon_threads = True
+        threading.Thread(target=self.server.serve_forever, name="metrics-http", daemon=True).start()
+        logging.info(f"已启动指标接口: http://{host}:{port}/metrics")
+
+    def stop(self):
+        if self.server:
+            self.server.shutdown()
+            self.server.server_close()
+
+def _escape_label(value):
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
@@ -1,14 +1,30 @@
 import pymysql
+import pymysql.cursors
 import os
+import queue
+import logging
+import hashlib
 import datetime
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
 class MySQLBackup:
-    def __init__(self, host='localhost', user='root', password='', port=3306):
+    def __init__(self, host='localhost', user='root', password='', port=3306,
+                 batch_rows=1000, max_statement_rows=1000, max_statement_bytes=1024 * 1024,
+                 workers=1, split_rows=1000000):
         self.host = host
         self.user = user
         self.password = password
         self.port = port
-        
+        # 流式导出时每次从服务器读取的行数
+        self.batch_rows = batch_rows
+        # 每条多行 INSERT 语句最多包含的行数和字节数，字节数应小于服务器的 max_allowed_packet
+        self.max_statement_rows = max_statement_rows
+        self.max_statement_bytes = max_statement_bytes
+        # 并行导出的连接数，所有连接共享同一个一致性快照
+        self.workers = max(1, workers)
+        # 估计行数超过该值且主键为单个整数列的表，按主键范围拆分给多个连接导出
+        self.split_rows = split_rows
+
     def get_connection(self):
         return pymysql.connect(
             host=self.host,
@@ -18,6 +34,361 @@ class MySQLBackup:
             charset='utf8mb4'
         )
 
+    def get_insert_columns(self, conn, database_name, table_name):
+        """
+        获取可以写入的列，排除生成列
+
+        只排除 VIRTUAL GENERATED / STORED GENERATED；MySQL 8 中带表达式默认值的普通列
+        （如 DEFAULT CURRENT_TIMESTAMP）的 EXTRA 是 DEFAULT_GENERATED，需要照常导出
+        :return: 列名列表，按表中的顺序
+        """
+        with conn.cursor() as cursor:
+            cursor.execute(
+                "SELECT COLUMN_NAME FROM information_schema.COLUMNS "
+                "WHERE TABLE_SCHEMA = %s AND TABLE_NAME = %s "
+                "AND EXTRA NOT IN ('VIRTUAL GENERATED', 'STORED GENERATED') "
+                "ORDER BY ORDINAL_POSITION",
+                (database_name, table_name)
+            )
+            return [row[0] for row in cursor.fetchall()]
+
+    @staticmethod
+    def sql_literal(conn, value):
+        """将值转换为SQL字面量，二进制数据使用十六进制，其余交给 pymysql 转义"""
+        if isinstance(value, (bytes, bytearray)):
+            return f"X'{bytes(value).hex()}'"
+        return conn.literal(value)
+
+    def dump_table_data(self, conn, database_name, table_name, f, where=None):
+        """
+        流式导出表数据为多行 INSERT 语句
+
+        使用服务器端游标分批读取，内存占用与表大小无关
+        :param conn: 数据库连接，导出期间不能在该连接上执行其他查询
+        :param database_name: 数据库名称
+        :param table_name: 表名
+        :param f: 写入的文本文件对象
+        :param where: 可选的 WHERE 条件
+        :return: 导出的行数
+        """
+        columns = self.get_insert_columns(conn, database_name, table_name)
+        column_sql = ', '.join(f"`{column}`" for column in columns)
+        insert_prefix = f"INSERT INTO `{table_name}` ({column_sql}) VALUES\n"
+
+        row_count = 0
+        values = []
+        values_bytes = 0
+
+        def write_statement():
+            f.write(insert_prefix + ',\n'.join(values) + ';\n')
+
+        with conn.cursor(pymysql.cursors.SSCursor) as cursor:
+            sql = f"SELECT {column_sql} FROM `{database_name}`.`{table_name}`"
+            if where:
+                sql += f" WHERE {where}"
+            cursor.execute(sql)
+            while True:
+                rows = cursor.fetchmany(self.batch_rows)
+                if not rows:
+                    break
+                for row in rows:
+                    row_sql = '(' + ', '.join(self.sql_literal(conn, value) for value in row) + ')'
+                    # 按 UTF-8 编码后的字节数计算，与还原时 max_allowed_packet 的限制一致
+                    row_bytes = len(row_sql.encode('utf-8'))
+                    # 达到行数或字节数上限时写出当前语句
+                    if values and (len(values) >= self.max_statement_rows
+                                   or values_bytes + row_bytes > self.max_statement_bytes):
+                        write_statement()
+                        values = []
+                        values_bytes = 0
+                    values.append(row_sql)
+                    values_bytes += row_bytes + 2
+                    row_count += 1
+
+        if values:
+            write_statement()
+        return row_count
+
+    def open_snapshot_connections(self, count):
+        """
+        打开 count 个连接，并在同一时刻开启一致性快照事务
+
+        多个连接时先用 FLUSH TABLES WITH READ LOCK 阻止写入，所有连接开启快照后再解锁，
+        这样各连接看到的数据完全相同；没有 RELOAD 权限时退化为依次开启快照
+        :param count: 连接数
+        :return: 连接列表
+        """
+        connections = []
+        lock_conn = None
+        try:
+            for _ in range(count):
+                connections.append(self.get_connection())
+            if count > 1:
+                lock_conn = self.get_connection()
+                try:
+                    with lock_conn.cursor() as cursor:
+                        cursor.execute("FLUSH TABLES WITH READ LOCK")
+                except pymysql.MySQLError as e:
+                    logging.warning(f"无法获取全局读锁，各连接的快照可能不完全一致：{str(e)}")
+                    lock_conn.close()
+                    lock_conn = None
+            for conn in connections:
+                with conn.cursor() as cursor:
+                    cursor.execute("SET SESSION TRANSACTION ISOLATION LEVEL REPEATABLE READ")
+                    cursor.execute("START TRANSACTION WITH CONSISTENT SNAPSHOT")
+        except Exception:
+            for conn in connections:
+                conn.close()
+            raise
+        finally:
+            if lock_conn:
+                with lock_conn.cursor() as cursor:
+                    cursor.execute("UNLOCK TABLES")
+                lock_conn.close()
+        return connections
+
+    def split_table(self, conn, database_name, table_name):
+        """
+        按主键范围拆分大表
+
+        :return: (估计行数, WHERE 条件列表)，不需要或无法拆分时条件列表为 [None]
+        """
+        with conn.cursor() as cursor:
+            cursor.execute(
+                "SELECT TABLE_ROWS FROM information_schema.TABLES WHERE TABLE_SCHEMA = %s AND TABLE_NAME = %s",
+                (database_name, table_name)
+            )
+            row = cursor.fetchone()
+            estimated_rows = int(row[0] or 0) if row else 0
+            if self.workers <= 1 or estimated_rows <= self.split_rows:
+                return estimated_rows, [None]
+
+            cursor.execute(
+                "SELECT COLUMN_NAME, DATA_TYPE FROM information_schema.COLUMNS "
+                "WHERE TABLE_SCHEMA = %s AND TABLE_NAME = %s AND COLUMN_KEY = 'PRI'",
+                (database_name, table_name)
+            )
+            primary_keys = cursor.fetchall()
+            # 只拆分单列整数主键的表
+            if len(primary_keys) != 1 or primary_keys[0][1].lower() not in (
+                    'tinyint', 'smallint', 'mediumint', 'int', 'bigint'):
+                return estimated_rows, [None]
+            key = primary_keys[0][0]
+
+            cursor.execute(f"SELECT MIN(`{key}`), MAX(`{key}`) FROM `{database_name}`.`{table_name}`")
+            min_id, max_id = cursor.fetchone()
+            if min_id is None:
+                return estimated_rows, [None]
+
+        parts = (estimated_rows + self.split_rows - 1) // self.split_rows
+        step = (max_id - min_id) // parts + 1
+        conditions = []
+        # 拆分在开启快照之前完成，首尾两段不设边界，之后插入的超出范围的行也能导出
+        bounds = list(range(min_id + step, max_id + 1, step))
+        for index in range(len(bounds) + 1):
+            lower = f"`{key}` >= {bounds[index - 1]}" if index > 0 else None
+            upper = f"`{key}` < {bounds[index]}" if index < len(bounds) else None
+            conditions.append(' AND '.join(filter(None, (lower, upper))) or None)
+        return estimated_rows, conditions
+
+    def dump_tables(self, database_name, table_names, write_output, skip_tables=()):
+        """
+        并行导出多个表的数据，每个表（或大表的每个主键范围）写入单独的文件
+
+        :param database_name: 数据库名称
+        :param table_names: 表名列表，序号决定数据文件的顺序
+        :param write_output: 输出函数，见 dump_database
+        :param skip_tables: 不需要导出的表，序号保持不变
+        :return: (导出的总行数, {表名: [数据文件名]})
+        """
+        # 拆分任务，估计行数多的任务先执行，避免大表最后才开始
+        tasks = []
+        table_files = {}
+        with self.get_connection() as conn:
+            for index, table_name in enumerate(table_names, 1):
+                if table_name in skip_tables:
+                    continue
+                estimated_rows, conditions = self.split_table(conn, database_name, table_name)
+                for part, where in enumerate(conditions, 1):
+                    file_name = f'{index}_data_{table_name}.sql' if len(conditions) == 1 \
+                        else f'{index}_data_{table_name}_{part:04d}.sql'
+                    tasks.append((estimated_rows // len(conditions), table_name, where, file_name))
+                    table_files.setdefault(table_name, []).append(file_name)
+        if not tasks:
+            return 0, table_files
+        tasks.sort(key=lambda task: task[0], reverse=True)
+
+        connections = self.open_snapshot_connections(min(self.workers, len(tasks)))
+        try:
+            # 连接池，每个任务借用一个连接，保证同一连接不会被两个线程同时使用
+            pool = queue.Queue()
+            for conn in connections:
+                pool.put(conn)
+
+            def write_data_file(conn, table_name, where, f):
+                f.write(f"USE `{database_name}`;\n")
+                f.write("SET NAMES utf8mb4;\n")
+                f.write("SET FOREIGN_KEY_CHECKS=0;\n")
+                f.write("SET UNIQUE_CHECKS=0;\n\n")
+
+                row_count = self.dump_table_data(conn, database_name, table_name, f, where)
+
+                f.write("\nSET FOREIGN_KEY_CHECKS=1;\n")
+                f.write("SET UNIQUE_CHECKS=1;\n")
+                return row_count
+
+            def run(table_name, where, file_name):
+                conn = pool.get()
+                try:
+                    return write_output(file_name, lambda f: write_data_file(conn, table_name, where, f))
+                finally:
+                    pool.put(conn)
+
+            total_rows = 0
+            with ThreadPoolExecutor(max_workers=len(connections)) as executor:
+                futures = {executor.submit(run, table_name, where, file_name): file_name
+                           for _, table_name, where, file_name in tasks}
+                for done, future in enumerate(as_completed(futures), 1):
+                    row_count = future.result()
+                    total_rows += row_count
+                    logging.info(f"已备份表数据 ({done}/{len(tasks)}): {futures[future]}，{row_count} 行")
+            return total_rows, table_files
+        finally:
+            # 快照事务只读，关闭连接即结束事务
+            for conn in connections:
+                conn.close()
+
+    def write_structure(self, cursor, database_name, f):
+        """
+        写入数据库结构（建库语句、表结构、视图、存储过程）
+
+        :param cursor: 已选择该数据库的游标
+        :param database_name: 数据库名称
+        :param f: 写入的文本文件对象
+        :return: 表名列表
+        """
+        # 获取数据库信息
+        cursor.execute(f"SELECT @@character_set_database, @@collation_database")
+        charset, collation = cursor.fetchone()
+        
+        cursor.execute(f"SELECT SCHEMA_NAME, DEFAULT_ENCRYPTION FROM information_schema.SCHEMATA WHERE SCHEMA_NAME = '{database_name}'")
+        _, encryption = cursor.fetchone()
+        encryption = 'Y' if encryption.upper() == 'YES' else 'N'
+        
+        # 写入数据库创建语句
+        create_db_sql = (
+            f"CREATE DATABASE /*!32312 IF NOT EXISTS*/ `{database_name}` "
+            f"/*!40100 DEFAULT CHARACTER SET {charset} COLLATE {collation} */ "
+            f"/*!80016 DEFAULT ENCRYPTION='{encryption}' */;\n"
+            f"USE `{database_name}`;\n\n"
+        )
+        f.write(create_db_sql)
+        
+        # 写入表结构
+        cursor.execute("SHOW FULL TABLES WHERE Table_type = 'BASE TABLE'")
+        tables = cursor.fetchall()
+        logging.info(f"开始备份数据库 {database_name}，共有 {len(tables)} 个表")
+        
+        for table in tables:
+            table_name = table[0]
+            cursor.execute(f"SHOW CREATE TABLE `{table_name}`")
+            create_table = cursor.fetchone()[1]
+            f.write(f"{create_table};\n\n")
+        
+        # 写入视图
+        f.write("\n-- Views\n")
+        cursor.execute("SHOW FULL TABLES WHERE Table_type = 'VIEW'")
+        views = cursor.fetchall()
+        for view in views:
+            view_name = view[0]
+            cursor.execute(f"SHOW CREATE VIEW `{view_name}`")
+            create_view = cursor.fetchone()[1]
+            f.write(f"{create_view};\n\n")
+        
+        # 写入存储过程和函数
+        f.write("\n-- Routines\n")
+        cursor.execute("SHOW PROCEDURE STATUS WHERE Db = %s", (database_name,))
+        procedures = cursor.fetchall()
+        for proc in procedures:
+            proc_name = proc[1]
+            cursor.execute(f"SHOW CREATE PROCEDURE `{proc_name}`")
+            create_proc = cursor.fetchone()[2]
+            f.write(f"DELIMITER //\n{create_proc}//\nDELIMITER ;\n\n")
+
+        return [table[0] for table in tables]
+
+    def get_table_signatures(self, database_name, table_names, change_detection='checksum'):
+        """
+        计算每个表的变化签名，签名与上次相同的表视为未变化
+
+        签名包含建表语句的哈希，表结构变化时也会重新导出
+        :param database_name: 数据库名称
+        :param table_names: 表名列表
+        :param change_detection: checksum 使用 CHECKSUM TABLE（需要读取整表，但结果可靠）；
+                                 update_time 使用 information_schema.TABLES 的 UPDATE_TIME 和 TABLE_ROWS，
+                                 UPDATE_TIME 为空（例如 InnoDB 重启后）的表退回 CHECKSUM TABLE
+        :return: {表名: 签名}，无法计算的表签名为 None
+        """
+        update_times = {}
+        signatures = {}
+        with self.get_connection() as conn:
+            with conn.cursor() as cursor:
+                if change_detection == 'update_time':
+                    cursor.execute(
+                        "SELECT TABLE_NAME, UPDATE_TIME, TABLE_ROWS FROM information_schema.TABLES "
+                        "WHERE TABLE_SCHEMA = %s AND TABLE_TYPE = 'BASE TABLE'",
+                        (database_name,)
+                    )
+                    for table_name, update_time, table_rows in cursor.fetchall():
+                        if update_time is not None:
+                            update_times[table_name] = f"update_time:{update_time.isoformat()}:{table_rows}"
+
+                for table_name in table_names:
+                    cursor.execute(f"SHOW CREATE TABLE `{database_name}`.`{table_name}`")
+                    structure_hash = hashlib.md5(cursor.fetchone()[1].encode('utf-8')).hexdigest()
+                    data_signature = update_times.get(table_name)
+                    if data_signature is None:
+                        cursor.execute(f"CHECKSUM TABLE `{database_name}`.`{table_name}`")
+                        checksum = cursor.fetchone()[1]
+                        data_signature = f"checksum:{checksum}" if checksum is not None else None
+                    signatures[table_name] = f"{structure_hash}:{data_signature}" if data_signature else None
+        return signatures
+
+    def dump_database(self, database_name, write_output, previous_signatures=None, change_detection='checksum'):
+        """
+        导出数据库的结构和数据，输出位置由 write_output 决定
+
+        :param database_name: 数据库名称
+        :param write_output: write_output(file_name, write_func)，打开名为 file_name 的文本输出，
+                             调用 write_func(f) 写入并返回其结果；多个表并行导出时会被同时调用
+        :param previous_signatures: 上次备份时的表签名，传入时签名没有变化的表不导出数据
+        :param change_detection: 计算签名的方式，见 get_table_signatures
+        :return: {'rows': 导出的总行数, 'files': {表名: [数据文件名]},
+                  'signatures': {表名: 签名}, 'skipped': [未导出的表名]}
+        """
+        # 1. 数据库结构文件（包含表结构、视图、函数）
+        with self.get_connection() as conn:
+            with conn.cursor() as cursor:
+                cursor.execute(f"USE `{database_name}`")
+                table_names = write_output('0_structure.sql',
+                                           lambda f: self.write_structure(cursor, database_name, f))
+
+        # 签名在开启快照之前计算，期间发生的修改会让下次签名不同，不会漏备份
+        signatures = {}
+        skipped = []
+        if previous_signatures is not None:
+            signatures = self.get_table_signatures(database_name, table_names, change_detection)
+            skipped = [
+                table_name for table_name in table_names
+                if signatures[table_name] is not None and previous_signatures.get(table_name) == signatures[table_name]
+            ]
+            if skipped:
+                logging.info(f"数据库 {database_name} 中有 {len(skipped)} 个表没有变化，跳过导出")
+
+        # 2. 为每个表创建单独的数据文件，多个连接共享同一个一致性快照
+        total_rows, table_files = self.dump_tables(database_name, table_names, write_output, set(skipped))
+        return {'rows': total_rows, 'files': table_files, 'signatures': signatures, 'skipped': skipped}
+
     def backup_database(self, database_name, backup_path='./backups/', tag=None):
         # 创建备份目录结构
         timestamp = datetime.datetime.now().strftime('%Y%m%d_%H%M%S')
@@ -25,100 +396,14 @@ class MySQLBackup:
         if tag:
             backup_dir = os.path.join(backup_path, f'{tag}_{database_name}_{timestamp}')
         os.makedirs(backup_dir, exist_ok=True)
+
+        def write_output(file_name, write_func):
+            with open(os.path.join(backup_dir, file_name), 'w', encoding='utf8') as f:
+                return write_func(f)
+
+        self.dump_database(database_name, write_output)
         
-        with self.get_connection() as conn:
-            with conn.cursor() as cursor:
-                # 先选择数据库
-                cursor.execute(f"USE `{database_name}`")
-                
-                # 然后获取数据库信息
-                cursor.execute(f"SELECT @@character_set_database, @@collation_database")
-                charset, collation = cursor.fetchone()
-                
-                cursor.execute(f"SELECT SCHEMA_NAME, DEFAULT_ENCRYPTION FROM information_schema.SCHEMATA WHERE SCHEMA_NAME = '{database_name}'")
-                _, encryption = cursor.fetchone()
-                encryption = 'Y' if encryption.upper() == 'YES' else 'N'
-                
-                # 1. 创建数据库结构文件（包含表结构、视图、函数）
-                structure_file = os.path.join(backup_dir, '0_structure.sql')
-                with open(structure_file, 'w', encoding='utf8') as f:
-                    # 写入数据库创建语句
-                    create_db_sql = (
-                        f"CREATE DATABASE /*!32312 IF NOT EXISTS*/ `{database_name}` "
-                        f"/*!40100 DEFAULT CHARACTER SET {charset} COLLATE {collation} */ "
-                        f"/*!80016 DEFAULT ENCRYPTION='{encryption}' */;\n"
-                        f"USE `{database_name}`;\n\n"
-                    )
-                    f.write(create_db_sql)
-                    
-                    # 写入表结构
-                    cursor.execute("SHOW FULL TABLES WHERE Table_type = 'BASE TABLE'")
-                    tables = cursor.fetchall()
-                    total_tables = len(tables)
-                    print(f"\n开始备份数据库 {database_name}，共有 {total_tables} 个表")
-                    
-                    for table in tables:
-                        table_name = table[0]
-                        cursor.execute(f"SHOW CREATE TABLE `{table_name}`")
-                        create_table = cursor.fetchone()[1]
-                        f.write(f"{create_table};\n\n")
-                    
-                    # 写入视图
-                    f.write("\n-- Views\n")
-                    cursor.execute("SHOW FULL TABLES WHERE Table_type = 'VIEW'")
-                    views = cursor.fetchall()
-                    for view in views:
-                        view_name = view[0]
-                        cursor.execute(f"SHOW CREATE VIEW `{view_name}`")
-                        create_view = cursor.fetchone()[1]
-                        f.write(f"{create_view};\n\n")
-                    
-                    # 写入存储过程和函数
-                    f.write("\n-- Routines\n")
-                    cursor.execute("SHOW PROCEDURE STATUS WHERE Db = %s", (database_name,))
-                    procedures = cursor.fetchall()
-                    for proc in procedures:
-                        proc_name = proc[1]
-                        cursor.execute(f"SHOW CREATE PROCEDURE `{proc_name}`")
-                        create_proc = cursor.fetchone()[2]
-                        f.write(f"DELIMITER //\n{create_proc}//\nDELIMITER ;\n\n")
-                
-                # 2. 为每个表创建单独的数据文件
-                for index, table in enumerate(tables, 1):
-                    table_name = table[0]
-                    print(f"正在备份表数据 ({index}/{total_tables}): {table_name}")
-                    
-                    data_file = os.path.join(backup_dir, f'{index}_data_{table_name}.sql')
-                    with open(data_file, 'w', encoding='utf8') as f:
-                        f.write(f"USE `{database_name}`;\n")
-                        f.write("SET FOREIGN_KEY_CHECKS=0;\n")
-                        f.write("SET UNIQUE_CHECKS=0;\n\n")
-                        
-                        cursor.execute(f"SELECT * FROM `{table_name}`")
-                        rows = cursor.fetchall()
-                        
-                        if rows:
-                            cursor.execute(f"SHOW COLUMNS FROM `{table_name}`")
-                            columns = [column[0] for column in cursor.fetchall()]
-                            
-                            for row in rows:
-                                values = []
-                                for value in row:
-                                    if value is None:
-                                        values.append('NULL')
-                                    elif isinstance(value, (int, float)):
-                                        values.append(str(value))
-                                    else:
-                                        values.append(f"'{str(value)}'")
-                                
-                                f.write(f"INSERT INTO `{table_name}` "
-                                       f"({', '.join(['`'+c+'`' for c in columns])}) "
-                                       f"VALUES ({', '.join(values)});\n")
-                    
-                        f.write("\nSET FOREIGN_KEY_CHECKS=1;\n")
-                        f.write("SET UNIQUE_CHECKS=1;\n")
-        
-        print(f'\n数据库 {database_name} 备份成功！备份目录：{backup_dir}')
+        logging.info(f'数据库 {database_name} 备份成功！备份目录：{backup_dir}')
         return backup_dir
 
         """
@@ -172,11 +457,11 @@ class MySQLBackup:
                                        f"({', '.join(['`'+c+'`' for c in columns])}) "
                                        f"VALUES ({', '.join(values)});\n")
                                 
-            print(f'数据表 {database_name}.{table_name} 备份成功！备份文件：{backup_file}')
+            logging.info(f'数据表 {database_name}.{table_name} 备份成功！备份文件：{backup_file}')
             return backup_file
             
         except Exception as e:
-            print(f'备份失败：{str(e)}')
+            logging.error(f'备份失败：{str(e)}')
             return None
 
     def get_user_databases(self):
@@ -196,7 +481,7 @@ class MySQLBackup:
                     user_databases = [db[0] for db in databases if db[0] not in system_databases]
                     return user_databases
         except Exception as e:
-            print(f'获取数据库列表失败：{str(e)}')
+            logging.error(f'获取数据库列表失败：{str(e)}')
             return []
 
     def backup_all_user_databases(self, backup_path='./backups/', tag=None):
@@ -217,6 +502,7 @@ class MySQLBackup:
         return backup_files
 
 if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
     # 据库连接配置
     configs = [
         {
@@ -0,0 +1,120 @@
+import os
+import time
+import logging
+import threading
+from datetime import datetime
+import pytz
+from webdav3.client import WebDavXmlUtils
+from webdav3.exceptions import RemoteResourceNotFound
+from webdav3.urn import Urn
+
+def _split_remote_path(remote_path):
+    """拆分为 (目录, 文件名)，目录不带结尾斜杠"""
+    remote_path = remote_path.replace('\\', '/').rstrip('/')
+    directory, name = remote_path.rsplit('/', 1) if '/' in remote_path else ('', remote_path)
+    return directory or '/', name
+
+def _normalize_directory(remote_directory):
+    return remote_directory.replace('\\', '/').rstrip('/') or '/'
+
+def parse_modified(modified_time_str):
+    """解析 getlastmodified，失败时返回None"""
+    if not modified_time_str:
+        return None
+    try:
+        modified_time = datetime.strptime(modified_time_str, "%a, %d %b %Y %H:%M:%S %Z")
+        return modified_time.replace(tzinfo=pytz.UTC)
+    except ValueError:
+        return None
+
+class RemoteInventory:
+    """
+    远程目录清单缓存
+
+    一次 PROPFIND（Depth: 1）获取整个目录的文件名、大小、修改时间和 ETag，
+    在 TTL 内直接使用缓存；本程序自己的上传和删除会同步更新缓存。
+    """
+    def __init__(self, webdav_client, ttl=300):
+        self.webdav_client = webdav_client
+        self.ttl = ttl
+        self.lock = threading.RLock()
+        # {目录: (获取时间, {文件名: 信息})}
+        self.directories = {}
+
+    def _fetch(self, remote_directory):
+        """从服务器获取目录清单"""
+        directory_urn = Urn(remote_directory, directory=True)
+        try:
+            response = self.webdav_client.execute_request(action='list', path=directory_urn.quote())
+        except RemoteResourceNotFound:
+            return {}
+        path = Urn.normalize_path(self.webdav_client.get_full_path(directory_urn))
+        entries = {}
+        for info in WebDavXmlUtils.parse_get_list_info_response(response.content):
+            if Urn.compare_path(path, info.get('path')):
+                continue
+            name = os.path.basename(info['path'].rstrip('/'))
+            entries[name] = {
+                'name': name,
+                'size': int(info['size']) if info.get('size') else None,
+                'modified': parse_modified(info.get('modified')),
+                'created': info.get('created'),
+                'etag': info.get('etag'),
+                'is_dir': info.get('isdir', False)
+            }
+        return entries
+
+    def list(self, remote_directory, refresh=False):
+        """
+        获取目录清单，缓存过期或 refresh 为 True 时重新获取
+
+        :param remote_directory: 远程目录路径
+        :param refresh: 是否忽略缓存
+        :return: {文件名: {'name', 'size', 'modified', 'created', 'etag', 'is_dir'}}
+        """
+        remote_directory = _normalize_directory(remote_directory)
+        with self.lock:
+            cached = self.directories.get(remote_directory)
+            if not refresh and cached and time.time() - cached[0] < self.ttl:
+                return dict(cached[1])
+        entries = self._fetch(remote_directory)
+        with self.lock:
+            self.directories[remote_directory] = (time.time(), entries)
+        logging.info(f"已获取远程目录清单: {remote_directory}, 共 {len(entries)} 项")
+        return dict(entries)
+
+    def get(self, remote_path):
+        """获取单个远程文件的信息，不存在时返回None"""
+        directory, name = _split_remote_path(remote_path)
+        return self.list(directory).get(name)
+
+    def note_uploaded(self, remote_path, size=None, etag=None, is_dir=False):
+        """本程序上传完成后更新缓存"""
+        directory, name = _split_remote_path(remote_path)
+        with self.lock:
+            cached = self.directories.get(_normalize_directory(directory))
+            if cached:
+                cached[1][name] = {
+                    'name': name,
+                    'size': size,
+                    'modified': datetime.now(pytz.UTC),
+                    'created': None,
+                    'etag': etag,
+                    'is_dir': is_dir
+                }
+
+    def note_deleted(self, remote_path):
+        """本程序删除远程文件后更新缓存"""
+        directory, name = _split_remote_path(remote_path)
+        with self.lock:
+            cached = self.directories.get(_normalize_directory(directory))
+            if cached:
+                cached[1].pop(name, None)
+
+    def invalidate(self, remote_directory=None):
+        """使缓存失效，remote_directory 为 None 时清空全部"""
+        with self.lock:
+            if remote_directory is None:
+                self.directories.clear()
+            else:
+                self.directories.pop(_normalize_directory(remote_directory), None)
@@ -0,0 +1,244 @@
+import os
+import time
+import queue
+import hashlib
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, as_completed, wait
+
+class UploadFailedError(Exception):
+    """文件多次重试后仍然上传失败时抛出的异常"""
+    pass
+
+def upload_with_retry(client, local_path, remote_directory, retries=3, backoff=2, db_manager=None, on_retry=None):
+    """
+    上传单个文件，失败时按指数退避重试
+
+    :param client: WebDAVSyncClient 实例
+    :param local_path: 本地文件路径
+    :param remote_directory: 远程目录路径
+    :param retries: 失败后的最大重试次数
+    :param backoff: 首次重试前等待的秒数，之后每次翻倍
+    :param db_manager: 可选的 DatabaseManager，用于记录分块上传进度
+    :param on_retry: 可选的回调，每次重试前调用，参数为本地文件路径
+    :return: 远程文件路径
+    :raises UploadFailedError: 所有重试都失败时抛出，消息中包含最后一次的错误，__cause__ 为最后一次的异常
+    """
+    last_error = None
+    for attempt in range(retries + 1):
+        try:
+            return client.sync_file(local_path, remote_directory, db_manager)
+        except Exception as e:
+            last_error = e
+        if attempt < retries:
+            delay = backoff * (2 ** attempt)
+            logging.warning(f"上传失败，{delay} 秒后进行第 {attempt + 1} 次重试: {local_path}, 错误: {str(last_error)}")
+            if on_retry:
+                on_retry(local_path)
+            time.sleep(delay)
+    raise UploadFailedError(
+        f"文件 {local_path} 重试 {retries} 次后仍然上传失败: {type(last_error).__name__}: {str(last_error)}"
+    ) from last_error
+
+def upload_files(client, file_list, remote_directory, max_workers=4, retries=3, backoff=2, db_manager=None,
+                 on_retry=None, on_submit=None):
+    """
+    使用有界线程池并发上传文件
+
+    按完成顺序逐个返回结果，调用方可以在每个文件完成时立即记录状态。
+    file_list 按需读取，在途的文件数有上限，传入生成器时可以一边产生文件一边上传。
+
+    :param client: WebDAVSyncClient 实例
+    :param file_list: 本地文件路径的可迭代对象
+    :param remote_directory: 远程目录路径
+    :param max_workers: 同时上传的文件数
+    :param retries: 单个文件失败后的最大重试次数
+    :param backoff: 首次重试前等待的秒数
+    :param db_manager: 可选的 DatabaseManager，用于记录分块上传进度
+    :param on_retry: 可选的回调，每次重试前调用
+    :param on_submit: 可选的回调，文件提交给线程池时在调用方线程中调用，参数为本地文件路径
+    :return: 生成器，产出 (本地路径, 远程路径, 异常)，成功时异常为None，失败时远程路径为None
+    """
+    if not file_list:
+        return
+
+    def result(future):
+        file_path = futures.pop(future)
+        try:
+            return file_path, future.result(), None
+        except Exception as e:
+            return file_path, None, e
+
+    futures = {}
+    max_pending = max(1, max_workers) * 2
+    with ThreadPoolExecutor(max_workers=max(1, max_workers)) as executor:
+        for file_path in file_list:
+            futures[executor.submit(upload_with_retry, client, file_path, remote_directory, retries, backoff,
+                                    db_manager, on_retry)] = file_path
+            if on_submit:
+                on_submit(file_path)
+            if len(futures) >= max_pending:
+                done, _ = wait(futures, return_when=FIRST_COMPLETED)
+                for future in done:
+                    yield result(future)
+        for future in as_completed(list(futures)):
+            yield result(future)
+
+class HashingReader:
+    """
+    作为上传请求体的文件包装对象，读取的同时计算 SHA-256 和 MD5
+
+    上传和计算校验和只读一遍文件；最多读取 size 字节，上传过程中文件变长也不会超出 Content-Length
+    """
+    def __init__(self, fileobj, size):
+        self.fileobj = fileobj
+        self.size = size
+        self.bytes_read = 0
+        self.sha256 = hashlib.sha256()
+        self.md5 = hashlib.md5(usedforsecurity=False)
+
+    def __len__(self):
+        return self.size
+
+    def read(self, size=-1):
+        remaining = self.size - self.bytes_read
+        if size is None or size < 0 or size > remaining:
+            size = remaining
+        data = self.fileobj.read(size)
+        self.sha256.update(data)
+        self.md5.update(data)
+        self.bytes_read += len(data)
+        return data
+
+class StreamPipe:
+    """
+    连接压缩线程和上传线程的有界管道
+
+    写入端是 ZipFile 使用的类文件对象（不可 seek，zipfile 会改用数据描述符）；
+    读取端是作为 PUT 请求体的生成器。队列满时写入端阻塞，从而对压缩形成背压。
+    可选地把同一份数据写入本地副本，并顺带计算大小和 SHA-256。
+    """
+    def __init__(self, chunk_size=1024 * 1024, max_chunks=8, local_copy_path=None):
+        self.chunk_size = chunk_size
+        self.queue = queue.Queue(maxsize=max(1, max_chunks))
+        self.buffer = bytearray()
+        self.local_copy = open(local_copy_path, 'wb') if local_copy_path else None
+        self.sha256 = hashlib.sha256()
+        self.size = 0
+        self.error = None
+        self.closed = False
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        if self.error is not None:
+            raise self.error
+        self.buffer += data
+        if len(self.buffer) >= self.chunk_size:
+            self._put(bytes(self.buffer))
+            self.buffer.clear()
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def _put(self, chunk):
+        self.sha256.update(chunk)
+        self.size += len(chunk)
+        if self.local_copy:
+            self.local_copy.write(chunk)
+        # 定时检查上传端是否已经失败，避免永久阻塞
+        while True:
+            if self.error is not None:
+                raise self.error
+            try:
+                self.queue.put(chunk, timeout=1)
+                return
+            except queue.Full:
+                continue
+
+    def close(self, error=None):
+        """写入结束；error 不为空时通知上传端中止"""
+        if self.closed:
+            return
+        self.closed = True
+        try:
+            if error is None and self.buffer:
+                self._put(bytes(self.buffer))
+            self.buffer.clear()
+        finally:
+            if self.local_copy:
+                self.local_copy.close()
+            if error is not None and self.error is None:
+                self.error = error
+            self._put_end()
+
+    def _put_end(self):
+        while True:
+            try:
+                self.queue.put(None, timeout=1)
+                return
+            except queue.Full:
+                if self.error is not None:
+                    return
+
+    def abort(self, error):
+        """上传端失败时调用，写入端下一次写入会抛出该异常"""
+        self.error = error
+        # 清空队列，让阻塞中的写入端尽快醒来
+        try:
+            while True:
+                self.queue.get_nowait()
+        except queue.Empty:
+            pass
+
+    def iter_chunks(self):
+        """作为请求体使用的生成器"""
+        while True:
+            chunk = self.queue.get()
+            if chunk is None:
+                if self.error is not None:
+                    raise self.error
+                return
+            yield chunk
+
+    @property
+    def hexdigest(self):
+        return self.sha256.hexdigest()
+
+def stream_upload(client, remote_path, write_func, chunk_size=1024 * 1024, max_chunks=8, local_copy_path=None):
+    """
+    一边生成数据一边上传，生成和上传在两个线程中进行
+
+    :param client: WebDAVSyncClient 实例
+    :param remote_path: 远程文件路径
+    :param write_func: 接收一个类文件对象并向其写入全部数据的函数
+    :param chunk_size: 每次上传的块大小
+    :param max_chunks: 管道中最多缓存的块数
+    :param local_copy_path: 可选的本地副本路径
+    :return: StreamPipe，可从中读取大小和哈希
+    """
+    pipe = StreamPipe(chunk_size, max_chunks, local_copy_path)
+    upload_errors = []
+
+    def upload():
+        try:
+            client.upload_stream(pipe.iter_chunks(), remote_path)
+        except Exception as e:
+            upload_errors.append(e)
+            pipe.abort(e)
+
+    upload_thread = threading.Thread(target=upload, name=f"stream-upload-{os.path.basename(remote_path)}")
+    upload_thread.start()
+    try:
+        write_func(pipe)
+        pipe.close()
+    except Exception as e:
+        pipe.close(e)
+        raise
+    finally:
+        upload_thread.join()
+    if upload_errors:
+        raise upload_errors[0]
+    return pipe
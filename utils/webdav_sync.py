@@ -1,12 +1,40 @@
 import os
 import time
+import hashlib
 import logging
 import json
+import threading
+from xml.etree import ElementTree
 from webdav3.client import Client
-from watchdog.observers import Observer
+from webdav3.urn import Urn
+from webdav3.exceptions import RemoteResourceNotFound
 from watchdog.events import FileSystemEventHandler
-from datetime import datetime
-import pytz
+from utils.remote_inventory import RemoteInventory
+from utils.local_file_handler import probe_ready_files
+from utils.coordinator import BandwidthLimiter, ThrottledReader
+from utils.upload_engine import HashingReader
+from utils.http_transport import configure_client
+
+# 上传后校验只请求大小、ETag 和校验和（ownCloud/Nextcloud 的 oc:checksums）
+VERIFY_PROPFIND_BODY = (
+    '<?xml version="1.0" encoding="utf-8"?>'
+    '<d:propfind xmlns:d="DAV:" xmlns:oc="http://owncloud.org/ns">'
+    '<d:prop><d:getcontentlength/><d:getetag/><oc:checksums/></d:prop>'
+    '</d:propfind>'
+).encode('utf-8')
+
+class UploadVerificationError(Exception):
+    """上传后远程文件的大小、ETag 或校验和与本地不一致时抛出的异常"""
+    pass
+
+def _normalize_etag(etag):
+    """去掉弱校验前缀和引号"""
+    if not etag:
+        return None
+    etag = etag.strip()
+    if etag.startswith('W/'):
+        etag = etag[2:]
+    return etag.strip('"')
 
 class WebDAVSyncClient:
     def __init__(self, config_file):
@@ -19,6 +47,28 @@ class WebDAVSyncClient:
             'webdav_password': self.config['WebDAV']['password']
         }
         self.webdav_client = Client(self.webdav_options)
+        # 所有任务共享一个 keep-alive 连接池，可选 HTTP/2
+        self.http_adapter = configure_client(self.webdav_client, self.config['WebDAV'])
+        # 限制同一WebDAV主机上同时进行的上传数，所有同步任务共享
+        self.upload_semaphore = threading.BoundedSemaphore(
+            self.config['WebDAV'].get('max_concurrent_uploads', 8)
+        )
+        # 大文件分块上传配置，chunk_upload_mode 为空时整文件上传
+        # content_range: 使用 PUT + Content-Range 续传到同一个远程文件
+        # parts: 每个分块作为独立文件上传到 <远程文件>.parts 目录，并写入 manifest.json
+        self.chunk_upload_mode = self.config['WebDAV'].get('chunk_upload_mode', '')
+        self.chunk_size = int(self.config['WebDAV'].get('chunk_size_mb', 8) * 1024 * 1024)
+        self.chunk_upload_threshold = int(self.config['WebDAV'].get('chunk_upload_threshold_mb', 64) * 1024 * 1024)
+        # 远程目录清单缓存，清理、跳过上传等检查都从这里读取
+        self.inventory = RemoteInventory(self.webdav_client, self.config['WebDAV'].get('inventory_ttl_seconds', 300))
+        # 带宽限制：bandwidth 作用于这台服务器的所有上传，directory_limiters 只作用于对应远程目录下的上传
+        self.bandwidth = BandwidthLimiter.from_config(self.config['WebDAV'].get('bandwidth_limits'))
+        self.directory_limiters = {}
+        # 上传后用一次 PROPFIND 校验远程文件，不下载也不重新读取本地文件
+        self.verify_uploads = self.config['WebDAV'].get('verify_uploads', True)
+        # {本地路径: 上传时计算的 SHA-256}，由 pop_upload_checksum 取走
+        self.upload_checksums = {}
+        self.checksum_lock = threading.Lock()
         
         logging.info("正在测试WebDAV连接...")
         try:
@@ -27,42 +77,270 @@ class WebDAVSyncClient:
         except Exception as e:
             logging.error(f"WebDAV连接测试失败: {str(e)}")
 
-    def sync_file(self, local_path, remote_directory):
+    def sync_file(self, local_path, remote_directory, db_manager=None):
         """
         同步单个文件到远程目录
+
+        上传时在同一次读取中计算 SHA-256，上传后用一次 PROPFIND 校验大小、ETag 和服务器提供的校验和，
+        校验和可以通过 pop_upload_checksum 获取
         
         :param local_path: 本地文件路径
         :param remote_directory: 远程目录路径
-        :return: 远程文件路径或None（如果同步失败）
+        :param db_manager: 可选的 DatabaseManager，用于记录分块上传进度
+        :return: 远程文件路径
+        :raises: 上传或校验失败时抛出原始异常（HTTP 错误、UploadVerificationError 等），由调用方决定是否重试
         """
-        try:
-            relative_path = os.path.basename(local_path)
-            remote_path = os.path.join(remote_directory, relative_path).replace('\\', '/')
-            
+        relative_path = os.path.basename(local_path)
+        remote_path = os.path.join(remote_directory, relative_path).replace('\\', '/')
+        
+        with self.upload_semaphore:
             logging.info(f"正在同步文件: {local_path} -> {remote_path}")
-            self.webdav_client.upload_sync(local_path=local_path, remote_path=remote_path)
-            logging.info(f"已同步文件: {local_path} -> {remote_path}")
-            
-            return remote_path
-        except Exception as e:
-            logging.error(f"同步文件时出错: {str(e)}")
-            return None
+            limiters = self.get_limiters(remote_path)
+            file_size = os.path.getsize(local_path)
+            if self.chunk_upload_mode and file_size >= self.chunk_upload_threshold:
+                remote_path = self.upload_chunked(local_path, remote_path, db_manager)
+                self.inventory.note_uploaded(remote_path, is_dir=self.chunk_upload_mode == 'parts')
+            else:
+                with open(local_path, 'rb') as f:
+                    reader = HashingReader(f, file_size)
+                    body = ThrottledReader(reader, file_size, limiters) if limiters else reader
+                    response = self.webdav_client.execute_request('upload', Urn(remote_path).quote(), data=body)
+                if reader.bytes_read != file_size:
+                    raise UploadVerificationError(f"文件在上传过程中被修改: {local_path}")
+                etag = _normalize_etag(response.headers.get('ETag'))
+                if self.verify_uploads:
+                    etag = self.verify_upload(remote_path, reader, etag)
+                self.inventory.note_uploaded(remote_path, file_size, etag)
+                with self.checksum_lock:
+                    self.upload_checksums[local_path] = reader.sha256.hexdigest()
+        logging.info(f"已同步文件: {local_path} -> {remote_path}")
+        
+        return remote_path
+
+    def verify_upload(self, remote_path, reader, put_etag=None):
+        """
+        用一次 PROPFIND（Depth: 0）校验刚上传的文件
 
-    def delete_remote_file(self, remote_path):
+        比较远程大小；PUT 响应带有 ETag 时要求与 PROPFIND 返回的一致（中间没有被其他客户端覆盖）；
+        服务器提供 oc:checksums（ownCloud/Nextcloud）时比较其中的 SHA256 或 MD5
+
+        :param remote_path: 远程文件路径
+        :param reader: 上传使用的 HashingReader
+        :param put_etag: PUT 响应中的 ETag
+        :return: 远程文件的 ETag
+        :raises UploadVerificationError: 校验失败时抛出
+        """
+        response = self.webdav_client.execute_request(
+            'info', Urn(remote_path).quote(), data=VERIFY_PROPFIND_BODY,
+            headers_ext=['Depth: 0', 'Content-Type: application/xml; charset=utf-8']
+        )
+        props = {}
+        for element in ElementTree.fromstring(response.content).iter():
+            if isinstance(element.tag, str) and element.text and element.tag.startswith('{'):
+                props.setdefault(element.tag.split('}', 1)[1], element.text.strip())
+
+        remote_size = props.get('getcontentlength')
+        if remote_size is not None and int(remote_size) != reader.size:
+            raise UploadVerificationError(f"远程文件大小 {remote_size} 与本地 {reader.size} 不一致: {remote_path}")
+
+        etag = _normalize_etag(props.get('getetag'))
+        if put_etag and etag and put_etag != etag:
+            raise UploadVerificationError(f"远程文件的 ETag 与上传时不一致，可能已被其他客户端覆盖: {remote_path}")
+
+        local_checksums = {'SHA256': reader.sha256.hexdigest(), 'MD5': reader.md5.hexdigest()}
+        # Nextcloud 的校验和在 oc:checksums 下的 oc:checksum 中，格式为 "SHA1:... MD5:..."
+        for checksum in (props.get('checksum') or props.get('checksums') or '').split():
+            algorithm, _, value = checksum.partition(':')
+            expected = local_checksums.get(algorithm.upper().replace('-', ''))
+            if expected and value.lower() != expected:
+                raise UploadVerificationError(f"远程文件的 {algorithm} 校验和与本地不一致: {remote_path}")
+        return etag or put_etag
+
+    def pop_upload_checksum(self, local_path):
+        """取出 sync_file 上传该文件时计算的 SHA-256，没有时返回None"""
+        with self.checksum_lock:
+            return self.upload_checksums.pop(local_path, None)
+
+    def upload_stream(self, chunks, remote_path):
+        """
+        以流的方式上传数据，请求体为分块传输编码
+
+        :param chunks: 产出 bytes 的可迭代对象
+        :param remote_path: 远程文件路径
+        :return: 远程文件路径
+        """
+        limiters = self.get_limiters(remote_path)
+        if limiters:
+            chunks = self._throttle_chunks(chunks, limiters)
+        with self.upload_semaphore:
+            logging.info(f"正在流式上传: {remote_path}")
+            self.webdav_client.execute_request('upload', Urn(remote_path).quote(), data=chunks)
+            self.inventory.note_uploaded(remote_path)
+            logging.info(f"已完成流式上传: {remote_path}")
+        return remote_path
+
+    def upload_bytes(self, data, remote_path):
+        """
+        上传内存中的数据，请求带 Content-Length，不使用分块传输编码
+
+        :param data: bytes
+        :param remote_path: 远程文件路径
+        :return: 远程文件路径
+        """
+        for limiter in self.get_limiters(remote_path):
+            limiter.consume(len(data))
+        with self.upload_semaphore:
+            self.webdav_client.execute_request('upload', Urn(remote_path).quote(), data=data)
+            self.inventory.note_uploaded(remote_path)
+        return remote_path
+
+    def set_directory_bandwidth(self, remote_directory, limiter):
+        """为远程目录设置单独的带宽限制，limiter 为 None 时取消"""
+        remote_directory = remote_directory.replace('\\', '/').rstrip('/')
+        if limiter is None:
+            self.directory_limiters.pop(remote_directory, None)
+        else:
+            self.directory_limiters[remote_directory] = limiter
+
+    def get_limiters(self, remote_path):
+        """上传到 remote_path 时需要遵守的所有带宽限制"""
+        limiters = [self.bandwidth] if self.bandwidth else []
+        for remote_directory, limiter in self.directory_limiters.items():
+            if remote_path.startswith(remote_directory + '/'):
+                limiters.append(limiter)
+        return limiters
+
+    @staticmethod
+    def _throttle_chunks(chunks, limiters):
+        for chunk in chunks:
+            for limiter in limiters:
+                limiter.consume(len(chunk))
+            yield chunk
+
+    def read_remote_file(self, remote_path):
+        """
+        读取远程文件的全部内容，只用于清单等小文件
+
+        :param remote_path: 远程文件路径
+        :return: bytes
+        """
+        return self.webdav_client.execute_request('download', Urn(remote_path).quote()).content
+
+    def make_remote_directory(self, remote_directory):
+        """
+        创建远程目录，已存在时不报错
+
+        :param remote_directory: 远程目录路径，父目录必须已经存在
+        """
+        self.webdav_client.mkdir(remote_directory)
+        self.inventory.note_uploaded(remote_directory.rstrip('/'), is_dir=True)
+
+    def upload_chunked(self, local_path, remote_path, db_manager=None):
+        """
+        分块上传大文件，每个分块确认后记录进度，下次从最后确认的位置继续
+
+        :param local_path: 本地文件路径
+        :param remote_path: 远程文件路径
+        :param db_manager: 可选的 DatabaseManager，用于读写上传进度
+        :return: 实际写入的远程路径，parts 模式下为分块目录
+        """
+        stat = os.stat(local_path)
+        file_size, file_mtime = stat.st_size, stat.st_mtime
+        parts_mode = self.chunk_upload_mode == 'parts'
+        target_path = f"{remote_path}.parts" if parts_mode else remote_path
+
+        offset = 0
+        if db_manager:
+            progress = db_manager.get_upload_progress(local_path)
+            # 文件和分块大小都没有变化时才能续传
+            if (progress and progress['remote_path'] == target_path
+                    and progress['file_size'] == file_size
+                    and progress['file_mtime'] == file_mtime
+                    and progress['chunk_size'] == self.chunk_size):
+                offset = progress['confirmed_offset']
+                logging.info(f"从 {offset}/{file_size} 字节处继续上传: {local_path}")
+
+        if parts_mode and not self.webdav_client.check(target_path):
+            self.webdav_client.mkdir(target_path)
+
+        limiters = self.get_limiters(remote_path)
+        # 从头上传时顺带计算 SHA-256；续传时前面的内容没有读取，不计算
+        sha256 = hashlib.sha256() if offset == 0 else None
+        # 固定大小的缓冲区，内存占用与文件大小无关
+        buffer = bytearray(self.chunk_size)
+        with open(local_path, 'rb') as f:
+            f.seek(offset)
+            while offset < file_size:
+                length = f.readinto(buffer)
+                if not length:
+                    break
+                chunk = bytes(memoryview(buffer)[:length])
+                if sha256:
+                    sha256.update(chunk)
+                for limiter in limiters:
+                    limiter.consume(length)
+                if parts_mode:
+                    part_path = f"{target_path}/{offset // self.chunk_size:08d}.part"
+                    self.webdav_client.execute_request('upload', Urn(part_path).quote(), data=chunk)
+                else:
+                    content_range = f"Content-Range: bytes {offset}-{offset + length - 1}/{file_size}"
+                    self.webdav_client.execute_request('upload', Urn(target_path).quote(), data=chunk,
+                                                       headers_ext=[content_range])
+                offset += length
+                if db_manager:
+                    db_manager.save_upload_progress(local_path, target_path, file_size, file_mtime,
+                                                    self.chunk_size, offset)
+
+        if parts_mode:
+            # 记录还原所需的信息，按序号顺序拼接分块即可得到原文件
+            manifest = {
+                'name': os.path.basename(remote_path),
+                'size': file_size,
+                'chunk_size': self.chunk_size,
+                'parts': (file_size + self.chunk_size - 1) // self.chunk_size
+            }
+            manifest_path = f"{target_path}/manifest.json"
+            self.webdav_client.execute_request('upload', Urn(manifest_path).quote(),
+                                               data=json.dumps(manifest).encode('utf-8'))
+        else:
+            # 不支持 Content-Range 的服务器会用每个分块覆盖文件，这里校验最终大小
+            remote_size = int(self.webdav_client.info(target_path).get('size') or 0)
+            if remote_size != file_size:
+                if db_manager:
+                    db_manager.clear_upload_progress(local_path)
+                raise Exception(f"远程文件大小 {remote_size} 与本地 {file_size} 不一致，服务器可能不支持 Content-Range，"
+                                f"请将 chunk_upload_mode 设置为 parts")
+
+        if db_manager:
+            db_manager.clear_upload_progress(local_path)
+        if sha256:
+            with self.checksum_lock:
+                self.upload_checksums[local_path] = sha256.hexdigest()
+        return target_path
+
+    def delete_remote_file(self, remote_path, missing_ok=False):
         """
         删除远程文件
 
         :param remote_path: 远程文件的完整路径
+        :param missing_ok: 为 True 时不预先检查是否存在，直接发送 DELETE，文件不存在也视为删除成功
         :return: 布尔值,表示删除是否成功
         """
         try:
-            if self.webdav_client.check(remote_path):
-                self.webdav_client.clean(remote_path)
-                logging.info(f"已删除远程文件: {remote_path}")
-                return True
-            else:
+            # 根据缓存的目录清单判断是否存在，不再逐个发送 HEAD 请求
+            if not missing_ok and self.inventory.get(remote_path) is None:
                 logging.warning(f"远程文件不存在，无法删除: {remote_path}")
                 return False
+            try:
+                self.webdav_client.clean(remote_path)
+            except RemoteResourceNotFound:
+                # 缓存过期期间可能已被其他客户端删除
+                self.inventory.note_deleted(remote_path)
+                logging.warning(f"远程文件不存在，无法删除: {remote_path}")
+                return missing_ok
+            self.inventory.note_deleted(remote_path)
+            logging.info(f"已删除远程文件: {remote_path}")
+            return True
         except Exception as e:
             logging.error(f"删除远程文件时出错: {remote_path}, 错误: {str(e)}")
             return False
@@ -75,56 +353,114 @@ class WebDAVSyncClient:
         :return: 包含文件信息的字典,如果文件不存在则返回 None
         """
         try:
-            info = self.webdav_client.info(remote_path)
-            if info:
-                modified_time_str = info.get('modified', '')
-                if modified_time_str:
-                    modified_time = datetime.strptime(modified_time_str, "%a, %d %b %Y %H:%M:%S %Z")
-                    modified_time = modified_time.replace(tzinfo=pytz.UTC)
-                else:
-                    modified_time = None
-
-                return {
-                    'name': info['name'],
-                    'size': info['size'],
-                    'modified': modified_time,
-                    'created': info.get('created'),
-                    'is_dir': info['isdir']
-                }
-            return None
+            return self.inventory.get(remote_path)
         except Exception as e:
             logging.error(f"获取远程文件信息失败: {remote_path}, 错误: {str(e)}")
             return None
 
-    def list_remote_directory(self, remote_directory):
+    def list_remote_directory(self, remote_directory, refresh=False):
         """
         列出远程目录中的所有文件
 
         :param remote_directory: 要列出内容的远程目录路径
-        :return: 文件名列表
+        :param refresh: 是否忽略缓存重新获取
+        :return: 文件名列表，目录名带结尾斜杠
         """
         try:
-            files = self.webdav_client.list(remote_directory)
-            return files
+            entries = self.inventory.list(remote_directory, refresh)
+            return [f"{name}/" if info['is_dir'] else name for name, info in entries.items()]
         except Exception as e:
             logging.error(f"列出远程目录内容时出错: {str(e)}")
             return []
 
 class SyncEventHandler(FileSystemEventHandler):
-    def __init__(self, sync_client, sync_config):
+    """
+    实时监控模式的事件处理器
+
+    同一路径的连续事件合并为一条待处理记录，最后一次事件后静默 watch_quiet_seconds 秒
+    且通过占用检测的文件才会交给 on_ready 上传；未就绪的文件稍后重试。
+    """
+    def __init__(self, sync_client, sync_config, on_ready=None, path_filter=None):
         self.sync_client = sync_client
         self.sync_config = sync_config
+        # 与定时任务相同的 include_patterns / exclude_patterns 规则
+        self.path_filter = path_filter
+        # on_ready 接收就绪的文件路径列表，默认直接逐个上传
+        self.on_ready = on_ready or self._sync_files
+        self.quiet_seconds = sync_config.get('watch_quiet_seconds', 5)
+        # {文件路径: 最后一次事件的时间}
+        self.pending = {}
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.worker = threading.Thread(target=self._run, name="sync-watch", daemon=True)
+
+    def start(self):
+        self.worker.start()
+
+    def stop(self):
+        self.stopped.set()
+        self.worker.join()
+
+    def _sync_files(self, file_paths):
+        for file_path in file_paths:
+            try:
+                self.sync_client.sync_file(file_path, self.sync_config['remote_directory'])
+            except Exception as e:
+                logging.error(f"同步文件时出错: {file_path}, 错误: {str(e)}")
+            self.sync_client.pop_upload_checksum(file_path)
+
+    def _touch(self, path):
+        if self.path_filter is not None:
+            rel_path = os.path.relpath(path, self.sync_config['local_sync_directory']).replace(os.sep, '/')
+            if not self.path_filter.allow_path(rel_path):
+                return
+        with self.lock:
+            self.pending[path] = time.monotonic()
 
     def on_created(self, event):
         if not event.is_directory:
-            self.sync_client.sync_file(event.src_path, self.sync_config['remote_directory'])
+            self._touch(event.src_path)
 
     def on_modified(self, event):
         if not event.is_directory:
-            self.sync_client.sync_file(event.src_path, self.sync_config['remote_directory'])
+            self._touch(event.src_path)
+
+    def on_moved(self, event):
+        if not event.is_directory:
+            with self.lock:
+                self.pending.pop(event.src_path, None)
+            self._touch(event.dest_path)
 
     def on_deleted(self, event):
+        # 本地删除不影响远程，远程文件按保存天数清理
         if not event.is_directory:
-            relative_path = os.path.basename(event.src_path)
-            remote_path = os.path.join(self.sync_config['remote_directory'], relative_path).replace('\\', '/')
-            self.sync_client.delete_remote_file(remote_path)
+            with self.lock:
+                self.pending.pop(event.src_path, None)
+
+    def _take_due(self):
+        """取出已经静默足够时间的文件"""
+        now = time.monotonic()
+        with self.lock:
+            due = [path for path, last_event in self.pending.items() if now - last_event >= self.quiet_seconds]
+            for path in due:
+                del self.pending[path]
+        return due
+
+    def _run(self):
+        while not self.stopped.wait(min(self.quiet_seconds, 1) or 0.1):
+            due = self._take_due()
+            if not due:
+                continue
+            ready = probe_ready_files(due, settle_seconds=0,
+                                      max_workers=self.sync_config.get('ready_probe_workers', 8))
+            ready_set = set(ready)
+            for path in due:
+                # 仍被占用的文件稍后重试，已经不存在的文件丢弃
+                if path not in ready_set and os.path.exists(path):
+                    with self.lock:
+                        self.pending.setdefault(path, time.monotonic())
+            if ready:
+                try:
+                    self.on_ready(ready)
+                except Exception as e:
+                    logging.error(f"实时同步文件时出错: {str(e)}")
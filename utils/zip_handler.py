@@ -1,40 +1,465 @@
 import os
+import io
+import json
+import zlib
+import threading
 import zipfile
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 import logging
+from utils.file_walker import walk_files
+
+# 每个压缩包内记录归档类型和变更列表的清单文件
+MANIFEST_NAME = '.wdsync_manifest.json'
+TIMESTAMP_FORMAT = '%Y-%m-%d-%H-%M-%S'
+
+# 已经压缩过的常见格式，再用 DEFLATE 压缩几乎没有收益
+DEFAULT_STORE_EXTENSIONS = [
+    '.jpg', '.jpeg', '.png', '.gif', '.webp', '.heic',
+    '.mp3', '.aac', '.ogg', '.flac', '.m4a',
+    '.mp4', '.mkv', '.mov', '.avi', '.webm',
+    '.zip', '.gz', '.tgz', '.bz2', '.xz', '.7z', '.rar', '.zst', '.lz4',
+    '.docx', '.xlsx', '.pptx', '.jar', '.apk', '.pdf'
+]
+
+COMPRESS_METHODS = {
+    'store': zipfile.ZIP_STORED,
+    'deflate': zipfile.ZIP_DEFLATED,
+    'bzip2': zipfile.ZIP_BZIP2,
+    'lzma': zipfile.ZIP_LZMA
+}
+
+class CompressionPolicy:
+    """
+    按文件类型选择压缩方式
+
+    已知的已压缩格式直接存储；未知类型先试压缩开头一段数据，压缩率不理想时也直接存储；
+    可以为指定扩展名设置压缩级别或更强的压缩算法（bzip2/lzma）。
+    """
+    def __init__(self, store_extensions=None, levels=None, methods=None,
+                 sample_size=64 * 1024, min_ratio=0.9, default_level=-1):
+        self.store_extensions = {ext.lower() for ext in (store_extensions or DEFAULT_STORE_EXTENSIONS)}
+        self.levels = {ext.lower(): level for ext, level in (levels or {}).items()}
+        self.methods = {ext.lower(): method for ext, method in (methods or {}).items()}
+        self.sample_size = sample_size
+        self.min_ratio = min_ratio
+        self.default_level = default_level
+        self.reset_stats()
+
+    @classmethod
+    def from_config(cls, sync_config):
+        """从同步配置的 compression_policy 创建，未配置时返回None"""
+        config = sync_config.get('compression_policy')
+        if not config:
+            return None
+        return cls(
+            store_extensions=config.get('store_extensions'),
+            levels=config.get('levels'),
+            methods=config.get('methods'),
+            sample_size=config.get('sample_size_kb', 64) * 1024,
+            min_ratio=config.get('min_ratio', 0.9),
+            default_level=sync_config.get('zip_compress_level', -1)
+        )
+
+    def reset_stats(self):
+        self.stats = {'files': 0, 'stored': 0, 'sampled': 0, 'original_bytes': 0, 'compressed_bytes': 0}
+
+    def choose(self, file_path):
+        """
+        选择文件的压缩方式
+
+        :param file_path: 文件路径
+        :return: (zipfile 压缩类型, 压缩级别)
+        """
+        ext = os.path.splitext(file_path)[1].lower()
+        if ext in self.methods:
+            return COMPRESS_METHODS[self.methods[ext]], self.levels.get(ext)
+        if ext in self.store_extensions:
+            return zipfile.ZIP_STORED, None
+        if ext in self.levels:
+            return zipfile.ZIP_DEFLATED, self.levels[ext]
+        if self.sample_size > 0 and not self._sample_compressible(file_path):
+            return zipfile.ZIP_STORED, None
+        return zipfile.ZIP_DEFLATED, self.default_level
+
+    def _sample_compressible(self, file_path):
+        """用最快的压缩级别试压缩文件开头的数据"""
+        try:
+            with open(file_path, 'rb') as f:
+                sample = f.read(self.sample_size)
+        except (OSError, IOError):
+            return True
+        if len(sample) < 512:
+            return True
+        self.stats['sampled'] += 1
+        return len(zlib.compress(sample, 1)) / len(sample) < self.min_ratio
+
+    def record(self, zinfo):
+        """记录写入完成的条目，用于统计"""
+        self.stats['files'] += 1
+        if zinfo.compress_type == zipfile.ZIP_STORED:
+            self.stats['stored'] += 1
+        self.stats['original_bytes'] += zinfo.file_size
+        self.stats['compressed_bytes'] += zinfo.compress_size
+
+    def log_summary(self, cpu_seconds):
+        """输出本次压缩节省的字节数和消耗的CPU时间"""
+        stats = self.stats
+        saved = stats['original_bytes'] - stats['compressed_bytes']
+        rate = saved / cpu_seconds / 1024 / 1024 if cpu_seconds > 0 else 0
+        logging.info(
+            f"压缩统计: 共 {stats['files']} 个文件, 直接存储 {stats['stored']} 个, 试压缩 {stats['sampled']} 个, "
+            f"原始 {stats['original_bytes']} 字节, 压缩后 {stats['compressed_bytes']} 字节, "
+            f"节省 {saved} 字节, CPU时间 {cpu_seconds:.2f} 秒, 每CPU秒节省 {rate:.2f} MB"
+        )
+
+def scan_directory(origin_dir, path_filter=None):
+    """
+    获取目录下所有文件的大小和修改时间
+
+    :param origin_dir: 源目录
+    :param path_filter: 可选的 PathFilter
+    :return: {相对路径: (大小, 修改时间)}，相对路径统一使用 / 分隔
+    """
+    return {record.rel_path: (record.size, record.mtime) for record in walk_files(origin_dir, path_filter)}
+
+class _PassthroughCompressor:
+    """数据已经在线程池中压缩好，写入zip时原样输出"""
+    def compress(self, data):
+        return data
+
+    def flush(self):
+        return b''
+
+# 预压缩写入依赖 zipfile 条目写入器的内部属性，不同 Python 版本可能变化，使用前先自检
+_WRITER_ATTRS = ('_compressor', '_crc', '_file_size')
+_predeflated_supported = None
+_predeflated_lock = threading.Lock()
+
+def _open_predeflated(zipf, zinfo):
+    """打开一个写入已压缩数据的条目写入器，写入器不支持替换压缩器时抛出 RuntimeError"""
+    writer = zipf.open(zinfo, 'w')
+    if not all(hasattr(writer, attr) for attr in _WRITER_ATTRS):
+        writer.close()
+        raise RuntimeError("zipfile 条目写入器不支持写入已压缩数据")
+    writer._compressor = _PassthroughCompressor()
+    return writer
+
+def _close_predeflated(writer, crc, size):
+    """写入器按写入的数据计算CRC和大小，关闭前换成原始数据的值"""
+    writer._crc = crc
+    writer._file_size = size
+    writer.close()
+
+class _NonSeekableWriter(io.RawIOBase):
+    """模拟不可 seek 的输出（如流式上传的管道），ZipFile 会改为写数据描述符"""
+    def __init__(self, buffer):
+        self.buffer = buffer
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        return self.buffer.write(data)
+
+    def flush(self):
+        pass
+
+def predeflated_supported():
+    """
+    检查当前 Python 的 zipfile 能否写入预压缩数据
+
+    分别向可 seek 和不可 seek 的输出写入一个多块条目，再用 testzip 和内容比对验证，结果缓存
+    """
+    global _predeflated_supported
+    with _predeflated_lock:
+        if _predeflated_supported is None:
+            _predeflated_supported = _check_predeflated()
+            if not _predeflated_supported:
+                logging.warning("当前 Python 版本的 zipfile 不支持写入预压缩数据，多线程压缩改为单线程")
+        return _predeflated_supported
+
+def _check_predeflated():
+    data = b'webdavsync predeflated self check ' * 4096
+    blocks = [data[:50000], data[50000:]]
+    try:
+        for seekable in (True, False):
+            buffer = io.BytesIO()
+            output = buffer if seekable else _NonSeekableWriter(buffer)
+            with zipfile.ZipFile(output, 'w', zipfile.ZIP_DEFLATED) as zipf:
+                zinfo = zipfile.ZipInfo('check.bin')
+                zinfo.compress_type = zipfile.ZIP_DEFLATED
+                writer = _open_predeflated(zipf, zinfo)
+                zdict = None
+                for index, block in enumerate(blocks):
+                    writer.write(_deflate_block(block, -1, zdict, index == len(blocks) - 1))
+                    zdict = block[-32768:]
+                _close_predeflated(writer, zlib.crc32(data), len(data))
+            with zipfile.ZipFile(io.BytesIO(buffer.getvalue())) as zipf:
+                if zipf.testzip() is not None or zipf.read('check.bin') != data:
+                    return False
+        return True
+    except Exception as e:
+        logging.debug(f"预压缩写入自检失败: {str(e)}")
+        return False
+
+def _deflate_block(data, level, zdict, is_last):
+    """
+    将一个数据块压缩为原始 deflate 流片段
+
+    非最后一块以 Z_SYNC_FLUSH 结束并按字节对齐，各块顺序拼接后仍是合法的 deflate 流；
+    使用前一块末尾32KB作为预置字典，压缩率与整文件压缩接近
+    """
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS, zdict=zdict) if zdict \
+        else zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS)
+    return compressor.compress(data) + compressor.flush(zlib.Z_FINISH if is_last else zlib.Z_SYNC_FLUSH)
+
+def write_file(zipf, file_path, arcname, policy=None):
+    """
+    按压缩策略把单个文件写入zip
+
+    :param zipf: 以写模式打开的 ZipFile
+    :param file_path: 文件路径
+    :param arcname: 压缩包内路径
+    :param policy: 可选的 CompressionPolicy，为None时使用 ZipFile 的默认压缩方式
+    """
+    if policy is None:
+        zipf.write(file_path, arcname)
+        return
+    compress_type, level = policy.choose(file_path)
+    zipf.write(file_path, arcname, compress_type=compress_type, compresslevel=level)
+    policy.record(zipf.filelist[-1])
+
+def write_files_parallel(zipf, files, workers=4, compress_level=-1, block_size=1024 * 1024, policy=None):
+    """
+    使用线程池并行压缩文件并写入zip，生成的是标准zip文件
+
+    文件按块读取，各块在线程池中压缩，再按顺序写入zip；同时在途的块数有上限，内存占用与文件大小无关。
+
+    :param zipf: 以写模式打开的 ZipFile
+    :param files: 可迭代的 (文件路径, 压缩包内路径)
+    :param workers: 压缩线程数
+    :param compress_level: zlib 压缩级别，-1为默认级别
+    :param block_size: 每个压缩块的大小
+    :param policy: 可选的 CompressionPolicy，不使用 DEFLATE 的文件在当前线程中直接写入
+    :return: 无法读取而跳过的文件路径列表
+    """
+    skipped = []
+    if not predeflated_supported():
+        for file_path, arcname in files:
+            try:
+                write_file(zipf, file_path, arcname, policy)
+            except (OSError, IOError) as e:
+                logging.warning(f"无法压缩文件 {file_path}: {str(e)}")
+                skipped.append(file_path)
+        return skipped
+
+    pending = deque()
+    open_entries = []
+    max_pending = max(1, workers) * 4
+
+    def write_block(item):
+        entry, future, is_first, is_last = item
+        if is_first:
+            entry['writer'] = _open_predeflated(zipf, entry['zinfo'])
+            open_entries.append(entry)
+        entry['writer'].write(future.result())
+        if is_last:
+            _close_predeflated(entry['writer'], entry['crc'], entry['size'])
+            open_entries.remove(entry)
+            if policy:
+                policy.record(entry['zinfo'])
+
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+        try:
+            for file_path, arcname in files:
+                compress_type, level = policy.choose(file_path) if policy else (zipfile.ZIP_DEFLATED, None)
+                if compress_type != zipfile.ZIP_DEFLATED:
+                    # 先写完排在前面的块，保证条目顺序
+                    while pending:
+                        write_block(pending.popleft())
+                    try:
+                        zipf.write(file_path, arcname, compress_type=compress_type, compresslevel=level)
+                        policy.record(zipf.filelist[-1])
+                    except (OSError, IOError) as e:
+                        logging.warning(f"无法压缩文件 {file_path}: {str(e)}")
+                        skipped.append(file_path)
+                    continue
+                level = compress_level if level is None else level
+
+                try:
+                    f = open(file_path, 'rb')
+                    block = f.read(block_size)
+                except (OSError, IOError) as e:
+                    logging.warning(f"无法压缩文件 {file_path}: {str(e)}")
+                    skipped.append(file_path)
+                    continue
+
+                with f:
+                    zinfo = zipfile.ZipInfo.from_file(file_path, arcname)
+                    zinfo.compress_type = zipfile.ZIP_DEFLATED
+                    entry = {'zinfo': zinfo, 'crc': 0, 'size': 0, 'writer': None}
+                    is_first = True
+                    zdict = None
+                    while True:
+                        next_block = f.read(block_size)
+                        is_last = not next_block
+                        entry['crc'] = zlib.crc32(block, entry['crc'])
+                        entry['size'] += len(block)
+                        future = executor.submit(_deflate_block, block, level, zdict, is_last)
+                        pending.append((entry, future, is_first, is_last))
+                        while len(pending) >= max_pending:
+                            write_block(pending.popleft())
+                        if is_last:
+                            break
+                        zdict = block[-32768:]
+                        block = next_block
+                        is_first = False
+
+            while pending:
+                write_block(pending.popleft())
+        except BaseException:
+            # 出错时关闭已打开的条目写入器，否则 ZipFile 无法关闭，原始异常会被掩盖
+            for entry in open_entries:
+                if entry['writer'] is not None and not entry['writer'].closed:
+                    try:
+                        entry['writer'].close()
+                    except Exception:
+                        pass
+            raise
+
+    return skipped
 
 class ZipHandler:
-    def __init__(self, origin_dir, sync_dir, zip_filename=None):
+    def __init__(self, origin_dir, sync_dir, zip_filename=None, workers=1, compress_level=-1, policy=None,
+                 path_filter=None):
         self.origin_dir = origin_dir
         self.sync_dir = sync_dir
         self.zip_filename = zip_filename
-        
-    def create_zip(self):
+        # workers 大于1时使用线程池并行压缩
+        self.workers = workers
+        self.compress_level = compress_level
+        self.policy = policy
+        # 压缩整个源目录时使用的文件筛选规则
+        self.path_filter = path_filter
+        # 指定文件列表压缩时，无法读取而跳过的相对路径
+        self.skipped_files = []
+
+    def create_zip(self, files=None, manifest=None):
+        """
+        创建压缩文件
+
+        :param files: 要压缩的相对路径列表，为None时压缩整个源目录
+        :param manifest: 写入压缩包的清单字典，为None时不写入
+        :return: 压缩文件路径，无法压缩的文件记录在 skipped_files 中
+        """
         if self.zip_filename:
             zip_path = os.path.join(self.sync_dir, self.zip_filename)
         else:
             # 保留原有的默认命名逻辑作为后备
             zip_path = os.path.join(self.sync_dir, 'archive.zip')
-        
+
         try:
             # 确保同步目录存在
             if not os.path.exists(self.sync_dir):
                 os.makedirs(self.sync_dir)
-            
+
             # 创建zip文件
-            with zipfile.ZipFile(zip_path, 'w', zipfile.ZIP_DEFLATED) as zipf:
-                # 遍历源目录
-                for root, _, files in os.walk(self.origin_dir):
-                    for file in files:
-                        file_path = os.path.join(root, file)
-                        # 获取相对路径
-                        rel_path = os.path.relpath(file_path, self.origin_dir)
-                        # 添加文件到zip
-                        zipf.write(file_path, rel_path)
-            
+            self.skipped_files = []
+            with zipfile.ZipFile(zip_path, 'w', zipfile.ZIP_DEFLATED, compresslevel=self.compress_level) as zipf:
+                if self.workers > 1:
+                    if files is None:
+                        files = (record.rel_path for record in walk_files(self.origin_dir, self.path_filter))
+                    skipped = write_files_parallel(
+                        zipf,
+                        ((os.path.join(self.origin_dir, rel_path), rel_path) for rel_path in files),
+                        self.workers,
+                        self.compress_level,
+                        policy=self.policy
+                    )
+                    self.skipped_files = [os.path.relpath(path, self.origin_dir).replace('\\', '/')
+                                          for path in skipped]
+                elif files is None:
+                    # 遍历源目录
+                    for record in walk_files(self.origin_dir, self.path_filter):
+                        write_file(zipf, record.path, record.rel_path, self.policy)
+                else:
+                    for rel_path in files:
+                        file_path = os.path.join(self.origin_dir, rel_path)
+                        try:
+                            write_file(zipf, file_path, rel_path, self.policy)
+                        except (OSError, IOError) as e:
+                            # 记录错误但继续处理其他文件，下次增量时会重新尝试
+                            logging.warning(f"无法压缩文件 {file_path}: {str(e)}")
+                            self.skipped_files.append(rel_path)
+
+                if manifest is not None:
+                    manifest = dict(manifest, skipped=self.skipped_files)
+                    zipf.writestr(MANIFEST_NAME, json.dumps(manifest, ensure_ascii=False, indent=2))
+
             logging.info(f"成功创建压缩文件: {zip_path}")
             return zip_path
-            
+
         except Exception as e:
             logging.error(f"创建压缩文件失败: {str(e)}")
-            raise
\ No newline at end of file
+            raise
+
+def read_manifest(zip_path):
+    """
+    读取压缩包的清单，没有清单的旧压缩包视为完整归档
+
+    :param zip_path: 压缩文件路径
+    :return: 清单字典
+    """
+    with zipfile.ZipFile(zip_path, 'r') as zipf:
+        if MANIFEST_NAME in zipf.namelist():
+            return json.loads(zipf.read(MANIFEST_NAME).decode('utf-8'))
+
+    # 文件名格式：folder_name_YYYY-MM-DD-HH-mm-SS.wdsync.zip
+    timestamp_str = os.path.basename(zip_path).split('_')[-1].replace('.wdsync.zip', '')
+    return {'type': 'full', 'created': timestamp_str, 'deleted': []}
+
+def restore_archives(archive_dir, target_dir, point_in_time=None):
+    """
+    根据完整归档和增量归档链还原指定时间点的目录
+
+    :param archive_dir: 存放 .wdsync.zip 的目录（可以是从远程下载回来的目录）
+    :param target_dir: 还原目标目录
+    :param point_in_time: 还原到的时间点（datetime），为None时还原到最新
+    :return: 按顺序应用的压缩文件路径列表
+    """
+    archives = []
+    for file in os.listdir(archive_dir):
+        if not file.endswith('.wdsync.zip'):
+            continue
+        zip_path = os.path.join(archive_dir, file)
+        manifest = read_manifest(zip_path)
+        try:
+            created = datetime.strptime(manifest['created'], TIMESTAMP_FORMAT)
+        except ValueError:
+            logging.warning(f"跳过无法识别时间的压缩文件: {zip_path}")
+            continue
+        if point_in_time is None or created <= point_in_time:
+            archives.append((created, zip_path, manifest))
+    archives.sort(key=lambda item: item[0])
+
+    # 从最后一个完整归档开始依次应用之后的增量归档
+    full_indexes = [i for i, (_, _, manifest) in enumerate(archives) if manifest['type'] == 'full']
+    if not full_indexes:
+        raise FileNotFoundError(f"目录 {archive_dir} 中没有可用的完整归档")
+    chain = archives[full_indexes[-1]:]
+
+    os.makedirs(target_dir, exist_ok=True)
+    applied = []
+    for _, zip_path, manifest in chain:
+        with zipfile.ZipFile(zip_path, 'r') as zipf:
+            members = [name for name in zipf.namelist() if name != MANIFEST_NAME]
+            zipf.extractall(target_dir, members)
+        for rel_path in manifest.get('deleted', []):
+            file_path = os.path.join(target_dir, rel_path)
+            if os.path.isfile(file_path):
+                os.remove(file_path)
+        applied.append(zip_path)
+        logging.info(f"已应用归档: {zip_path}")
+    return applied